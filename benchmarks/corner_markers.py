@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the corner marker detection on the test fixtures.
+
+Each image in `tests/data/cornermarkers` is processed as is and with
+speckle noise added, which resembles a dirty scanner glass.
+Images scaled to a resolution above `PYRAMID_DPI` are processed both
+with the coarse-to-fine search and at full resolution only.
+
+Usage:
+    python benchmarks/corner_markers.py [-h] [--repeat REPEAT] [--noise NOISE] [--scale SCALE]
+
+    optional arguments:
+      -h, --help        show this help message and exit
+      --repeat (int)    number of times each image is processed
+      --noise (float)   fraction of pixels turned black in the noisy images
+      --scale (int)     factor to scale the images with, the images are 150 DPI
+"""
+
+import argparse
+import os
+import sys
+import time
+from glob import glob
+
+import cv2
+import numpy as np
+from flask import Flask
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from zesje.factory import create_config  # noqa: E402
+from zesje import scans  # noqa: E402
+from zesje.scans import find_corner_marker_keypoints  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "..", "tests", "data", "cornermarkers")
+
+
+def add_noise(image_array, fraction, seed=0):
+    rng = np.random.default_rng(seed)
+    noisy = image_array.copy()
+    noisy[rng.random(image_array.shape[:2]) < fraction] = 0
+    return noisy
+
+
+def benchmark(image_array, repeat):
+    find_corner_marker_keypoints(image_array)  # warm up
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        keypoints = find_corner_marker_keypoints(image_array)
+
+    return (time.perf_counter() - start) / repeat, keypoints
+
+
+def main(repeat, noise, scale):
+    app = Flask(__name__)
+    create_config(app.config, None)
+
+    modes = {"": scans.PYRAMID_DPI}
+    if scale > 1:
+        # Compare with searching at full resolution only
+        modes[", full"] = 150 * scale
+
+    with app.app_context():
+        header = " ".join(f"{f'{kind}{mode} (ms)':>17}" for mode in modes for kind in ("clean", "noisy"))
+        print(f"{'image':<35} {header}  markers (clean / noisy)")
+        for path in sorted(glob(os.path.join(FIXTURES, "*.png"))):
+            image_array = np.array(Image.open(path).convert("RGB"))
+            if scale > 1:
+                image_array = cv2.resize(image_array, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+            noisy_array = add_noise(image_array, noise)
+
+            timings = []
+            for pyramid_dpi in modes.values():
+                scans.PYRAMID_DPI = pyramid_dpi
+                clean_time, keypoints = benchmark(image_array, repeat)
+                noisy_time, noisy_keypoints = benchmark(noisy_array, repeat)
+                timings += [clean_time, noisy_time]
+
+            print(
+                f"{os.path.basename(path):<35} "
+                + " ".join(f"{timing * 1000:>17.1f}" for timing in timings)
+                + f"  {len(keypoints)} / {len(noisy_keypoints)}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the corner marker detection")
+    parser.add_argument("--repeat", type=int, default=10, help="number of times each image is processed")
+    parser.add_argument("--noise", type=float, default=0.01, help="fraction of pixels turned black in the noisy images")
+    parser.add_argument("--scale", type=int, default=1, help="factor to scale the images with, the images are 150 DPI")
+    args = parser.parse_args()
+
+    main(args.repeat, args.noise, args.scale)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the exam export on generated data.
+
+The generated exam has the same shape as the data of `example_data.py`: three
+problems per page, 2 to 10 top-level feedback options per problem of which some
+have 2 to 5 children, and a single feedback option per graded solution.
+The data is stored in a temporary SQLite database.
+
+Usage:
+    python benchmarks/export.py [-h] [--pages PAGES] [--students STUDENTS] [--grade GRADE] [--repeat REPEAT]
+
+    optional arguments:
+      -h, --help            show this help message and exit
+      --pages (int)         number of pages of the exam
+      --students (int)      number of students
+      --grade (int)         how much of the solutions to grade (between 0 and 100)
+      --repeat (int)        number of times the export is timed
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from io import BytesIO
+from tempfile import TemporaryDirectory
+
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from zesje.database import db, Exam, Problem, FeedbackOption, Student, Submission, Solution, Grader  # noqa: E402
+from zesje.factory import create_config  # noqa: E402
+from zesje.statistics import full_exam_data  # noqa: E402
+
+
+def generate_exam(pages, students, grade):
+    grader = Grader(name="Grader", oauth_id="grader")
+    exam = Exam(name="Benchmark", finalized=True)
+    problems = [Problem(name=f"Problem {k + 1}", exam=exam) for k in range(3 * pages)]
+    db.session.add_all([grader, exam, *problems])
+    db.session.commit()
+
+    feedback = {}
+    for problem in problems:
+        root = problem.root_feedback
+        top_level = [
+            FeedbackOption(problem=problem, text=f"Option {k}", score=random.randint(0, 10), parent=root)
+            for k in range(random.randint(2, 10))
+        ]
+        children = [
+            FeedbackOption(problem=problem, text=f"Option {k}.{j}", score=random.randint(0, 10), parent=parent)
+            for k, parent in enumerate(random.sample(top_level, random.randint(2, len(top_level))))
+            for j in range(random.randint(2, 5))
+        ]
+        db.session.add_all(top_level + children)
+        feedback[problem] = top_level + children
+    db.session.commit()
+
+    for k in range(students):
+        student = Student(id=1000000 + k, first_name=f"First {k}", last_name=f"Last {k}")
+        sub = Submission(exam=exam, student=student, validated=True)
+        db.session.add_all([student, sub])
+
+        for problem in problems:
+            solution = Solution(submission=sub, problem=problem, remarks="")
+            if random.random() < grade:
+                solution.feedback = [random.choice(feedback[problem])]
+                solution.graded_by = grader
+            db.session.add(solution)
+    db.session.commit()
+
+    return exam.id
+
+
+def main(pages, students, grade, repeat):
+    with TemporaryDirectory() as data_directory:
+        app = Flask(__name__)
+        create_config(app.config, {"DATA_DIRECTORY": data_directory})
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(data_directory, 'benchmark.sqlite')}"
+        app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        db.init_app(app)
+
+        with app.app_context():
+            db.create_all()
+
+            start = time.perf_counter()
+            exam_id = generate_exam(pages, students, grade)
+            print(f"Generated {students} students and {3 * pages} problems in {time.perf_counter() - start:.1f} s")
+
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                data = full_exam_data(exam_id)
+                timings.append(time.perf_counter() - start)
+            print(f"full_exam_data: {min(timings):.3f} s (best of {repeat}), {data.shape[1]} columns")
+
+            start = time.perf_counter()
+            data.to_excel(BytesIO())
+            print(f"to_excel: {time.perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the exam export")
+    parser.add_argument("--pages", type=int, default=3, help="number of pages of the exam")
+    parser.add_argument("--students", type=int, default=1000, help="number of students")
+    parser.add_argument("--grade", type=int, default=90, help="how much of the solutions to grade (between 0 and 100)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of times the export is timed")
+    args = parser.parse_args()
+
+    random.seed(0)
+    main(args.pages, args.students, args.grade / 100, args.repeat)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the image processing of scanned pages in RGB and in grayscale.
+
+Each image in `tests/data/cornermarkers` is aligned and checked for misalignment
+against itself, which covers the image operations of `scans.analyse_page`
+except for the barcode decoding.
+
+Usage:
+    python benchmarks/grayscale.py [-h] [--repeat REPEAT]
+
+    optional arguments:
+      -h, --help        show this help message and exit
+      --repeat (int)    number of times each image is processed
+"""
+
+import argparse
+import os
+import sys
+import time
+from glob import glob
+
+import numpy as np
+from flask import Flask
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from zesje.constants import PAGE_FORMATS  # noqa: E402
+from zesje.factory import create_config  # noqa: E402
+from zesje.images import guess_dpi, is_misaligned  # noqa: E402
+from zesje.scans import find_corner_marker_keypoints, realign_image  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "..", "tests", "data", "cornermarkers")
+
+
+def process(image_array):
+    width, height = PAGE_FORMATS["A4"]
+    dpi = guess_dpi(image_array)
+    page_shape = np.rint([height / 72 * dpi, width / 72 * dpi]).astype(int)
+    keypoints = find_corner_marker_keypoints(image_array)
+    aligned = realign_image(image_array, page_shape, keypoints)
+
+    h, w = aligned.shape[:2]
+    is_misaligned(np.array([0, h, 0, w]) / dpi, aligned, aligned)
+
+    return aligned
+
+
+def benchmark(image_array, repeat):
+    process(image_array)  # warm up
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        aligned = process(image_array)
+
+    return (time.perf_counter() - start) / repeat, aligned.nbytes
+
+
+def main(repeat):
+    app = Flask(__name__)
+    create_config(app.config, None)
+
+    with app.app_context():
+        print(f"{'image':<35} {'RGB (ms)':>9} {'gray (ms)':>9} {'RGB (MB)':>9} {'gray (MB)':>9}")
+        for path in sorted(glob(os.path.join(FIXTURES, "a4*.png"))):
+            with Image.open(path) as image:
+                rgb = np.array(image.convert("RGB"))
+                gray = np.array(image.convert("L"))
+
+            rgb_time, rgb_bytes = benchmark(rgb, repeat)
+            gray_time, gray_bytes = benchmark(gray, repeat)
+
+            print(
+                f"{os.path.basename(path):<35} {rgb_time * 1000:>9.1f} {gray_time * 1000:>9.1f}"
+                f" {rgb_bytes / 1024**2:>9.1f} {gray_bytes / 1024**2:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the image processing in RGB and grayscale")
+    parser.add_argument("--repeat", type=int, default=10, help="number of times each image is processed")
+    args = parser.parse_args()
+
+    main(args.repeat)
@@ -13,6 +13,7 @@ import Tooltip from '../../components/Tooltip.jsx'
 
 import ExamEditor from './ExamEditor.jsx'
 import PanelGradeAnonymous from './PanelGradeAnonymous.jsx'
+import PanelGrayscale from './PanelGrayscale.jsx'
 import ExamFinalizeMarkdown from './ExamFinalize.md'
 import PanelExamName from './PanelExamName.jsx'
 import PanelFinalize from './PanelFinalize.jsx'
@@ -715,6 +716,11 @@ class ExamTemplated extends React.Component {
               gradeAnonymous={this.props.exam.gradeAnonymous}
               onChange={(anonymous) => this.props.updateExam()}
               />}
+            <PanelGrayscale
+              examID={this.state.examID}
+              grayscale={this.props.exam.grayscale}
+              onChange={(grayscale) => this.props.updateExam()}
+            />
           </div>
           <div className='column is-narrow'>
             <Pager
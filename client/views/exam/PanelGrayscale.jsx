@@ -0,0 +1,65 @@
+import React from 'react'
+import { toast } from 'bulma-toast'
+import Switch from '../../components/Switch.jsx'
+
+import * as api from '../../api.jsx'
+
+class PanelGrayscale extends React.Component {
+  state = {
+    examID: null,
+    grayscale: false,
+    isLoading: false
+  }
+
+  static getDerivedStateFromProps (nextProps, prevState) {
+    if (prevState.examID !== nextProps.examID) {
+      return {
+        examID: nextProps.examID,
+        grayscale: nextProps.grayscale,
+        isLoading: false
+      }
+    }
+
+    return null
+  }
+
+  toggleGrayscale = () => {
+    this.setState({ isLoading: true }, () =>
+      api.put(`exams/${this.state.examID}`, { grayscale: !this.state.grayscale })
+        .then(() => {
+          this.setState({
+            grayscale: !this.state.grayscale,
+            isLoading: false
+          }, () => this.props.onChange && this.props.onChange(this.state.grayscale))
+        })
+        .catch(err => {
+          toast({ message: 'Could not change Grayscale setting: ' + err.message, type: 'is-danger' })
+          this.setState({ isLoading: false })
+        })
+    )
+  }
+
+  render = () => (
+    <nav className='panel'>
+      <p className='panel-heading'>
+        Grayscale scans
+      </p>
+      <div className='panel-block'>
+        <div className='field flex-input'>
+          <label>Process scans without color</label>
+          <Switch
+            color='link'
+            disabled={this.state.isLoading}
+            value={this.state.grayscale}
+            onChange={(e) => this.toggleGrayscale()}
+          />
+        </div>
+      </div>
+      <div className='panel-block'>
+        Faster for black and white exams. Only applies to scans uploaded after changing it.
+      </div>
+    </nav>
+  )
+}
+
+export default PanelGrayscale
@@ -0,0 +1,24 @@
+""" Add grading version to problem
+
+Revision ID: 3f8d1b6a9c24
+Revises: e7a2c5d18b96
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "3f8d1b6a9c24"
+down_revision = "e7a2c5d18b96"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("problem", schema=None) as batch_op:
+        batch_op.add_column(sa.Column("grading_version", sa.Integer(), server_default="0", nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table("problem", schema=None) as batch_op:
+        batch_op.drop_column("grading_version")
@@ -0,0 +1,30 @@
+""" create scan_checkpoint
+
+Revision ID: 5b1e7c2d9f40
+Revises: e21e51ace137
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "5b1e7c2d9f40"
+down_revision = "e21e51ace137"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "scan_checkpoint",
+        sa.Column("scan_id", sa.Integer(), sa.ForeignKey("scan.id"), nullable=False),
+        sa.Column("position", sa.Integer(), nullable=False),
+        sa.Column("success", sa.Boolean(), nullable=False),
+        sa.Column("description", sa.Text(), nullable=True),
+        sa.Column("hash", sa.String(length=64), nullable=True),
+        sa.PrimaryKeyConstraint("scan_id", "position"),
+    )
+
+
+def downgrade():
+    op.drop_table("scan_checkpoint")
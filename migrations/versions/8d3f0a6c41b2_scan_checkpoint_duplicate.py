@@ -0,0 +1,24 @@
+""" Add duplicate to scan_checkpoint
+
+Revision ID: 8d3f0a6c41b2
+Revises: 5b1e7c2d9f40
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "8d3f0a6c41b2"
+down_revision = "5b1e7c2d9f40"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("scan_checkpoint", schema=None) as batch_op:
+        batch_op.add_column(sa.Column("duplicate", sa.Boolean(), server_default="0", nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table("scan_checkpoint", schema=None) as batch_op:
+        batch_op.drop_column("duplicate")
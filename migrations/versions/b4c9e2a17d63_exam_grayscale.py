@@ -0,0 +1,24 @@
+""" Add grayscale to exam
+
+Revision ID: b4c9e2a17d63
+Revises: 8d3f0a6c41b2
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "b4c9e2a17d63"
+down_revision = "8d3f0a6c41b2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("exam", schema=None) as batch_op:
+        batch_op.add_column(sa.Column("grayscale", sa.Boolean(), server_default="0", nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table("exam", schema=None) as batch_op:
+        batch_op.drop_column("grayscale")
@@ -0,0 +1,24 @@
+""" Add hash to page
+
+Revision ID: e7a2c5d18b96
+Revises: b4c9e2a17d63
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "e7a2c5d18b96"
+down_revision = "b4c9e2a17d63"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("page", schema=None) as batch_op:
+        batch_op.add_column(sa.Column("hash", sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("page", schema=None) as batch_op:
+        batch_op.drop_column("hash")
@@ -0,0 +1,225 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from zesje import image_cache
+from zesje.api import images
+from zesje.database import (
+    db,
+    Exam,
+    ExamLayout,
+    Problem,
+    ProblemWidget,
+    Submission,
+    Copy,
+    Page,
+    Solution,
+    FeedbackOption,
+    MultipleChoiceOption,
+)
+
+
+@pytest.fixture
+def solution(app):
+    exam = Exam(name="Exam", finalized=True, layout=ExamLayout.templated)
+    problem = Problem(exam=exam, name="Problem")
+    problem.widget = ProblemWidget(page=0, x=100, y=100, width=200, height=100)
+    sub = Submission(exam=exam)
+    copy = Copy(submission=sub, number=1)
+    page = Page(copy=copy, number=0, path="page00.jpg")
+    db.session.add_all([exam, sub, copy, page])
+    db.session.commit()
+
+    option = FeedbackOption(problem=problem, text="A", score=1, parent=problem.root_feedback)
+    mc_option = MultipleChoiceOption(x=120, y=120, label="A", feedback=option)
+    solution = Solution(submission=sub, problem=problem)
+    db.session.add_all([option, mc_option, solution])
+    db.session.commit()
+
+    Image.fromarray(np.full((1754, 1240, 3), 255, dtype=np.uint8)).save(page.abs_path)
+
+    yield exam, problem, solution, option
+
+
+def solution_url(exam, problem, solution):
+    return f"/api/images/solutions/{exam.id}/{problem.id}/{solution.submission_id}/0"
+
+
+def test_image_cached(test_client, solution, monkeypatch):
+    exam, problem, solution, _ = solution
+
+    response = test_client.get(solution_url(exam, problem, solution))
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    etag, _ = response.get_etag()
+
+    def no_read(*args, **kwargs):
+        raise AssertionError("The image should be served from the cache")
+
+    monkeypatch.setattr(images, "read_page", no_read)
+
+    response = test_client.get(solution_url(exam, problem, solution))
+    assert response.status_code == 200
+    assert response.get_etag() == (etag, False)
+
+    response = test_client.get(solution_url(exam, problem, solution), headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 304
+
+
+def test_image_changes_with_highlight(test_client, solution):
+    exam, problem, solution, option = solution
+
+    etag, _ = test_client.get(solution_url(exam, problem, solution)).get_etag()
+
+    solution.feedback.append(option)
+    db.session.commit()
+
+    response = test_client.get(solution_url(exam, problem, solution), headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
+
+
+def test_image_cache_size(test_client, solution, monkeypatch):
+    exam, problem, solution, _ = solution
+    monkeypatch.setitem(test_client.application.config, "IMAGE_CACHE_SIZE", 0)
+
+    response = test_client.get(solution_url(exam, problem, solution))
+
+    assert response.status_code == 200
+    assert not os.path.exists(os.path.join(test_client.application.config["DATA_DIRECTORY"], "cache"))
+
+
+def test_image_cache_eviction(app, monkeypatch):
+    monkeypatch.setitem(app.config, "IMAGE_CACHE_SIZE", 1)
+    image_cache.clear()
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda path: scanned.append(path) or scandir(path))
+    data = bytes(300 * 1024)
+
+    # Only the first image stored by this process scans the cache
+    for key in ["a", "b", "c"]:
+        image_cache.put(key, data)
+    assert len(scanned) == 1
+
+    # Crossing the limit evicts the least recently used image
+    image_cache.put("d", data)
+    assert len(scanned) == 2
+    assert [image_cache.contains(key) for key in "abcd"] == [False, True, True, True]
+
+
+def test_prefetch(test_client, solution, monkeypatch):
+    exam, problem, solution, _ = solution
+
+    images.prefetch_solution_images(exam, problem, [solution.submission_id])
+    # Wait for the prefetch thread to finish
+    images._prefetch_executor.submit(lambda: None).result()
+
+    def no_read(*args, **kwargs):
+        raise AssertionError("The image should be served from the cache")
+
+    monkeypatch.setattr(images, "read_page", no_read)
+
+    response = test_client.get(solution_url(exam, problem, solution))
+    assert response.status_code == 200
+
+
+def test_prefetch_without_cache(test_client, solution, monkeypatch):
+    exam, problem, solution, _ = solution
+    monkeypatch.setitem(test_client.application.config, "IMAGE_CACHE_SIZE", 0)
+    monkeypatch.setattr(images, "_prefetch_executor", None)
+
+    # Nothing is rendered, as it would not be cached
+    images.prefetch_solution_images(exam, problem, [solution.submission_id])
+
+
+def test_prefetch_superseded(test_client, solution):
+    exam, problem, solution, _ = solution
+    started, release = threading.Event(), threading.Event()
+
+    def blocked():
+        started.set()
+        release.wait()
+
+    images._prefetch_executor.submit(blocked)
+    started.wait()
+    images.prefetch_solution_images(exam, problem, [solution.submission_id], grader_id=1)
+    # The grader navigated further before the prefetching started
+    images.prefetch_solution_images(exam, problem, [], grader_id=1)
+    release.set()
+    images._prefetch_executor.submit(lambda: None).result()
+
+    assert not os.path.exists(os.path.join(test_client.application.config["DATA_DIRECTORY"], "cache"))
+
+
+def batch_url(exam, problem, submission_ids):
+    return f"/api/images/solutions/{exam.id}/{problem.id}?" + "&".join(f"submissions={id}" for id in submission_ids)
+
+
+def parse_multipart(response):
+    boundary = response.mimetype_params["boundary"].encode()
+    preamble, *parts, end = response.data.split(b"--" + boundary)
+    assert preamble == b""
+    assert end == b"--\r\n"
+
+    parsed = []
+    for part in parts:
+        head, body = part.split(b"\r\n\r\n", 1)
+        headers = dict(line.split(": ", 1) for line in head.decode().strip().split("\r\n"))
+        parsed.append((headers, body[: -len(b"\r\n")]))
+    return parsed
+
+
+def test_batch(test_client, solution):
+    exam, problem, solution, _ = solution
+    single = test_client.get(solution_url(exam, problem, solution))
+
+    # Unknown submissions are left out
+    response = test_client.get(batch_url(exam, problem, [12345, solution.submission_id]))
+
+    assert response.status_code == 200
+    assert response.mimetype == "multipart/mixed"
+    [(headers, body)] = parse_multipart(response)
+    assert headers["Content-Type"] == "image/jpeg"
+    assert headers["Content-Location"] == solution_url(exam, problem, solution)
+    assert headers["ETag"] == f'"{single.get_etag()[0]}"'
+    assert body == single.data
+
+
+def test_batch_highlight(test_client, solution):
+    exam, problem, solution, option = solution
+    solution.feedback.append(option)
+    db.session.commit()
+
+    [(headers, _)] = parse_multipart(test_client.get(batch_url(exam, problem, [solution.submission_id])))
+
+    assert headers["ETag"] == f'"{test_client.get(solution_url(exam, problem, solution)).get_etag()[0]}"'
+
+
+def test_batch_size(test_client, solution):
+    exam, problem, solution, _ = solution
+
+    assert test_client.get(batch_url(exam, problem, [])).status_code == 422
+    response = test_client.get(batch_url(exam, problem, range(test_client.application.config["MAX_BATCH_IMAGES"] + 1)))
+    assert response.status_code == 422
+
+
+def test_other_exam(test_client, solution):
+    exam, problem, solution, _ = solution
+    other_exam = Exam(name="Other exam", finalized=True, layout=ExamLayout.templated)
+    other_problem = Problem(exam=other_exam, name="Problem")
+    other_problem.widget = ProblemWidget(page=0, x=100, y=100, width=200, height=100)
+    db.session.add_all([other_exam, other_problem])
+    db.session.commit()
+
+    assert test_client.get(solution_url(other_exam, problem, solution)).status_code == 404
+    assert test_client.get(solution_url(other_exam, other_problem, solution)).status_code == 404
+    assert test_client.get(batch_url(other_exam, problem, [solution.submission_id])).status_code == 404
+
+    # Submissions of another exam are left out
+    response = test_client.get(batch_url(other_exam, other_problem, [solution.submission_id]))
+    assert response.status_code == 200
+    assert parse_multipart(response) == []
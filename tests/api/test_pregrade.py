@@ -0,0 +1,115 @@
+import pytest
+
+from zesje import celery, scans
+from zesje.database import (
+    db,
+    Exam,
+    ExamLayout,
+    ExamWidget,
+    Problem,
+    ProblemWidget,
+    Submission,
+    Copy,
+    Page,
+    Solution,
+    Grader,
+    FeedbackOption,
+)
+from zesje.pregrader import PregradeResult
+
+
+@pytest.fixture
+def exam_with_solutions(app, monkeypatch):
+    monkeypatch.setitem(celery.conf, "task_always_eager", True)
+
+    exam = Exam(name="Exam", token="PREGRADE", finalized=True, layout=ExamLayout.templated)
+    ExamWidget(exam=exam, name="student_id_widget", x=50, y=50)
+    ExamWidget(exam=exam, name="barcode_widget", x=40, y=510)
+    graded, ungraded = [Problem(exam=exam, name=name) for name in ("graded", "ungraded")]
+    for problem in graded, ungraded:
+        problem.widget = ProblemWidget(page=0, x=0, y=0, width=100, height=100)
+
+    grader = Grader(name="Grader", oauth_id="grader")
+    sub = Submission(exam=exam)
+    copy = Copy(submission=sub, number=1)
+    page = Page(copy=copy, number=0, path="page00.jpg")
+    db.session.add_all([exam, grader, sub, copy, page])
+    db.session.commit()
+
+    feedback = FeedbackOption(problem=graded, text="Correct", score=1, parent=graded.root_feedback)
+    graded_solution = Solution(submission=sub, problem=graded, graded_by=grader, feedback=[feedback])
+    ungraded_solution = Solution(submission=sub, problem=ungraded)
+    db.session.add_all([feedback, graded_solution, ungraded_solution])
+    db.session.commit()
+
+    pregraded_pages = []
+
+    def mock_pregrade_stored_page(image_path, page, exam_config, layouts):
+        pregraded_pages.append((image_path, page))
+        return {layout.id: PregradeResult(misaligned=False, blank=True, filled_feedback_ids=()) for layout in layouts}
+
+    monkeypatch.setattr(scans, "pregrade_stored_page", mock_pregrade_stored_page)
+
+    yield exam, graded_solution, ungraded_solution, pregraded_pages
+
+
+def test_repregrade(test_client, exam_with_solutions):
+    exam, graded_solution, ungraded_solution, pregraded_pages = exam_with_solutions
+
+    response = test_client.post(f"/api/pregrade/{exam.id}", json={})
+
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "SUCCESS"
+    assert [page for _, page in pregraded_pages] == [0]
+
+    blank = test_client.application.config["BLANK_FEEDBACK_NAME"]
+    assert [feedback.text for feedback in ungraded_solution.feedback] == [blank]
+    # Solutions graded by a human are left untouched
+    assert [feedback.text for feedback in graded_solution.feedback] == ["Correct"]
+    assert graded_solution.graded_by.oauth_id == "grader"
+
+
+def test_repregrade_selected_problems(test_client, exam_with_solutions):
+    exam, graded_solution, ungraded_solution, pregraded_pages = exam_with_solutions
+
+    response = test_client.post(f"/api/pregrade/{exam.id}", json={"problems": [graded_solution.problem_id]})
+
+    assert response.status_code == 200
+    assert len(pregraded_pages) == 1
+    assert ungraded_solution.feedback == []
+
+
+def test_repregrade_invalid(test_client, exam_with_solutions):
+    exam, *_, pregraded_pages = exam_with_solutions
+
+    response = test_client.post(f"/api/pregrade/{exam.id}", json={"problems": [12345]})
+    assert response.status_code == 404
+
+    exam.layout = ExamLayout.unstructured
+    db.session.commit()
+
+    response = test_client.post(f"/api/pregrade/{exam.id}", json={})
+    assert response.status_code == 409
+
+    assert pregraded_pages == []
+
+
+def test_repregrade_progress(test_client, exam_with_solutions, monkeypatch):
+    exam, *_ = exam_with_solutions
+    other_exam = Exam(name="Other exam", finalized=True, layout=ExamLayout.templated)
+    db.session.add(other_exam)
+    db.session.commit()
+
+    progress = test_client.post(f"/api/pregrade/{exam.id}", json={}).get_json()
+    assert progress["status"] == "SUCCESS"
+
+    # Eager tasks do not store their result
+    task_result = scans.repregrade_exam.apply(args=(exam.id,))
+    monkeypatch.setattr(scans.repregrade_exam, "AsyncResult", lambda task_id: task_result)
+
+    response = test_client.get(f"/api/pregrade/{exam.id}/{progress['task_id']}")
+    assert response.status_code == 200
+    assert response.get_json()["done"] == response.get_json()["total"] == 1
+
+    response = test_client.get(f"/api/pregrade/{other_exam.id}/{progress['task_id']}")
+    assert response.status_code == 404
@@ -1,5 +1,10 @@
 import pytest
-from zesje.api.submissions import has_all_required_feedback, _find_submission
+from zesje.api.submissions import (
+    has_all_required_feedback,
+    _find_submission,
+    _matching_submissions,
+    _upcoming_submissions,
+)
 from datetime import datetime
 from zesje.database import db, Exam, Problem, FeedbackOption, Student, Submission, Solution, Grader
 
@@ -133,6 +138,57 @@ def test_find_length(add_test_data, get_first_feedback, get_second_feedback):
     assert not matched
 
 
+def test_find_after_feedback_changes(add_test_data, add_test_submissions):
+    sub, sub2 = Submission.query.get(25), Submission.query.get(26)
+    feedback = FeedbackOption(problem_id=20, text="text", description="desc", score=1)
+    db.session.add(feedback)
+    db.session.flush()
+
+    _, count_follows, count_precedes, _ = _find_submission(sub, 20, 1, "first", False, [feedback.id], [], None)
+    assert count_follows == count_precedes == 0
+
+    sol2 = Solution.query.filter(Solution.submission_id == 26).one()
+    sol2.feedback = [feedback]
+
+    _, count_follows, count_precedes, _ = _find_submission(sub, 20, 1, "first", False, [feedback.id], [], None)
+    assert count_follows + count_precedes == 1
+    found = {_find_submission(sub, 20, 1, d, False, [feedback.id], [], None)[0] for d in ("next", "prev")}
+    assert sub2 in found
+
+    sol2.graded_by = None
+    found = {_find_submission(sub, 20, 1, d, True, [], [], None)[0] for d in ("next", "prev")}
+    assert sub2 in found
+
+
+@pytest.mark.parametrize("direction", ["next", "prev"])
+def test_upcoming_submissions(add_test_data, add_test_submissions, direction):
+    sub = Submission.query.get(25)
+
+    expected = []
+    current = sub
+    while (current := _find_submission(current, 20, 1, direction, False, [], [], None)[0]).id not in expected:
+        if current == sub:
+            break
+        expected.append(current.id)
+
+    matches = _matching_submissions(20, 1, False, [], [], None)
+    assert _upcoming_submissions(sub, 1, direction, 5, matches) == expected
+    assert _upcoming_submissions(sub, 1, direction, 1, matches) == expected[:1]
+
+
+def test_upcoming_submissions_after_first_and_last(add_test_data, add_test_submissions):
+    sub = Submission.query.get(25)
+
+    matches = _matching_submissions(20, 1, False, [], [], None)
+
+    def upcoming(direction):
+        return _upcoming_submissions(sub, 1, direction, 5, matches)
+
+    # After the first submission a grader moves forward, after the last one backward
+    assert upcoming("first") == upcoming("next")
+    assert upcoming("last") == upcoming("prev")
+
+
 def test_get_all_submissions(test_client, add_test_data, add_test_submissions):
     res = test_client.get("/api/submissions/42")
     data = res.get_json()
@@ -179,3 +235,30 @@ def test_get_submission(
     assert data["meta"]["no_next_sub"] == no_next_sub
     assert data["meta"]["no_prev_sub"] == no_prev_sub
     assert data["id"] == sub
+
+
+def test_grading_version(add_test_data, add_test_submissions):
+    problem = Problem.query.get(20)
+    feedback = FeedbackOption(problem_id=20, text="text", description="desc", score=1)
+    db.session.add(feedback)
+    db.session.commit()
+
+    def version():
+        return db.session.query(Problem.grading_version).filter(Problem.id == 20).scalar()
+
+    last_version = version()
+    for change in (
+        lambda sol: sol.feedback.append(feedback),
+        lambda sol: setattr(sol, "feedback", []),
+        lambda sol: setattr(sol, "graded_by", None),
+    ):
+        change(Solution.query.filter(Solution.submission_id == 26).one())
+        db.session.commit()
+        assert version() > last_version
+        last_version = version()
+
+    # Unrelated changes keep the navigation index
+    problem.name = "Problem happy"
+    Solution.query.filter(Solution.submission_id == 26).one().remarks = "remark"
+    db.session.commit()
+    assert version() == last_version
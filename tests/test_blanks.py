@@ -0,0 +1,158 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+from kombu.exceptions import OperationalError
+from PIL import Image
+
+import zesje.blanks
+from zesje.blanks import reference_image, reference_mask, clear_reference_images, render_reference_images
+from zesje.blanks import schedule_reference_images
+
+
+@pytest.fixture
+def blank_path(app):
+    blanks_dir = os.path.join(app.config["DATA_DIRECTORY"], "1_data", "blanks", "100")
+    os.makedirs(blanks_dir)
+    path = os.path.join(blanks_dir, "page00.jpg")
+    Image.new("RGB", (827, 1169), (255, 255, 255)).save(path)
+    return path
+
+
+def test_reference_image_cached(app, blank_path):
+    reference = reference_image(1, 0, 100)
+
+    assert reference.shape == (1169, 827, 3)
+    assert not reference.flags.writeable
+    assert reference_image(1, 0, 100) is reference
+
+
+def test_reference_image_reloaded_when_modified(app, blank_path):
+    reference = reference_image(1, 0, 100)
+
+    Image.new("RGB", (827, 1169), (0, 0, 0)).save(blank_path)
+    os.utime(blank_path, ns=(0, os.stat(blank_path).st_mtime_ns + 1))
+
+    new_reference = reference_image(1, 0, 100)
+    assert new_reference is not reference
+    assert np.all(new_reference < 10)
+
+
+def test_reference_cache_size(app, blank_path, monkeypatch):
+    monkeypatch.setitem(app.config, "REFERENCE_CACHE_SIZE", 0)
+
+    reference = reference_image(1, 0, 100)
+    assert reference_image(1, 0, 100) is not reference
+
+
+def test_reference_mask_cached(app, blank_path):
+    Image.new("RGB", (827, 1169), (0, 0, 0)).save(blank_path)
+
+    mask = reference_mask(1, 0, 100, 150)
+    thick_mask = reference_mask(1, 0, 100, 150, kernel_size=3)
+
+    assert mask.shape == (1169, 827)
+    assert not mask.flags.writeable
+    assert np.all(mask == 0)
+    assert reference_mask(1, 0, 100, 150) is mask
+    assert thick_mask is not mask
+    assert reference_mask(1, 0, 100, 150, kernel_size=3) is thick_mask
+
+
+def test_clear_reference_images(app, blank_path):
+    reference_image(1, 0, 100)
+
+    clear_reference_images(1)
+
+    assert not os.path.exists(os.path.dirname(blank_path))
+
+
+def fake_pdf_pages(pdf_path, dpi):
+    for _ in range(2):
+        yield Image.new("RGB", (dpi, dpi), (255, 255, 255)), None
+
+
+def test_render_reference_images(app, monkeypatch):
+    monkeypatch.setattr(zesje.blanks, "extract_images_from_pdf", fake_pdf_pages)
+
+    render_reference_images(1, dpis=(50, 60))
+
+    blanks_dir = os.path.join(app.config["DATA_DIRECTORY"], "1_data", "blanks")
+    assert sorted(os.listdir(os.path.join(blanks_dir, "50"))) == ["page00.jpg", "page01.jpg"]
+    assert reference_image(1, 1, 60).shape == (60, 60, 3)
+    # No temporary directories are left behind
+    assert sorted(name for name in os.listdir(blanks_dir) if not name.endswith(".lock")) == ["50", "60"]
+
+
+def test_render_reference_images_failure(app, monkeypatch):
+    def failing_pdf_pages(pdf_path, dpi):
+        yield Image.new("RGB", (dpi, dpi)), None
+        yield RuntimeError("Corrupt page"), None
+
+    monkeypatch.setattr(zesje.blanks, "extract_images_from_pdf", failing_pdf_pages)
+
+    with pytest.raises(RuntimeError):
+        render_reference_images(1, dpis=(50,))
+
+    blanks_dir = os.path.join(app.config["DATA_DIRECTORY"], "1_data", "blanks")
+    assert [name for name in os.listdir(blanks_dir) if not name.endswith(".lock")] == []
+
+
+def test_reference_image_missing_page(app, blank_path, monkeypatch):
+    monkeypatch.setattr(zesje.blanks, "extract_images_from_pdf", fake_pdf_pages)
+
+    # The second page was removed or added after the pages were rendered
+    assert reference_image(1, 1, 100).shape == (100, 100, 3)
+    assert sorted(os.listdir(os.path.dirname(blank_path))) == ["page00.jpg", "page01.jpg"]
+
+
+def test_render_reference_images_existing(app, blank_path, monkeypatch):
+    monkeypatch.setattr(zesje.blanks, "extract_images_from_pdf", fake_pdf_pages)
+
+    render_reference_images(1, dpis=(100,))
+
+    assert os.listdir(os.path.dirname(blank_path)) == ["page00.jpg"]
+
+
+def test_clear_reference_images_waits_for_rendering(app, monkeypatch):
+    rendering, release = threading.Event(), threading.Event()
+
+    def slow_pdf_pages(pdf_path, dpi):
+        rendering.set()
+        release.wait()
+        yield from fake_pdf_pages(pdf_path, dpi)
+
+    def in_app_context(function, *args):
+        with app.app_context():
+            function(*args)
+
+    monkeypatch.setattr(zesje.blanks, "extract_images_from_pdf", slow_pdf_pages)
+    render_thread = threading.Thread(target=in_app_context, args=(render_reference_images, 1, (50,)), daemon=True)
+    render_thread.start()
+    rendering.wait()
+
+    clear_thread = threading.Thread(target=in_app_context, args=(clear_reference_images, 1), daemon=True)
+    clear_thread.start()
+    try:
+        clear_thread.join(timeout=0.2)
+        assert clear_thread.is_alive()
+    finally:
+        release.set()
+
+    render_thread.join()
+    clear_thread.join()
+
+    # The images rendered from the outdated PDF are removed once they are complete
+    blanks_dir = os.path.join(app.config["DATA_DIRECTORY"], "1_data", "blanks")
+    assert [name for name in os.listdir(blanks_dir) if not name.endswith(".lock")] == []
+
+
+def test_schedule_reference_images_without_broker(app, monkeypatch):
+    def unavailable_broker(*args, **kwargs):
+        raise OperationalError("Connection refused")
+
+    monkeypatch.setattr(render_reference_images, "apply_async", unavailable_broker)
+
+    # The images are rendered on first use instead
+    schedule_reference_images(1)
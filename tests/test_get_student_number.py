@@ -16,3 +16,10 @@ def test_get_studentnumber_precision(config_app, datadir):
         expected_number = int(filename_short)
         detected_number = scans.get_student_number(image, [50, 231, 50, 363])
         assert expected_number == detected_number
+
+
+def test_get_studentnumber_grayscale(config_app, datadir):
+    for filename_full in os.listdir(os.path.join(datadir, "studentnumbers")):
+        image = cv2.imread(os.path.join(datadir, "studentnumbers", filename_full), cv2.IMREAD_GRAYSCALE)
+        expected_number = int(os.path.splitext(filename_full)[0])
+        assert scans.get_student_number(image, [50, 231, 50, 363]) == expected_number
@@ -1,3 +1,4 @@
+import json
 import pytest
 import zipfile
 
@@ -8,8 +9,10 @@ from pathlib import Path
 from io import BytesIO
 from PIL import Image
 
-from zesje.image_extraction import convert_to_rgb, extract_pages_from_file, guess_page_info, guess_missing_page_info
-from zesje.image_extraction import extract_image_wand
+from zesje.image_extraction import convert_to_rgb, convert_to_grayscale, extract_pages_from_file
+from zesje.image_extraction import guess_page_info, guess_missing_page_info
+from zesje.image_extraction import extract_image_wand, build_manifest, extract_pages_from_manifest
+from zesje.image_extraction import manifest_to_data, manifest_from_data
 from zesje.database import Student
 
 image_modes = ["RGB", "RGBA", "L", "P", "CMYK", "HSV"]
@@ -25,6 +28,16 @@ def test_convert_to_rgb(image_mode):
     assert converted.size == image.size
 
 
+@pytest.mark.parametrize("image_mode", image_modes, ids=image_modes)
+def test_convert_to_grayscale(image_mode):
+    image = Image.new(image_mode, (10, 10))
+
+    converted = convert_to_grayscale(image)
+
+    assert converted.mode == "L"
+    assert converted.size == image.size
+
+
 def test_large_mediabox_limit(app):
     pdf_path = Path(app.config["DATA_DIRECTORY"]) / "large.pdf"
     page_size = (10000, 15000)
@@ -257,3 +270,47 @@ def test_extract_images_from_mixed_zip(app, datadir):
 
     assert pages == []
     assert last_total == 5
+
+
+def test_manifest_mixed_zip(app, datadir):
+    flat_pdf = Path(datadir) / "flattened-a4-2pages.pdf"
+    with BytesIO() as zip_bytes:
+        with zipfile.ZipFile(zip_bytes, "w") as z, BytesIO() as image_bytes, Image.new("RGB", (10, 10)) as image:
+            image.save(image_bytes, format="png")
+            image_bytes.seek(0)
+            z.writestr("1000000-1.png", image_bytes.read())
+            z.writestr("1000000.pdf", flat_pdf.read_bytes())
+            z.writestr("corrupted.pdf", b"1701")
+
+        zip_bytes.seek(0)
+        manifest = list(build_manifest(zip_bytes, "scan.zip"))
+
+        assert [entry.file_info for entry in manifest] == [
+            ["scan.zip", "1000000-1.png"],
+            ["scan.zip", "1000000.pdf", 1],
+            ["scan.zip", "1000000.pdf", 2],
+            ["scan.zip", "corrupted.pdf"],
+        ]
+        assert [entry.kind for entry in manifest] == ["image", "pdf", "pdf", "pdf"]
+        assert [entry.page for entry in manifest] == [None, 0, 1, None]
+        assert isinstance(manifest[-1].error, Exception)
+
+        # Only the requested entries are extracted
+        images = list(extract_pages_from_manifest(zip_bytes, manifest[2:]))
+        assert len(images) == 2
+
+        (image, file_info), (error, error_file_info) = images
+        assert isinstance(image, Image.Image)
+        assert file_info == ["scan.zip", "1000000.pdf", 2]
+        assert isinstance(error, Exception)
+        assert error_file_info == ["scan.zip", "corrupted.pdf"]
+
+        # The manifest can be passed to other processes as plain data
+        data = json.loads(json.dumps(manifest_to_data(manifest)))
+        restored = manifest_from_data(data)
+        assert [entry[:4] for entry in restored] == [entry[:4] for entry in manifest]
+        assert str(restored[-1].error) == str(manifest[-1].error)
+        assert [file_info for _, file_info in extract_pages_from_manifest(zip_bytes, restored[2:])] == [
+            file_info,
+            error_file_info,
+        ]
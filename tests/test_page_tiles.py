@@ -0,0 +1,117 @@
+import errno
+import os
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from zesje import page_tiles
+from zesje.database import db, Exam, Submission, Copy, Page
+from zesje.images import get_box, read_page
+
+
+@pytest.fixture
+def page_path(app):
+    # A smooth A4 page at 200 DPI, such that the tiles are close to the stored page
+    rng = np.random.default_rng(0)
+    image = cv2.resize(rng.integers(0, 256, (74, 52, 3), dtype=np.uint8), (1654, 2339), interpolation=cv2.INTER_CUBIC)
+
+    exam = Exam(name="Exam")
+    copy = Copy(submission=Submission(exam=exam), number=1)
+    page = Page(copy=copy, number=0, path="page00.jpg")
+    db.session.add_all([exam, copy, page])
+    db.session.commit()
+
+    cv2.imwrite(page.abs_path, image)
+    yield page.abs_path
+
+
+def test_save_tiles(page_path):
+    page_tiles.save_tiles(page_path)
+
+    manifest = page_tiles.load_manifest(page_path)
+    assert manifest["levels"] == [[1654, 2339], [827, 1170], [414, 585], [207, 293]]
+    assert len(os.listdir(os.path.join(page_tiles.tiles_directory(page_path), "0"))) == 5 * 4
+
+
+@pytest.mark.parametrize(
+    "box",
+    [[0.5, 2, 1, 4], [5, 6.5, 3, 8], [10, 11.7, 0, 8.3], [-1, 13, -1, 10]],
+    ids=["top", "middle", "bottom", "all"],
+)
+def test_read_tiled_box(page_path, box, monkeypatch):
+    page_tiles.save_tiles(page_path)
+    box = np.array(box, dtype=float)
+    expected = get_box(cv2.imread(page_path), box, padding=0.3)
+
+    def no_decode(*args, **kwargs):
+        raise AssertionError("The page itself should not be decoded")
+
+    monkeypatch.setattr(Image, "open", no_decode)
+    monkeypatch.setattr(cv2, "imdecode", no_decode)
+    image, dpi, _ = read_page(page_path, box, padding=0.3)
+
+    assert dpi == 200
+    assert image.shape == expected.shape
+    assert np.abs(image.astype(int) - expected).mean() < 2
+
+
+@pytest.mark.parametrize("min_width, width", [(None, 1654), (1000, 1654), (800, 827), (300, 414)])
+def test_read_tiled_level(page_path, min_width, width):
+    page_tiles.save_tiles(page_path)
+
+    image, _, origin = read_page(page_path, min_width=min_width)
+
+    assert image.shape[1] == width
+    assert origin == (0, 0)
+
+
+def test_modified_page(page_path):
+    page_tiles.save_tiles(page_path)
+
+    cv2.imwrite(page_path, np.zeros((2339, 1654, 3), dtype=np.uint8))
+
+    assert page_tiles.load_manifest(page_path) is None
+    image, *_ = read_page(page_path, [0.5, 2, 1, 4], padding=0.3)
+    assert not image.any()
+
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_update(app, page_path, monkeypatch, enabled):
+    page_tiles.save_tiles(page_path)
+    cv2.imwrite(page_path, np.zeros((2339, 1654, 3), dtype=np.uint8))
+    monkeypatch.setitem(app.config, "PAGE_TILES", enabled)
+
+    page_tiles.update(page_path)
+
+    assert os.path.exists(page_tiles.tiles_directory(page_path)) == enabled
+    assert (page_tiles.load_manifest(page_path) is not None) == enabled
+
+
+def test_save_tiles_error(app, page_path, monkeypatch, caplog):
+    def full_disk(*args, **kwargs):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(page_tiles, "_save_level", full_disk)
+
+    with pytest.raises(OSError):
+        page_tiles.save_tiles(page_path)
+    assert os.listdir(os.path.dirname(page_path)) == ["page00.jpg"]
+
+    # Storing a page does not fail because of its tiles
+    monkeypatch.setitem(app.config, "PAGE_TILES", True)
+    page_tiles.update(page_path)
+    assert "No space left on device" in caplog.text
+
+
+def test_tile_pages_command(app, page_path):
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(page_tiles.tile_pages_command)
+    assert result.exit_code == 0
+    assert page_tiles.load_manifest(page_path) is not None
+
+    result = runner.invoke(page_tiles.tile_pages_command, ["--remove"])
+    assert result.exit_code == 0
+    assert not os.path.exists(page_tiles.tiles_directory(page_path))
@@ -3,6 +3,7 @@ import pytest
 from PIL import Image
 import numpy as np
 from zesje import pregrader
+from zesje.images import binarize, guess_dpi, widget_area
 from zesje.database import Problem, ProblemWidget
 from reportlab.lib.pagesizes import A4
 
@@ -84,6 +85,19 @@ def test_is_checkbox_filled(dpi, checkbox_images, app):
                 index -= 1
 
 
+@pytest.mark.parametrize("dpi", [100, 300], ids=["100 dpi", "300 dpi"])
+def test_checkbox_fill_ratios(dpi, checkbox_images, app):
+    student, _ = checkbox_images[dpi]
+    boxes = [(50 + x, 300 + y) for x in range(0, 460, 10) for y in range(0, 450, 15)]
+
+    fill_ratios = pregrader.checkbox_fill_ratios(boxes, student)
+
+    assert fill_ratios.shape == (len(boxes),)
+    assert np.any(fill_ratios >= 1) and np.any(fill_ratios < 1)
+    for box, fill_ratio in zip(boxes, fill_ratios):
+        assert pregrader.checkbox_fill_ratios([box], student)[0] == fill_ratio
+
+
 problems_with_result = [
     ((60, 154, 483, 206), True),
     ((34, 135, 535, 247), True),
@@ -119,6 +133,25 @@ def test_is_misaligned(config_app, coords, student_misaligned, reference):
     assert pregrader.is_problem_misaligned(problem, student_misaligned, reference)
 
 
+@pytest.mark.parametrize("student", ["student_aligned", "student_misaligned"])
+def test_pregrade_with_reference_masks(config_app, request, student, reference):
+    student = request.getfixturevalue(student)
+    layouts = []
+    for k, (coords, _) in enumerate(problems_with_result):
+        problem = Problem(name="Problem")
+        problem.widget = ProblemWidget(x=coords[0], y=coords[1], width=coords[2], height=coords[3])
+        layouts.append(pregrader.ProblemLayout(k, 0, widget_area(problem), ()))
+
+    dpi = guess_dpi(reference)
+    masks = pregrader.ReferenceMasks(
+        misalignment=binarize(reference, config_app.config["THRESHOLD_MISALIGMENT"]),
+        blank=binarize(reference, config_app.config["THRESHOLD_BLANK"], pregrader._blank_kernel_size(dpi)),
+    )
+
+    expected = pregrader.pregrade_problems(layouts, 0, student, reference)
+    assert pregrader.pregrade_problems(layouts, 0, student, reference, masks) == expected
+
+
 def test_threshold(config_app, datadir):
     dir = os.path.join(datadir, "thresholds")
     files = os.listdir(dir)
@@ -5,9 +5,22 @@ from io import BytesIO
 from PIL import Image
 from pathlib import Path
 
+from zesje import celery, scans
 from zesje.raw_scans import create_copy, process_page
-from zesje.scans import _process_scan, exam_metadata
-from zesje.database import db, Exam, Student, Submission, Scan, Problem, ProblemWidget, ExamLayout, Copy, Page
+from zesje.scans import _process_scan, exam_metadata, process_scan
+from zesje.database import (
+    db,
+    Exam,
+    Student,
+    Submission,
+    Scan,
+    ScanCheckpoint,
+    Problem,
+    ProblemWidget,
+    ExamLayout,
+    Copy,
+    Page,
+)
 
 
 @pytest.fixture
@@ -74,6 +87,152 @@ def test_zip_process(app_with_data, zip_file):
         assert page.number == 0
 
 
+def test_zip_process_in_chunks(app_with_data, image_file, monkeypatch):
+    app, exam, students = app_with_data
+    scan = Scan(exam=exam, name="test.zip", status="processing")
+    db.session.add(scan)
+    db.session.commit()
+
+    with zipfile.ZipFile(str(scan.path), "w") as z:
+        z.writestr("1000000-1.png", image_file.getvalue())
+        z.writestr("notes.txt", "not an image")
+        z.writestr("1000001-1.png", image_file.getvalue())
+
+    # Run the chunks and the summary in this process instead of on the workers
+    monkeypatch.setitem(celery.conf, "task_always_eager", True)
+    monkeypatch.setitem(app.config, "SCAN_CHUNK_SIZE", 1)
+    manifests_built = []
+    build_manifest = scans.build_manifest
+    monkeypatch.setattr(scans, "build_manifest", lambda *args: manifests_built.append(args) or build_manifest(*args))
+
+    _process_scan(scan.id, exam.layout)
+
+    # The chunks get their entries of the manifest instead of building it again
+    assert len(manifests_built) == 1
+
+    for student in students:
+        sub = Submission.query.filter(Submission.student == student, Submission.exam == exam).one()
+        assert len(sub.copies) == 1
+        assert len(sub.copies[0].pages) == 1
+
+    assert scan.status == "error"
+    assert scan.message == "Processed 2 / 3 pages.\ntest.zip, notes.txt: File is not an image."
+
+
+def test_resume_process(app_with_data, zip_file):
+    app, exam, students = app_with_data
+    scan = Scan(exam=exam, name="test.zip", status="error")
+    # The first page was processed before the processing was interrupted
+    scan.checkpoints.append(ScanCheckpoint(position=0, success=False, description="Interrupted"))
+    db.session.add(scan)
+    db.session.commit()
+
+    with open(str(scan.path), "wb") as file:
+        file.write(zip_file.getvalue())
+
+    _process_scan(scan.id, exam.layout)
+
+    assert Submission.query.filter(Submission.student == students[0]).one_or_none() is None
+    assert Submission.query.filter(Submission.student == students[1]).one()
+
+    assert [checkpoint.position for checkpoint in scan.checkpoints] == [0, 1]
+    assert scan.checkpoints[1].success
+    assert len(scan.checkpoints[1].hash) == 64
+    assert scan.message == "Processed 1 / 2 pages.\ntest.zip, 1000000-1.png: Interrupted"
+
+
+def test_resume_after_worker_died(app_with_data, zip_file):
+    app, exam, students = app_with_data
+    scan = Scan(exam=exam, name="test.zip", status="processing")
+    db.session.add(scan)
+    db.session.commit()
+
+    with open(str(scan.path), "wb") as file:
+        file.write(zip_file.getvalue())
+    # The worker died while processing the first page
+    Path(f"{scan.path}.0.in-progress").write_text("0")
+
+    _process_scan(scan.id, exam.layout)
+
+    assert Submission.query.filter(Submission.student == students[0]).one_or_none() is None
+    assert Submission.query.filter(Submission.student == students[1]).one()
+    assert [checkpoint.success for checkpoint in scan.checkpoints] == [False, True]
+    assert scan.message == "Processed 1 / 2 pages.\ntest.zip, 1000000-1.png: Processing this page stopped the worker."
+    assert not Path(f"{scan.path}.0.in-progress").exists()
+
+
+def test_retry_unexpected_errors(app_with_data, zip_file, monkeypatch):
+    app, exam, students = app_with_data
+    scan = Scan(exam=exam, name="test.zip", status="processing")
+    db.session.add(scan)
+    db.session.commit()
+
+    with open(str(scan.path), "wb") as file:
+        file.write(zip_file.getvalue())
+
+    def failing_process_page(*args, **kwargs):
+        raise RuntimeError("Database connection lost")
+
+    with monkeypatch.context() as m:
+        m.setattr(scans, "process_page_raw", failing_process_page)
+        _process_scan(scan.id, exam.layout)
+
+    assert scan.message.startswith("Failed on all 2 pages.")
+    assert scan.checkpoints == []
+
+    _process_scan(scan.id, exam.layout)
+
+    assert scan.message == "Processed 2 pages."
+    assert [checkpoint.success for checkpoint in scan.checkpoints] == [True, True]
+
+
+@pytest.mark.parametrize("error", [SystemExit, KeyboardInterrupt])
+def test_shutdown_is_resumed(app_with_data, monkeypatch, error):
+    app, exam, students = app_with_data
+    scan = Scan(exam=exam, name="test.zip", status="processing")
+    db.session.add(scan)
+    db.session.commit()
+
+    def interrupted_process_scan(*args):
+        raise error()
+
+    monkeypatch.setattr(scans, "_exit_on_signals", lambda: None)
+    monkeypatch.setattr(scans, "_process_scan", interrupted_process_scan)
+
+    with pytest.raises(error):
+        process_scan(scan.id, exam.layout.value)
+
+    # The scan is processed again when the task is delivered again
+    assert scan.status == "processing"
+
+
+def test_skip_duplicate_pages(app_with_data, zip_file):
+    app, exam, students = app_with_data
+    scans = [Scan(exam=exam, name="test.zip", status="processing") for _ in range(2)]
+    db.session.add_all(scans)
+    db.session.commit()
+
+    for scan in scans:
+        with open(str(scan.path), "wb") as file:
+            file.write(zip_file.getvalue())
+
+    _process_scan(scans[0].id, exam.layout)
+    # The pages of both students are identical images, but belong to different students
+    assert scans[0].message == "Processed 2 pages."
+
+    pages = Page.query.all()
+    modified = [Path(page.abs_path).stat().st_mtime_ns for page in pages]
+
+    _process_scan(scans[1].id, exam.layout)
+    assert scans[1].message == "Processed 2 pages. Skipped 2 duplicate pages."
+
+    assert Page.query.count() == len(pages)
+    assert [Path(page.abs_path).stat().st_mtime_ns for page in pages] == modified
+
+    # The copies of the skipped pages are part of the new scan as well
+    assert set(scans[1].copies) == set(scans[0].copies) == {page.copy for page in pages}
+
+
 def test_reupload_page(app_with_data, zip_file):
     app, exam, students = app_with_data
     student = students[0]
@@ -103,3 +262,38 @@ def test_reupload_page(app_with_data, zip_file):
     assert page.path != file_name
     assert not old_path.exists()
     assert Path(page.abs_path).exists()
+
+
+def test_reupload_replaced_page(app_with_data):
+    app, exam, students = app_with_data
+
+    def upload(color):
+        scan = Scan(exam=exam, name="test.zip", status="processing")
+        db.session.add(scan)
+        db.session.commit()
+
+        with BytesIO() as image_bytes, zipfile.ZipFile(str(scan.path), "w") as z:
+            Image.new("RGB", (10, 10), color).save(image_bytes, format="PNG")
+            z.writestr("1000000-1.png", image_bytes.getvalue())
+
+        _process_scan(scan.id, exam.layout)
+        return scan
+
+    upload("black")
+    upload("white")
+    # The page was replaced since the first upload, so it is not a duplicate anymore
+    scan = upload("black")
+
+    assert scan.message == "Processed 1 pages."
+    page = Page.query.one()
+    assert Image.open(page.abs_path).getpixel((0, 0)) == (0, 0, 0)
+
+    # Nor is it after the submission is deleted
+    db.session.delete(page)
+    db.session.delete(page.copy)
+    db.session.delete(page.copy.submission)
+    db.session.commit()
+
+    scan = upload("black")
+    assert scan.message == "Processed 1 pages."
+    assert Page.query.count() == 1
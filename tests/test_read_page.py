@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+import pytest
+
+from zesje.images import get_box, read_page
+
+
+@pytest.fixture
+def page_image():
+    # A noisy A4 page at 200 DPI, such that any misplaced pixel is detected
+    rng = np.random.default_rng(0)
+    return cv2.GaussianBlur(rng.integers(0, 256, (2339, 1654, 3), dtype=np.uint8), (9, 9), 3)
+
+
+@pytest.mark.parametrize("extension", ["jpg", "png"])
+@pytest.mark.parametrize(
+    "box",
+    [[0.5, 2, 1, 4], [5, 6.5, 3, 8], [10, 11.7, 0, 8.3], [-1, 13, -1, 10]],
+    ids=["top", "middle", "bottom", "outside"],
+)
+def test_read_page_box(tmp_path, page_image, extension, box):
+    path = str(tmp_path / f"page.{extension}")
+    cv2.imwrite(path, page_image)
+
+    image, dpi, (y0, x0) = read_page(path, np.array(box, dtype=float), padding=0.3)
+
+    page = cv2.imread(path)
+    expected = get_box(page, np.array(box, dtype=float), padding=0.3)
+    assert dpi == 200
+    assert np.array_equal(image, expected)
+    assert np.array_equal(page[y0 : y0 + image.shape[0], x0 : x0 + image.shape[1]], expected)
+
+
+@pytest.mark.parametrize(
+    "min_width, width, dpi", [(None, 1654, 200), (1000, 1654, 200), (800, 827, 100), (400, 414, 50)]
+)
+def test_read_page_reduced(tmp_path, page_image, min_width, width, dpi):
+    path = str(tmp_path / "page.jpg")
+    cv2.imwrite(path, page_image)
+
+    image, image_dpi, origin = read_page(path, min_width=min_width)
+
+    assert image.shape[1] == width
+    assert image_dpi == dpi
+    assert origin == (0, 0)
@@ -1,4 +1,5 @@
 import os
+from collections import OrderedDict
 
 import pytest
 import numpy as np
@@ -9,6 +10,7 @@ from pikepdf import Pdf
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from sqlalchemy import insert, event
+from sqlalchemy.exc import IntegrityError
 
 from zesje.scans import add_to_correct_copy, decode_barcode, ExamMetadata, ExtractedBarcode, exam_metadata, guess_dpi
 from zesje.image_extraction import extract_image_pikepdf, extract_images_from_pdf
@@ -18,6 +20,7 @@ from zesje.pdf_generation import exam_dir, exam_pdf_path, write_finalized_exam,
 from zesje.database import Exam, ExamWidget
 from zesje import scans
 from zesje.constants import PAGE_FORMATS
+from zesje.images import normalize_dpi
 
 
 # Returns the original image instead of retrieving a box from it
@@ -103,6 +106,38 @@ def test_decode_barcode(datadir, image_filename, token, expected, mock_get_box_r
     assert decode_barcode(image, exam_config) == (expected, False)
 
 
+def test_decode_barcode_remembers_strategy(monkeypatch, mock_get_box_return_original):
+    # Only decodes the image when it is rotated
+    attempts = []
+
+    class Decoded:
+        data = b"REMEMBER/1/2"
+
+    def mock_decode(image, **kwargs):
+        image_array = np.array(image)
+        attempts.append(image_array.shape)
+        return [Decoded()] if image_array[0, 0] == 255 else []
+
+    monkeypatch.setattr(scans.pylibdmtx, "decode", mock_decode)
+    monkeypatch.setattr(scans, "_preferred_barcode_strategy", OrderedDict())
+
+    image = np.zeros((40, 40), dtype=np.uint8)
+    image[-1, -1] = 255
+
+    exam_config = ExamMetadata(token="REMEMBER", barcode_coords=[0])
+    assert decode_barcode(image, exam_config) == (ExtractedBarcode("REMEMBER", 1, 2), True)
+    assert len(attempts) > 1
+
+    attempts.clear()
+    assert decode_barcode(image, exam_config) == (ExtractedBarcode("REMEMBER", 1, 2), True)
+    assert len(attempts) == 1
+
+    # Only the most recently used exams are remembered
+    monkeypatch.setattr(scans, "BARCODE_STRATEGY_CACHE_SIZE", 1)
+    decode_barcode(image, ExamMetadata(token="OTHER", barcode_coords=[0]))
+    assert list(scans._preferred_barcode_strategy) == ["OTHER"]
+
+
 # Noise transformations
 
 
@@ -149,6 +184,35 @@ def test_pipeline(full_app):
         assert success is True, reason
 
 
+def test_pipeline_guess_student_in_memory(full_app, monkeypatch):
+    def no_imread(*args, **kwargs):
+        raise AssertionError("The stored page should not be read back")
+
+    monkeypatch.setattr(scans.cv2, "imread", no_imread)
+
+    for image, exam_config, examdir in generate_flat_scan_data(copy_number=146):
+        assert exam_config.student_id_coords is not None
+        success, reason = scans.process_page(image, [], [], exam_config, examdir)
+        assert success is True, reason
+        assert "Student id widget" not in reason
+
+
+def test_pipeline_pool(full_app):
+    pages = [
+        (image, None, [], number, 2, exam_config, examdir)
+        for number, (image, exam_config, examdir) in enumerate(generate_flat_scan_data(), start=1)
+    ]
+    *_, exam_config, examdir = pages[0]
+
+    results = list(scans.analyse_pages_in_pool((page[:5] for page in pages), exam_config, examdir, processes=2))
+
+    assert [number for _, _, _, number, _ in results] == [1, 2]
+    for analysis, *_ in results:
+        assert isinstance(analysis, scans.PageAnalysis)
+        assert analysis.success is True, analysis.description
+        assert os.path.exists(analysis.image_path)
+
+
 @pytest.mark.parametrize(
     "threshold, expected", [(0.02, True), (0.12, True), (0.28, True)], ids=["Low noise", "Medium noise", "High noise"]
 )
@@ -227,7 +291,7 @@ def test_image_extraction_pike(datadir, filename, expected):
 def test_image_extraction(datadir, filename):
     file = os.path.join(datadir, filename)
     page = 0
-    for img, _ in extract_images_from_pdf(file, only_info=False):
+    for img, _ in extract_images_from_pdf(file):
         page += 1
         assert img is not None
         assert np.average(np.array(img)) == 255
@@ -266,6 +330,72 @@ def test_realign_image(module_app, datadir, file_name, markers):
         assert diff[1] <= epsilon
 
 
+@pytest.mark.parametrize("file_name", ["a4-rotated.png", "a4-3-markers.png", "a4-shifted-1-marker.png"])
+def test_find_corner_markers_pyramid(module_app, datadir, monkeypatch, file_name):
+    test_image = np.array(PIL.Image.open(os.path.join(datadir, "cornermarkers", file_name)).convert("RGB"))
+    # The same page at 300 DPI
+    test_image = cv2.resize(test_image, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+
+    pyramid_markers = scans.find_corner_marker_keypoints(test_image)
+
+    monkeypatch.setattr(scans, "PYRAMID_DPI", 300)
+    markers = scans.find_corner_marker_keypoints(test_image)
+
+    assert len(pyramid_markers) == len(markers) > 0
+    assert np.max(np.abs(np.subtract(pyramid_markers, markers))) <= 1
+
+
+def test_decode_barcode_pyramid(monkeypatch, mock_get_box_return_original):
+    attempts = []
+
+    class Decoded:
+        data = b"PYRAMID/1/2"
+
+    def mock_decode(image, **kwargs):
+        attempts.append(np.array(image).shape)
+        return [Decoded()] if attempts[-1] == (7016, 4961) else []
+
+    monkeypatch.setattr(scans.pylibdmtx, "decode", mock_decode)
+    monkeypatch.setattr(scans, "_preferred_barcode_strategy", OrderedDict())
+
+    # An A4 page at 600 DPI
+    image = np.full((7016, 4961), 255, dtype=np.uint8)
+
+    exam_config = ExamMetadata(token="PYRAMID", barcode_coords=[0])
+    assert decode_barcode(image, exam_config) == (ExtractedBarcode("PYRAMID", 1, 2), False)
+
+    # All strategies are tried on the image downscaled to 300 DPI before the full resolution
+    assert attempts[:2] == [(1754, 1240), (3508, 2480)]
+    assert len(attempts) == len(scans.BARCODE_STRATEGIES) + 2
+
+
+@pytest.mark.parametrize("scale, max_dpi, dpi", [(4, 300, 300), (2, 300, 300), (1, 300, 150), (4, 0, 600)])
+def test_normalize_dpi(module_app, datadir, scale, max_dpi, dpi):
+    test_image = np.array(PIL.Image.open(os.path.join(datadir, "cornermarkers", "a4-rotated.png")).convert("RGB"))
+    test_image = cv2.resize(test_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+
+    result_image = normalize_dpi(test_image, max_dpi)
+
+    assert guess_dpi(result_image) == dpi
+    assert np.allclose(result_image.shape[:2], original_page_size("A4", dpi), atol=1)
+    assert len(scans.find_corner_marker_keypoints(result_image)) == 4
+
+
+def test_realign_grayscale_image(module_app, datadir):
+    test_file = os.path.join(datadir, "cornermarkers", "a4-rotated.png")
+    test_image = np.array(PIL.Image.open(test_file).convert("RGB"))
+    gray_image = np.array(PIL.Image.open(test_file).convert("L"))
+
+    page_shape = np.array(original_page_size("A4", guess_dpi(test_image)))
+
+    result_image = scans.realign_image(gray_image, page_shape)
+    assert result_image.shape == tuple(page_shape)
+
+    assert scans.find_corner_marker_keypoints(result_image) == scans.find_corner_marker_keypoints(
+        scans.realign_image(test_image, page_shape)
+    )
+
+
 def test_incomplete_reference_realign_image(module_app, datadir):
     dir_name = "cornermarkers"
     epsilon = 1
@@ -368,3 +498,58 @@ def test_add_to_correct_copy_integrity(module_app, model):
     # Make sure the submission + copy were added by the test in case of the Copy test
     solutions = submissions[0].solutions
     assert len(solutions) == 0 if model == Copy else 1
+
+
+def test_page_batch(module_app):
+    exam = Exam(name="", token="BATCH")
+    db.session.add(exam)
+    db.session.commit()
+
+    attempts = []
+
+    def store_page(number, commit):
+        assert not commit
+        attempts.append(number)
+
+        db.session.add(Submission(exam=exam, copies=[Copy(number=number)]))
+        db.session.flush()
+
+        if number == 2 and attempts.count(2) == 1:
+            raise IntegrityError("INSERT", {}, Exception("Added by a concurrent upload"))
+        elif number == 3:
+            raise RuntimeError("Failing page")
+
+        return True, f"Stored page {number}"
+
+    batch = scans.PageBatch(max_pages=2, max_seconds=60)
+
+    assert batch.store(store_page, 1) == (True, "Stored page 1")
+    assert not batch.commit_if_due()
+
+    # The batch is committed before the page is tried again
+    assert batch.store(store_page, 2) == (True, "Stored page 2")
+    assert attempts == [1, 2, 2]
+    assert batch.pages == 1
+
+    # A failing page does not affect the others
+    with pytest.raises(RuntimeError):
+        batch.store(store_page, 3)
+    assert batch.store(store_page, 4) == (True, "Stored page 4")
+    assert batch.commit_if_due()
+
+    assert sorted(copy.number for copy in exam.copies) == [1, 2, 4]
+
+
+def test_page_batch_conflicting_page(module_app):
+    attempts = []
+
+    def store_page(commit):
+        attempts.append(commit)
+        raise IntegrityError("INSERT", {}, Exception("Conflicts every time"))
+
+    batch = scans.PageBatch(max_pages=2, max_seconds=60)
+
+    with pytest.raises(IntegrityError):
+        batch.store(store_page)
+    assert len(attempts) == scans.PageBatch.MAX_ATTEMPTS
+    assert batch.pages == 0
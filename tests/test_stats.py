@@ -110,6 +110,15 @@ def test_validated_submission_exist(add_test_data):
         stats.solution_data(exam_id=1, student_id=1000003)
 
 
+def test_solution_scores(add_test_data):
+    assert stats.solution_scores(exam_id=1) == {(1, 1): 5, (1, 3): 0, (2, 1): 5, (3, 1): 5}
+    assert stats.solution_scores(exam_id=1, submission_id=2) == {(2, 1): 5}
+
+    for solution in Solution.query.all():
+        score = stats.solution_scores(exam_id=1).get((solution.submission_id, solution.problem_id), np.nan)
+        assert score == solution.score or np.isnan(score) and np.isnan(solution.score)
+
+
 def test_solution_data(add_test_data):
     student, results = stats.solution_data(exam_id=1, student_id=1000001)
 
@@ -139,6 +148,17 @@ def test_full_exam_data(add_test_data):
     # 11 columns = 3 problems * (1 total + 1 remarks) + 1 fbp1 + 1 fbp3 + total + 2 name
     assert data.shape == (2, 11)
 
+    assert list(data.index) == [1000001, 1000002]
+    assert list(data[("Problem", "total")]) == [5, 5]
+    assert list(data[("Extra Space", "blank")].isna()) == [False, True]
+    assert data.loc[1000001, ("Extra Space", "blank")] == 0
+    assert list(data[("Empty Problem", "total")].isna()) == [True, True]
+    assert list(data[("total", "total")]) == [5, 5]
+
+    # Feedback of solutions without a grader is not exported, but it is counted in the total
+    assert data.loc[1000001, ("Problem", "text")] == 5
+    assert data[("Problem", "text")].isna()[1000002]
+
 
 # Tests whether the statistics return the correct avg and total time per problem.
 # This is done with two test data, one with equal elapsed times and the other with
@@ -8,6 +8,7 @@ from werkzeug.exceptions import HTTPException
 from .graders import Graders
 from .exams import Exams, ExamSource, ExamGeneratedPdfs, ExamPreview
 from .scans import Scans
+from .pregrade import Pregrade
 from .students import Students
 from .copies import Copies, MissingPages
 from .submissions import Submissions
@@ -83,6 +84,7 @@ add_url_rules(api_bp, ExamSource, "/exams/<int:exam>/source_pdf", name="exam_sou
 add_url_rules(api_bp, ExamGeneratedPdfs, "/exams/<int:exam>/generated_pdfs", name="exam_generated_pdfs")
 add_url_rules(api_bp, ExamPreview, "/exams/<int:exam>/preview", name="exam_preview")
 add_url_rules(api_bp, Scans, "/scans/<int:exam>")
+add_url_rules(api_bp, Pregrade, "/pregrade/<int:exam>", "/pregrade/<int:exam>/<string:task_id>")
 add_url_rules(api_bp, Students, "/students", "/students/<int:student>")
 add_url_rules(api_bp, Copies, "/copies/<int:exam>", "/copies/<int:exam>/<int:copy_number>")
 add_url_rules(api_bp, MissingPages, "/copies/missing_pages/<int:exam>", name="missing_pages")
@@ -115,6 +117,11 @@ api_bp.add_url_rule(
     "solution_image",
     images.get,
 )
+api_bp.add_url_rule(
+    "/images/solutions/<int:exam>/<int:problem>",
+    "solution_images",
+    images.get_batch,
+)
 
 # Exports
 api_bp.add_url_rule(
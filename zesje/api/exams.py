@@ -15,6 +15,7 @@ from ..pdf_generation import exam_dir, exam_pdf_path, _exam_generate_data
 from ..pdf_generation import generate_pdfs, generate_single_pdf, generate_zipped_pdfs
 from ..pdf_generation import page_is_size, save_with_even_pages
 from ..pdf_generation import write_finalized_exam
+from ..blanks import schedule_reference_images
 from ..database import db, Exam, ExamWidget, Submission, FeedbackOption, token_length, ExamLayout
 from .submissions import sub_to_data
 from .students import student_to_data
@@ -140,6 +141,7 @@ class Exams(MethodView):
             ],
             "finalized": exam.finalized,
             "gradeAnonymous": exam.grade_anonymous,
+            "grayscale": exam.grayscale,
             "layout": exam.layout.name,
         }
 
@@ -270,10 +272,11 @@ class Exams(MethodView):
         {
             "finalized": fields.Bool(required=False, load_default=None),
             "grade_anonymous": fields.Bool(required=False, load_default=None),
+            "grayscale": fields.Bool(required=False, load_default=None),
         },
         location="json",
     )
-    def put(self, exam, finalized, grade_anonymous):
+    def put(self, exam, finalized, grade_anonymous, grayscale):
         if finalized is not None:
             if not finalized:
                 return dict(status=409, message="Exam can not be unfinalized"), 409
@@ -285,6 +288,11 @@ class Exams(MethodView):
 
             exam.finalized = True
             db.session.commit()
+
+            if exam.layout == ExamLayout.templated:
+                # Rendered ahead of the first scan, only once the exam is finalized
+                schedule_reference_images(exam.id)
+
             return dict(status=200, message="ok"), 200
 
         if grade_anonymous is not None:
@@ -293,7 +301,13 @@ class Exams(MethodView):
             db.session.commit()
             return dict(status=200, message="ok", changed=changed), 200
 
-        return dict(status=400, message="One of finalized or anonymous must be present"), 400
+        if grayscale is not None:
+            changed = exam.grayscale != grayscale
+            exam.grayscale = grayscale
+            db.session.commit()
+            return dict(status=200, message="ok", changed=changed), 200
+
+        return dict(status=400, message="One of finalized, anonymous or grayscale must be present"), 400
 
     @use_kwargs({"exam": DBModel(Exam, required=True)})
     @use_kwargs({"name": fields.Str(required=True, validate=non_empty_string)}, location="json")
@@ -5,7 +5,7 @@ from sqlalchemy import func
 import numpy as np
 
 from ._helpers import DBModel, ApiError, non_empty_string, use_args, use_kwargs
-from ..database import db, Problem, FeedbackOption, Solution, solution_feedback
+from ..database import db, Problem, FeedbackOption, Solution, solution_feedback, bump_grading_version
 
 
 def feedback_to_data(feedback, full_children=True):
@@ -112,6 +112,7 @@ class Feedback(MethodView):
                         .filter(Solution.id.in_(invalid_solutions))
                         .update({Solution.grader_id: None, Solution.graded_at: None}, synchronize_session="fetch")
                     )
+                    bump_grading_version(db.session.connection(), [feedback.problem_id])
 
                     if len(invalid_solutions) != set_aside_solutions:
                         return (
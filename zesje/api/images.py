@@ -1,15 +1,21 @@
-from flask import Response, current_app, request
-from webargs import fields
+import hashlib
+import os
+import secrets
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from flask import Response, current_app, request, stream_with_context, url_for
+from webargs import fields, validate
 from pathlib import Path
-from werkzeug.http import parse_date, http_date
-from datetime import datetime
 
 import cv2
 import numpy as np
 
 from ._helpers import DBModel, use_kwargs, ApiError
-from ..images import get_box, guess_dpi, widget_area
-from ..database import Exam, Submission, Problem, Page, Solution, Copy, ExamLayout
+from .. import image_cache
+from ..constants import MAX_BATCH_IMAGES
+from ..images import read_page, widget_area
+from ..database import db, Exam, Submission, Problem, Page, Solution, Copy, ExamLayout, solution_feedback
 from ..scans import exam_student_id_widget
 
 
@@ -40,6 +46,186 @@ def get(exam, problem, submission, full_page):
     -------
     Image (JPEG mimetype)
     """
+    if problem.exam_id != exam.id:
+        return dict(status=404, message="Problem does not belong to this exam."), 404
+    if submission.exam_id != exam.id:
+        return dict(status=404, message="Submission does not belong to this exam."), 404
+
+    image = _solution_image(exam, problem, submission, full_page)
+
+    # The image only changes if any of its inputs changes, such that this is a strong validator
+    etag = _solution_image_key(image)
+    if request.if_none_match.contains(etag):
+        # Send 304 Not Modified with empty body
+        return Response(status=304, headers={"ETag": f'"{etag}"', "Cache-Control": "no-cache"})
+
+    image_encoded = image_cache.get(etag)
+    if image_encoded is None:
+        image_encoded = _render_solution_image(image)
+        image_cache.put(etag, image_encoded)
+
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    return Response(image_encoded, 200, headers=headers, mimetype="image/jpeg")
+
+
+@use_kwargs({"exam": DBModel(Exam, required=True), "problem": DBModel(Problem, required=True)})
+@use_kwargs(
+    {"submissions": fields.List(fields.Int(), required=True, validate=validate.Length(min=1, max=MAX_BATCH_IMAGES))},
+    location="query",
+)
+def get_batch(exam, problem, submissions):
+    """get the images of a problem for multiple submissions at once.
+
+    Parameters
+    ----------
+    exam : int
+    problem_id : int
+    submissions : list of int
+        The ids of the submissions, at most `MAX_BATCH_IMAGES`.
+
+    Returns
+    -------
+    Multipart response (multipart/mixed mimetype)
+        The images as returned by `get` without `full_page`, in the order of `submissions`.
+        Each JPEG part has the URL of the single image as Content-Location and its ETag.
+        The images of submissions that are not available or not of `exam` are left out.
+    """
+    if problem.exam_id != exam.id:
+        return dict(status=404, message="Problem does not belong to this exam."), 404
+
+    images = _solution_images(exam, problem, submissions)
+    urls = [
+        url_for(".solution_image", exam=exam.id, problem=problem.id, submission=submission_id, full_page=0)
+        for submission_id in images
+    ]
+    boundary = secrets.token_hex(16)
+
+    # The images are decoded and encoded in parallel, but sent in order
+    rendered = _render_executor.map(partial(_cached_solution_image, current_app._get_current_object()), images.values())
+
+    def generator():
+        for url, (etag, image_encoded) in zip(urls, rendered):
+            if image_encoded is None:
+                continue
+            headers = f'Content-Type: image/jpeg\r\nContent-Location: {url}\r\nETag: "{etag}"\r\n'
+            yield f"--{boundary}\r\n{headers}\r\n".encode() + image_encoded + b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    return Response(stream_with_context(generator()), content_type=f"multipart/mixed; boundary={boundary}")
+
+
+def prefetch_solution_images(exam, problem, submission_ids, grader_id=None):
+    """Render and cache the images of solutions in the background
+
+    Prefetching is best effort: the images are rendered by a thread of the web
+    server process, and prefetching that did not finish yet is lost when the process
+    stops. Any prefetching for the same grader that did not finish yet is stopped,
+    and nothing is prefetched when the image cache is disabled.
+
+    The database is only accessed here, such that the background thread only
+    renders the images that are not cached yet.
+
+    Parameters
+    ----------
+    exam : Exam
+    problem : Problem
+    submission_ids : list of int
+        The submissions to render the solution of `problem` for, in the order to render them.
+    grader_id : int, optional
+        The grader the images are prefetched for.
+    """
+    job = object()
+    _latest_prefetch[grader_id] = job
+
+    if not current_app.config["IMAGE_CACHE_SIZE"]:
+        # The rendered images would not be kept
+        return
+
+    try:
+        images = list(_solution_images(exam, problem, submission_ids).values())
+    except Exception:
+        # Prefetching is best effort, any error is reported when the image is requested
+        return
+
+    if images:
+        _prefetch_executor.submit(_prefetch, current_app._get_current_object(), images, grader_id, job)
+
+
+# A single thread per process, such that prefetching never competes with more than one request
+_prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+
+# The last prefetching job of each grader, earlier jobs are superseded by it
+_latest_prefetch = {}
+
+
+def _prefetch(app, images, grader_id, job):
+    with app.app_context():
+        for image in images:
+            if _latest_prefetch.get(grader_id) is not job:
+                # The grader moved on, so the remaining images are not needed soon
+                return
+            try:
+                key = _solution_image_key(image)
+                if not image_cache.contains(key):
+                    image_cache.put(key, _render_solution_image(image))
+            except Exception:
+                app.logger.debug("Prefetching a solution image failed", exc_info=True)
+
+
+# Decoding and encoding images releases the GIL, such that the images of a batch are rendered in parallel
+_render_executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="render")
+
+
+def _cached_solution_image(app, image):
+    """Get the encoded image of a solution from the cache, or render it
+
+    Returns
+    -------
+    key : str or None
+        The ETag of the image.
+    image_encoded : bytes or None
+        The JPEG encoded image, or None if rendering failed.
+    """
+    with app.app_context():
+        try:
+            key = _solution_image_key(image)
+            image_encoded = image_cache.get(key)
+            if image_encoded is None:
+                image_encoded = _render_solution_image(image)
+                image_cache.put(key, image_encoded)
+        except Exception:
+            app.logger.exception("Rendering a solution image failed")
+            return None, None
+
+    return key, image_encoded
+
+
+SolutionImage = namedtuple("SolutionImage", ["page_paths", "widget_area_in", "student_id_coords", "highlighted"])
+
+
+def _solution_image(exam, problem, submission, full_page):
+    """Collect everything the image of a solution is rendered from
+
+    Parameters
+    ----------
+    See `get`.
+
+    Returns
+    -------
+    image : SolutionImage
+        page_paths : list of str
+            The paths of the pages to stitch together, relative to the data directory.
+        widget_area_in : numpy array or None
+            The area of the problem in inches to crop the pages to, or None to return full pages.
+        student_id_coords : list of int or None
+            The coordinates of the student id widget to grey out in points, see `exam_student_id_widget`.
+        highlighted : list of (int, int)
+            The top left coordinates in points of the multiple choice checkboxes to highlight.
+
+    Raises
+    ------
+    ApiError if all pages are missing.
+    """
     pages = None
     if exam.layout == ExamLayout.unstructured:
         full_page = True
@@ -65,51 +251,162 @@ def get(exam, problem, submission, full_page):
     if len(pages) == 0:
         raise ApiError(f"Page #{page_number} is missing for all copies of submission #{submission.id}.", 404)
 
-    # Convert to int to match the time resolution of HTTP headers (seconds)
-    last_modified = int(max(Path(page.abs_path).stat().st_mtime for page in pages))
-
-    if modified_since := request.headers.get("If-Modified-Since"):
-        modified_since = parse_date(modified_since).timestamp()
-        if last_modified == modified_since:
-            # Send 304 Not Modified with empty body
-            return "", 304
-
     solution = Solution.query.filter(Solution.submission_id == submission.id, Solution.problem_id == problem.id).one()
 
     if exam.layout == ExamLayout.templated and exam.grade_anonymous and page_number == 0:
-        student_id_widget, coords = exam_student_id_widget(exam.id)
+        _, student_id_coords = exam_student_id_widget(exam.id)
     else:
-        student_id_widget = None
+        student_id_coords = None
 
-    raw_images = []
+    # pregrade highlighting
+    highlighted = _highlighted_options(problem, {feedback.id for feedback in solution.feedback})
+
+    # TODO: use points as base unit
+    widget_area_in = None if full_page else widget_area(problem)
+
+    return SolutionImage([page.path for page in pages], widget_area_in, student_id_coords, highlighted)
+
+
+def _solution_images(exam, problem, submission_ids):
+    """Collect everything the images of the solutions of a problem are rendered from
+
+    Unlike `_solution_image`, the pages and feedback of all submissions are queried at once.
+
+    Parameters
+    ----------
+    exam : Exam
+    problem : Problem
+    submission_ids : list of int
+
+    Returns
+    -------
+    images : dict of int to SolutionImage
+        The images without `full_page` by submission id, in the order of `submission_ids`.
+        Submissions of other exams or of which all pages are missing are left out.
+    """
+    if exam.layout == ExamLayout.unstructured:
+        # Full pages are shown, of which the number differs per submission
+        images = {}
+        for submission in Submission.query.filter(
+            Submission.id.in_(submission_ids), Submission.exam_id == exam.id
+        ).all():
+            try:
+                images[submission.id] = _solution_image(exam, problem, submission, full_page=True)
+            except ApiError:
+                continue
+        return {submission_id: images[submission_id] for submission_id in submission_ids if submission_id in images}
+
+    page_number = problem.widget.page
+
+    page_paths = defaultdict(list)
+    for submission_id, path in (
+        db.session.query(Copy.submission_id, Page.path)
+        .join(Submission, Submission.id == Copy.submission_id)
+        .filter(
+            Page.copy_id == Copy.id,
+            Copy.submission_id.in_(submission_ids),
+            Submission.exam_id == exam.id,
+            Page.number == page_number,
+        )
+        .order_by(Copy.number)
+    ):
+        page_paths[submission_id].append(path)
+
+    feedback_ids = defaultdict(set)
+    for submission_id, feedback_id in (
+        db.session.query(Solution.submission_id, solution_feedback.c.feedback_option_id)
+        .join(solution_feedback, solution_feedback.c.solution_id == Solution.id)
+        .filter(Solution.problem_id == problem.id, Solution.submission_id.in_(submission_ids))
+    ):
+        feedback_ids[submission_id].add(feedback_id)
+
+    if exam.layout == ExamLayout.templated and exam.grade_anonymous and page_number == 0:
+        _, student_id_coords = exam_student_id_widget(exam.id)
+    else:
+        student_id_coords = None
 
     # TODO: use points as base unit
     widget_area_in = widget_area(problem)
 
-    for page in pages:
-        page_path = page.abs_path
-        page_im = cv2.imread(page_path)
-        dpi = guess_dpi(page_im)
+    return {
+        submission_id: SolutionImage(
+            page_paths[submission_id],
+            widget_area_in,
+            student_id_coords,
+            _highlighted_options(problem, feedback_ids[submission_id]),
+        )
+        for submission_id in submission_ids
+        if page_paths[submission_id]
+    }
+
+
+def _highlighted_options(problem, feedback_ids):
+    """The top left coordinates of the multiple choice checkboxes of the given feedback"""
+    return [(option.x, option.y) for option in problem.mc_options if option.feedback_id in feedback_ids]
+
+
+def _solution_image_key(image):
+    """A key that identifies a solution image by everything it is rendered from
 
-        if student_id_widget:
+    Parameters
+    ----------
+    image : SolutionImage
+        The image changes if any of its fields changes or any of its page files is modified.
+
+    Returns
+    -------
+    key : str
+    """
+    files = [(path, *_file_version(_abs_path(path))) for path in image.page_paths]
+    config = [current_app.config[key] for key in ("CHECKBOX_SIZE", "MAX_WIDTH", "MAX_HEIGHT")]
+    area = None if image.widget_area_in is None else [float(coord) for coord in image.widget_area_in]
+
+    data = repr((files, area, image.student_id_coords, sorted(image.highlighted), config))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _abs_path(path):
+    return os.path.join(current_app.config["DATA_DIRECTORY"], path)
+
+
+def _file_version(path):
+    stat = Path(path).stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _render_solution_image(image):
+    """Render the image of a solution
+
+    Parameters
+    ----------
+    image : SolutionImage
+
+    Returns
+    -------
+    image_encoded : bytes
+        The JPEG encoded image.
+    """
+    raw_images = []
+    # Full pages are only downscaled if multiple pages are stitched together
+    min_width = current_app.config["MAX_WIDTH"] if len(image.page_paths) > 1 else None
+
+    for page_path in image.page_paths:
+        # Only the widget area is decoded, so everything is drawn relative to its origin
+        raw_image, dpi, (y0, x0) = read_page(
+            _abs_path(page_path), image.widget_area_in, padding=0.3, min_width=min_width
+        )
+
+        if image.student_id_coords:
             # coords are [ymin, ymax, xmin, xmax]
-            page_im = _grey_out_student_widget(page_im, coords, dpi)
-
-        # pregrade highlighting
-        fb = list(map(lambda x: x.id, solution.feedback))
-        for option in problem.mc_options:
-            if option.feedback_id in fb:
-                x = int(option.x / 72 * dpi)
-                y = int(option.y / 72 * dpi)
-                box_length = int(current_app.config["CHECKBOX_SIZE"] / 72 * dpi)
-                x1 = x + box_length
-                y1 = y + box_length
-                page_im = cv2.rectangle(page_im, (x, y), (x1, y1), (0, 255, 0), 3)
-
-        if not full_page:
-            raw_image = get_box(page_im, widget_area_in, padding=0.3)
-        else:
-            raw_image = page_im
+            raw_image = _grey_out_student_widget(raw_image, image.student_id_coords, dpi, origin=(y0, x0))
+
+        for option_x, option_y in image.highlighted:
+            x = int(option_x / 72 * dpi) - x0
+            y = int(option_y / 72 * dpi) - y0
+            box_length = int(current_app.config["CHECKBOX_SIZE"] / 72 * dpi)
+            x1 = x + box_length
+            y1 = y + box_length
+            raw_image = cv2.rectangle(raw_image, (x, y), (x1, y1), (0, 255, 0), 3)
 
         raw_images.append(raw_image)
 
@@ -135,23 +432,21 @@ def get(exam, problem, submission, full_page):
 
         stitched_image = np.concatenate(tuple(resized_images), axis=0)
 
-    image_encoded = cv2.imencode(".jpg", stitched_image)[1].tostring()
-
-    headers = {"Last-Modified": http_date(datetime.fromtimestamp(last_modified)), "Cache-Control": "no-cache"}
-    return Response(image_encoded, 200, headers=headers, mimetype="image/jpeg")
+    return cv2.imencode(".jpg", stitched_image)[1].tobytes()
 
 
-def _grey_out_student_widget(page_im, coords, dpi):
+def _grey_out_student_widget(page_im, coords, dpi, origin=(0, 0)):
     """
     Grey out the student id widget on a page.
     Doesn't grey out the bottom left empty part of the widget,
     in case some exam material is there.
 
+    :param origin: the (y, x) position of the image on the page in pixels
     :returns the page image with the widget greyed out
 
     """
     grey = (150, 150, 150)
-    ymin, ymax, xmin, xmax = (np.array(coords) / 72 * dpi).astype(int)
+    ymin, ymax, xmin, xmax = (np.array(coords) / 72 * dpi).astype(int) - np.repeat(origin, 2)
     height, width = ymax - ymin, xmax - xmin
 
     xmiddle = int(xmin + 0.5 * width)
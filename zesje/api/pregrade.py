@@ -0,0 +1,88 @@
+from flask.views import MethodView
+from webargs import fields
+
+from ._helpers import DBModel, ApiError, ExamNotFinalizedError, use_kwargs, ERROR_CODE_CONFLICT, ERROR_CODE_NOT_FOUND
+from ..scans import repregrade_exam
+from ..database import Exam, ExamLayout
+
+
+def _is_templated(exam):
+    if exam.layout != ExamLayout.templated:
+        return ApiError("Only templated exams can be pregraded", ERROR_CODE_CONFLICT)
+
+
+class Pregrade(MethodView):
+    """Running the pregrading again on the stored pages of an exam."""
+
+    @use_kwargs(
+        {
+            "exam": DBModel(
+                Exam,
+                required=True,
+                validate_model=[lambda exam: exam.finalized or ExamNotFinalizedError, _is_templated],
+            )
+        }
+    )
+    @use_kwargs({"problems": fields.List(fields.Int(), required=False, load_default=None)}, location="json")
+    def post(self, exam, problems):
+        """Start pregrading the stored pages of an exam in the background
+
+        Solutions that are graded by a human are left untouched.
+
+        Parameters
+        ----------
+        exam_id : int
+        problems : list of int, optional
+            The ids of the problems to pregrade, defaults to all problems.
+
+        Returns
+        -------
+        task_id : str
+            The id to request the progress with.
+        status : str
+        """
+        if problems is not None:
+            unknown = set(problems) - {problem.id for problem in exam.problems}
+            if unknown:
+                raise ApiError(f"Problems {sorted(unknown)} do not belong to this exam", ERROR_CODE_NOT_FOUND)
+
+        task = repregrade_exam.delay(exam.id, problems)
+
+        return {"task_id": task.id, "status": task.state}
+
+    @use_kwargs({"exam": DBModel(Exam, required=True), "task_id": fields.Str(required=True)})
+    def get(self, exam, task_id):
+        """Get the progress of pregrading the stored pages of an exam
+
+        Parameters
+        ----------
+        exam_id : int
+        task_id : str
+
+        Returns
+        -------
+        task_id : str
+            The id of a task started for this exam, otherwise 404 is returned once the task started.
+        status : str
+            One of PENDING, PROGRESS, SUCCESS or FAILURE.
+        done : int or None
+            The amount of pages that are pregraded.
+        total : int or None
+            The amount of pages to pregrade.
+        failed : int or None
+            The amount of pages that could not be pregraded.
+        """
+        result = repregrade_exam.AsyncResult(task_id)
+        progress = result.info if isinstance(result.info, dict) else {}
+
+        # Tasks that did not start yet have no progress, and are indistinguishable from unknown tasks
+        if progress and progress.get("exam_id") != exam.id:
+            raise ApiError(f"Task {task_id} does not belong to this exam", ERROR_CODE_NOT_FOUND)
+
+        return {
+            "task_id": task_id,
+            "status": result.state,
+            "done": progress.get("done"),
+            "total": progress.get("total"),
+            "failed": progress.get("failed"),
+        }
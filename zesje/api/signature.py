@@ -5,7 +5,7 @@ import numpy as np
 import cv2
 
 from ._helpers import DBModel, ApiError, use_kwargs
-from ..images import get_box
+from ..images import read_page
 from ..database import Exam, Copy, ExamLayout
 from ..scans import exam_student_id_widget
 
@@ -53,8 +53,7 @@ def get(exam, copy_number):
     except StopIteration:
         raise ApiError(f"First page is missing for the copy #{copy_number}", 404)
 
-    first_page_im = cv2.imread(first_page_path)
-
-    raw_image = get_box(first_page_im, widget_area_in, padding=0.3)
-    image_encoded = cv2.imencode(".jpg", raw_image)[1].tostring()
+    # Only the rows of the page up to the widget are decoded
+    raw_image, *_ = read_page(first_page_path, widget_area_in, padding=0.3)
+    image_encoded = cv2.imencode(".jpg", raw_image)[1].tobytes()
     return Response(image_encoded, 200, mimetype="image/jpeg")
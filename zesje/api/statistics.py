@@ -5,7 +5,7 @@ import pandas as pd
 
 from ._helpers import DBModel, use_kwargs
 from ..database import db, Exam, Submission, ExamLayout
-from ..statistics import grader_data
+from ..statistics import grader_data, solution_scores
 
 
 class Statistics(MethodView):
@@ -72,6 +72,8 @@ class Statistics(MethodView):
         if len(student_ids) == 0:
             return dict(status=404, message="There are no students with a validated copy for this exam."), 404
 
+        scores = solution_scores(exam.id)
+
         total_max_score = 0
         full_scores = pd.DataFrame(
             data={},
@@ -117,7 +119,7 @@ class Statistics(MethodView):
                     continue
 
                 student_id = sol.submission.student_id
-                mark = sol.score
+                mark = scores.get((sol.submission_id, p.id), nan)
 
                 if not isnan(mark):
                     if not (is_graded := sol.is_graded):
@@ -1,11 +1,16 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
 from hashlib import md5
+from itertools import islice
+import threading
 
-from sqlalchemy.sql import operators
+from flask import current_app
 from flask.views import MethodView
 from flask_login import current_user
 from webargs import fields, validate
 
 from ._helpers import DBModel, use_args, use_kwargs
+from .images import prefetch_solution_images
 from .solutions import solution_to_data
 from .students import student_to_data
 from ..database import db, Exam, Submission, Problem, Solution, solution_feedback
@@ -55,16 +60,96 @@ def has_all_required_feedback(sol, required_feedback, excluded_feedback):
     return (required_feedback <= feedback_ids) and (not excluded_feedback & feedback_ids)
 
 
-_DIRECTION_OPERATORS = {
-    "next": (min, operators.gt, operators.lt),
-    "prev": (max, operators.lt, operators.gt),
-    "first": (min, operators.lt, operators.gt),
-    "last": (max, operators.gt, operators.lt),
-}
+NavigationIndex = namedtuple("NavigationIndex", ["version", "keys", "submission_ids", "grader_ids", "feedback"])
+NavigationIndex.__doc__ = """The solutions of a problem in the order of a shuffle seed.
+
+All attributes except for `version` are sorted by the shuffled order of the submissions.
+
+Attributes
+----------
+version : int
+    The grading version of the problem when the index was made.
+keys : list of bytes
+    The keys that determine the shuffled order.
+submission_ids : list of int
+grader_ids : list of int or None
+feedback : list of frozenset of int
+    The feedback option ids of each solution.
+"""
+
+_navigation_cache = OrderedDict()
+_navigation_cache_lock = threading.Lock()
+_NAVIGATION_CACHE_SIZE = 128
+
+
+def _shuffle_key(sub_id, shuffle_seed):
+    return md5(b"%i %i" % (sub_id, shuffle_seed)).digest()
+
+
+def navigation_index(problem_id, shuffle_seed):
+    """Get the solutions of a problem in shuffled order for navigating through the submissions.
+
+    The index is cached per problem and shuffle seed, and made again when the
+    grading version of the problem changed.
+
+    Parameters
+    ----------
+    problem_id : int
+    shuffle_seed : int
+
+    Returns
+    -------
+    index : NavigationIndex
+    """
+    version = db.session.query(Problem.grading_version).filter(Problem.id == problem_id).scalar()
+
+    with _navigation_cache_lock:
+        index = _navigation_cache.get((problem_id, shuffle_seed))
+        if index is not None and index.version == version:
+            _navigation_cache.move_to_end((problem_id, shuffle_seed))
+            return index
+
+    solutions = {}
+    for sub_id, grader_id, feedback_id in (
+        db.session.query(Solution.submission_id, Solution.grader_id, solution_feedback.c.feedback_option_id)
+        .outerjoin(solution_feedback, solution_feedback.c.solution_id == Solution.id)
+        .filter(Solution.problem_id == problem_id)
+    ):
+        _, feedback = solutions.setdefault(sub_id, (grader_id, set()))
+        if feedback_id is not None:
+            feedback.add(feedback_id)
+
+    entries = sorted(
+        (_shuffle_key(sub_id, shuffle_seed), sub_id, grader_id, frozenset(feedback))
+        for sub_id, (grader_id, feedback) in solutions.items()
+    )
+    index = NavigationIndex(
+        version,
+        keys=[key for key, *_ in entries],
+        submission_ids=[sub_id for _, sub_id, *_ in entries],
+        grader_ids=[grader_id for *_, grader_id, _ in entries],
+        feedback=[feedback for *_, feedback in entries],
+    )
+
+    with _navigation_cache_lock:
+        _navigation_cache[(problem_id, shuffle_seed)] = index
+        _navigation_cache.move_to_end((problem_id, shuffle_seed))
+        while len(_navigation_cache) > _NAVIGATION_CACHE_SIZE:
+            _navigation_cache.popitem(last=False)
+
+    return index
 
 
 def _find_submission(
-    old_submission, problem_id, shuffle_seed, direction, ungraded, required_feedback, excluded_feedback, graded_by
+    old_submission,
+    problem_id,
+    shuffle_seed,
+    direction,
+    ungraded,
+    required_feedback,
+    excluded_feedback,
+    graded_by,
+    matches=None,
 ):
     """
     Finds a submission based on the parameters of the function.
@@ -90,45 +175,92 @@ def _find_submission(
         the feedback_id's which the found submission should not have
     graded_by : int
         the id of the grader that should have graded that submission, optional
+    matches : list of (key, submission_id), optional
+        the result of `_matching_submissions` for these parameters, queried if not given.
 
     Returns
     -------
     A new submission, or the old one if no submission matching the criteria is found.
     """
+    if matches is None:
+        matches = _matching_submissions(
+            problem_id, shuffle_seed, ungraded, required_feedback, excluded_feedback, graded_by
+        )
+    old_key = _shuffle_key(old_submission.id, shuffle_seed)
 
-    def key(sub_id):
-        return md5(b"%i %i" % (sub_id, shuffle_seed)).digest()
+    # The matches before and after the old submission
+    n_before = bisect_left(matches, (old_key,))
+    n_after = len(matches) - bisect_right(matches, (old_key, float("inf")))
+    match_current = n_before + n_after < len(matches)
 
-    old_key = key(old_submission.id)
-    next_, follows, precedes = _DIRECTION_OPERATORS[direction]
+    if direction in ("next", "last"):
+        count_follows, count_precedes = n_after, n_before
+        candidates = matches[len(matches) - n_after :]
+        position = 0 if direction == "next" else -1
+    else:
+        count_follows, count_precedes = n_before, n_after
+        candidates = matches[:n_before]
+        position = -1 if direction == "prev" else 0
+
+    sub = candidates[position][1] if candidates else None
+
+    new_submission = Submission.query.get(sub) if sub else old_submission
+    return new_submission, count_follows, count_precedes, match_current
+
+
+def _matching_submissions(problem_id, shuffle_seed, ungraded, required_feedback, excluded_feedback, graded_by):
+    """The submissions whose solution matches the filters, in shuffled order
+
+    See `_find_submission` for the parameters.
+
+    Returns
+    -------
+    matches : list of (key, submission_id)
+        The matching submissions, sorted by their shuffle key.
+    """
+    index = navigation_index(problem_id, shuffle_seed)
 
     required_feedback = set(required_feedback)
     excluded_feedback = set(excluded_feedback)
 
-    count_follows = 0
-    count_precedes = 0
-    match_current = False
-    sub = None
-
-    solutions = Solution.query.filter(
-        Solution.problem_id == problem_id,
-        (Solution.is_graded.is_(False) if ungraded else (graded_by is None) or (Solution.grader_id == graded_by)),
-    ).all()
-
-    for sol in solutions:
-        if not has_all_required_feedback(sol, required_feedback, excluded_feedback):
-            continue
-        sub_id = sol.submission_id
-        if follows(key(sub_id), old_key):
-            count_follows += 1
-            sub = sub_id if not sub else next_(sub, sub_id, key=key)
-        elif precedes(key(sub_id), old_key):
-            count_precedes += 1
-        else:
-            match_current = True
+    return [
+        (key, sub_id)
+        for key, sub_id, grader_id, feedback in zip(index.keys, index.submission_ids, index.grader_ids, index.feedback)
+        if (grader_id is None if ungraded else graded_by is None or grader_id == graded_by)
+        and required_feedback <= feedback
+        and not excluded_feedback & feedback
+    ]
 
-    new_submission = Submission.query.get(sub) if sub else old_submission
-    return new_submission, count_follows, count_precedes, match_current
+
+def _upcoming_submissions(submission, shuffle_seed, direction, count, matches):
+    """The submissions a grader is likely to open after `submission`
+
+    Parameters
+    ----------
+    submission : Submission
+        The submission the grader is at.
+    shuffle_seed : int
+    direction : str
+        The last direction the grader went in, one of 'next', 'prev', 'first' or 'last'.
+        After the first submission a grader goes to the next ones, after the last to the previous ones.
+    count : int
+        The maximum number of submissions to return.
+    matches : list of (key, submission_id)
+        The submissions that match the filters of the grader, see `_matching_submissions`.
+
+    Returns
+    -------
+    submission_ids : list of int
+        The ids of the next `count` matching submissions in the direction of the grader.
+    """
+    key = _shuffle_key(submission.id, shuffle_seed)
+
+    if direction in ("prev", "last"):
+        upcoming = reversed(matches[: bisect_left(matches, (key,))])
+    else:
+        upcoming = matches[bisect_right(matches, (key, float("inf"))) :]
+
+    return [sub_id for _, sub_id in islice(upcoming, count)]
 
 
 class Submissions(MethodView):
@@ -179,15 +311,11 @@ class Submissions(MethodView):
 
         n_graded = Solution.query.filter(Solution.problem_id == args["problem"].id, Solution.is_graded).count()
 
+        filters = (args["ungraded"], args["required_feedback"], args["excluded_feedback"], args["graded_by"])
+        matches = _matching_submissions(args["problem"].id, current_user.id, *filters)
+
         new_sub, no_of_subs_follow, no_of_subs_precede, match_current = _find_submission(
-            submission,
-            args["problem"].id,
-            current_user.id,
-            args["direction"] or "next",
-            args["ungraded"],
-            args["required_feedback"],
-            args["excluded_feedback"],
-            args["graded_by"],
+            submission, args["problem"].id, current_user.id, args["direction"] or "next", *filters, matches=matches
         )
 
         matched = no_of_subs_follow + no_of_subs_precede + match_current
@@ -213,4 +341,8 @@ class Submissions(MethodView):
             "no_prev_sub": no_prev_sub,
         }
 
+        if prefetch := current_app.config["PREFETCH_SUBMISSIONS"]:
+            upcoming = _upcoming_submissions(new_sub, current_user.id, args["direction"] or "next", prefetch, matches)
+            prefetch_solution_images(exam, args["problem"], upcoming, grader_id=current_user.id)
+
         return sub_to_data(new_sub, meta)
@@ -1,13 +1,20 @@
+import fcntl
 import numpy as np
 import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
+from . import celery
 from .image_extraction import extract_images_from_pdf
-from .images import get_box
+from .images import binarize, get_box
 from PIL import Image
 from flask import current_app
 
 
-def reference_image(exam_id, page, dpi, widget_area_in=None, padding=0):
+def reference_image(exam_id, page, dpi, widget_area_in=None, padding=0, grayscale=False):
     """Returns a reference image for a specified area
 
     The reference image is a flattened image of the
@@ -26,61 +33,273 @@ def reference_image(exam_id, page, dpi, widget_area_in=None, padding=0):
         If None, return the full page
     padding : float
         Extra padding to apply in inches
+    grayscale : bool
+        Whether to return a single-channel grayscale image instead of RGB
 
     Returns
     -------
-    image_path : string
-        Location of the image.
+    reference : numpy array
+        The (read-only) reference image.
     """
 
-    app_config = current_app.config
-    data_directory = app_config["DATA_DIRECTORY"]
-    generated_path = os.path.join(data_directory, f"{exam_id}_data", "blanks", f"{dpi}")
+    data_directory = current_app.config["DATA_DIRECTORY"]
+    image_path = _reference_image_path(data_directory, exam_id, page, dpi)
+
+    blank_img_array = _load_reference_image(data_directory, exam_id, page, dpi, image_path, grayscale)
+
+    if widget_area_in is not None:
+        return get_box(blank_img_array, widget_area_in, padding=padding)
+    else:
+        return blank_img_array
+
+
+def reference_mask(exam_id, page, dpi, binary_threshold, kernel_size=None, grayscale=False):
+    """Returns a binarized reference image of a full page
+
+    The mask is computed once per page and parameters and shared through the
+    same cache as the reference images, such that the pregrading of every
+    scanned page does not need to binarize the reference again.
+
+    Parameters
+    ----------
+    exam_id : int
+        The id of the exam to use
+    page : int
+        The page number to get the reference mask for
+    dpi : int
+        The desired DPI of the mask
+    binary_threshold : int, between 0 and 255
+        The value used to convert the grayscale image to binary
+    kernel_size : int, optional
+        The diameter in pixels of the kernel that is used to thicken the lines,
+        see `images.binarize`. If None, the lines are not thickened.
+    grayscale : bool
+        Whether the mask is derived from the grayscale reference image
+
+    Returns
+    -------
+    mask : numpy array
+        The (read-only) binary image, with the same shape as the reference image.
+    """
+    data_directory = current_app.config["DATA_DIRECTORY"]
+    image_path = _reference_image_path(data_directory, exam_id, page, dpi)
+
+    key = (data_directory, exam_id, page, dpi, grayscale, binary_threshold, kernel_size)
+    mtime = os.stat(image_path).st_mtime_ns
+
+    mask = _cache_get(key, mtime)
+    if mask is None:
+        reference = _load_reference_image(data_directory, exam_id, page, dpi, image_path, grayscale)
+        mask = binarize(reference, binary_threshold, kernel_size)
+        mask.flags.writeable = False
+        _cache_put(key, mtime, mask)
+
+    return mask
 
-    if not os.path.exists(generated_path):
-        _extract_reference_images(dpi, exam_id)
 
+def _reference_image_path(data_directory, exam_id, page, dpi):
+    """The path of a reference image, which is rendered if it does not exist yet"""
+    generated_path = os.path.join(data_directory, f"{exam_id}_data", "blanks", f"{dpi}")
     image_path = os.path.join(generated_path, f"page{page:02d}.jpg")
+
     if not os.path.exists(image_path):
+        _extract_reference_images(dpi, exam_id, image_path)
+
+    return image_path
+
+
+# Decoded reference images and masks, indexed by (data_directory, exam_id, page, dpi, grayscale, ...)
+_reference_cache = OrderedDict()
+_reference_cache_lock = threading.Lock()
+
+
+def _cache_get(key, mtime):
+    """Get an array from the reference cache if it is not older than `mtime`"""
+    with _reference_cache_lock:
+        cached = _reference_cache.get(key)
+        if cached is not None and cached[0] == mtime:
+            _reference_cache.move_to_end(key)
+            return cached[1]
+
+
+def _cache_put(key, mtime, array):
+    """Store an array in the reference cache, evicting the least recently used arrays
+
+    The cache is bounded by ``REFERENCE_CACHE_SIZE`` in megabytes.
+    """
+    max_size = current_app.config["REFERENCE_CACHE_SIZE"] * 1024**2
+
+    with _reference_cache_lock:
+        _reference_cache[key] = (mtime, array)
+        _reference_cache.move_to_end(key)
+
+        cache_size = sum(cached.nbytes for _, cached in _reference_cache.values())
+        while cache_size > max_size and _reference_cache:
+            _, (_, evicted) = _reference_cache.popitem(last=False)
+            cache_size -= evicted.nbytes
+
+
+def _load_reference_image(data_directory, exam_id, page, dpi, image_path, grayscale=False):
+    """Load a reference image, using a least recently used cache
+
+    The cache is bounded by ``REFERENCE_CACHE_SIZE`` in megabytes. Cached images are
+    reloaded when the file on disk has been modified, such that re-rendered
+    references are picked up by all processes.
+
+    Returns
+    -------
+    blank_img_array : numpy array
+        The decoded image, which is read-only as it is shared between callers.
+    """
+    key = (data_directory, exam_id, page, dpi, grayscale)
+    mtime = os.stat(image_path).st_mtime_ns
+
+    blank_img_array = _cache_get(key, mtime)
+    if blank_img_array is None:
+        with Image.open(image_path) as image:
+            blank_img_array = np.array(image.convert("L") if grayscale else image)
+        blank_img_array.flags.writeable = False
+        _cache_put(key, mtime, blank_img_array)
+
+    return blank_img_array
+
+
+def clear_reference_images(exam_id):
+    """Remove all reference images of an exam, both on disk and in memory
+
+    Should be called when the exam PDF changes, e.g. when finalizing. Images that
+    are being rendered are removed once they are complete.
+
+    Parameters
+    ----------
+    exam_id : int
+        The id of the exam
+    """
+    data_directory = current_app.config["DATA_DIRECTORY"]
+    blanks_directory = os.path.join(data_directory, f"{exam_id}_data", "blanks")
+
+    try:
+        names = os.listdir(blanks_directory)
+    except FileNotFoundError:
+        names = []
+    # Rendered images have a directory per DPI, images that are being rendered only a lock file
+    dpis = {name.removeprefix(".").removesuffix(".lock") for name in names}
+
+    for dpi in filter(str.isdigit, dpis):
+        with _reference_lock(blanks_directory, dpi):
+            shutil.rmtree(os.path.join(blanks_directory, dpi), ignore_errors=True)
+
+    with _reference_cache_lock:
+        for key in [key for key in _reference_cache if key[:2] == (data_directory, exam_id)]:
+            del _reference_cache[key]
+
+
+@celery.task()
+def render_reference_images(exam_id, dpis=None):
+    """Render the reference images of an exam ahead of time
+
+    Images that were already rendered are kept. Usually run in the background,
+    as images that are not rendered yet are also rendered on first use.
+
+    Parameters
+    ----------
+    exam_id : int
+        The id of the exam
+    dpis : list of int, optional
+        The DPIs to render the images for, defaults to ``REFERENCE_DPIS``.
+    """
+    if dpis is None:
+        dpis = current_app.config["REFERENCE_DPIS"]
+
+    for dpi in dpis:
         _extract_reference_images(dpi, exam_id)
 
-    blank_page = Image.open(image_path)
-    blank_img_array = np.array(blank_page)
 
-    if widget_area_in is not None:
-        return get_box(blank_img_array, widget_area_in, padding=padding)
-    else:
-        return blank_img_array
+def schedule_reference_images(exam_id):
+    """Render the reference images of an exam in a Celery task
+
+    Failing to reach the broker is only logged, as the images are also rendered on first use.
+
+    Parameters
+    ----------
+    exam_id : int
+        The id of the exam
+    """
+    try:
+        # Not retried, such that an unavailable broker does not delay the caller
+        render_reference_images.apply_async((exam_id,), retry=False)
+    except Exception:
+        current_app.logger.warning(f"Could not schedule rendering reference images of exam {exam_id}", exc_info=True)
 
 
-def _extract_reference_images(dpi, exam_id):
+def _extract_reference_images(dpi, exam_id, image_path=None):
     """Extract and save reference images for the specified exam
 
     Saves the images at:
         {data_directory}/{exam_id}_data/blanks/{dpi}/page{page}.jpg
 
+    The images are rendered in a temporary directory that is moved in place once
+    all pages are saved, such that the directory above is either absent or complete.
+    A lock ensures concurrent workers do not render the same images twice.
+
     Parameters
     ----------
     dpi : int
         The desired DPI for the extracted images
     exam_id : int
         The id of the desired exam
+    image_path : str, optional
+        An image that is required, the images are rendered again if it is missing.
     """
     data_directory = current_app.config["DATA_DIRECTORY"]
     output_directory = os.path.join(data_directory, f"{exam_id}_data")
     pdf_path = os.path.join(output_directory, "exam.pdf")
+    blanks_directory = os.path.join(output_directory, "blanks")
+    generated_path = os.path.join(blanks_directory, f"{dpi}")
+
+    os.makedirs(blanks_directory, exist_ok=True)
+
+    with _reference_lock(blanks_directory, dpi):
+        if os.path.exists(generated_path) and (image_path is None or os.path.exists(image_path)):
+            # Another worker rendered the images while we were waiting
+            return
 
-    pages = extract_images_from_pdf(pdf_path, dpi=dpi)
+        temp_path = tempfile.mkdtemp(prefix=f".{dpi}-", dir=blanks_directory)
+        try:
+            pages = extract_images_from_pdf(pdf_path, dpi=dpi)
 
-    for page, (image, _) in enumerate(pages, start=1):
-        _save_image(image, page, dpi, output_directory)
+            for page, (image, _) in enumerate(pages, start=1):
+                if isinstance(image, Exception):
+                    raise image
+                _save_image(image, page, temp_path)
 
+            if os.path.exists(generated_path):
+                # Replace the incomplete images, only leaving them out shortly
+                outdated_path = f"{temp_path}.outdated"
+                os.rename(generated_path, outdated_path)
+                os.rename(temp_path, generated_path)
+                shutil.rmtree(outdated_path, ignore_errors=True)
+            else:
+                os.rename(temp_path, generated_path)
+        except BaseException:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
 
-def _save_image(image, page, dpi, output_directory):
+
+@contextmanager
+def _reference_lock(blanks_directory, dpi):
+    """Hold the lock on the reference images of a DPI across all processes"""
+    with open(os.path.join(blanks_directory, f".{dpi}.lock"), "w") as lock_file:
+        # The lock is released when the file is closed
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _save_image(image, page, directory):
     """Save an image at an appropriate location.
 
     Saves the images at:
-        {output_directory}/blanks/{dpi}/page{page}.jpg
+        {directory}/page{page}.jpg
 
     Parameters
     ----------
@@ -88,19 +307,14 @@ def _save_image(image, page, dpi, output_directory):
         Image data.
     page : int
         The corresponding page number, starting at 1.
-    dpi : int
-        The DPI of the image to save.
-    output_directory : path
-        The output directory of the exam the page is from.
+    directory : path
+        The directory to save the image in.
 
     Returns
     -------
     image_path : string
         Location of the image.
     """
-
-    submission_path = os.path.join(output_directory, "blanks", f"{dpi}")
-    os.makedirs(submission_path, exist_ok=True)
-    image_path = os.path.join(submission_path, f"page{page-1:02d}.jpg")
+    image_path = os.path.join(directory, f"page{page-1:02d}.jpg")
     image.save(image_path)
     return image_path
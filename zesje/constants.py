@@ -32,6 +32,19 @@ PAGE_FORMATS = {
     "US letter": (612, 792),
 }
 
+# Time in milliseconds spent on a single attempt to decode a barcode
+BARCODE_TIMEOUT = 500
+
+# Number of exams of which each worker process remembers the last successful barcode strategy
+BARCODE_STRATEGY_CACHE_SIZE = 64
+
+# Corner markers and barcodes of scans with a higher resolution are
+# first searched for in a copy downscaled to this resolution
+PYRAMID_DPI = 150
+
+# Resolutions for which reference images are rendered when finalizing an exam
+REFERENCE_DPIS = (150, 200, 300)
+
 AUTOGRADER_NAME = "Zesje"
 BLANK_FEEDBACK_NAME = "Blank"
 
@@ -42,6 +55,13 @@ MAX_ALIGNMENT_ERROR_MM = 1
 MAX_WIDTH = 1500
 MAX_HEIGHT = 65000
 
+# Maximal number of images requested at once
+MAX_BATCH_IMAGES = 100
+
+# Size in pixels and JPEG quality of the tiles of pages, see `page_tiles`
+PAGE_TILE_SIZE = 512
+PAGE_TILE_QUALITY = 90
+
 # Make sure a roughly 1 cm long line written with
 # a ballpoint pen is regarded as not blank.
 MIN_ANSWER_SIZE_MM2 = 4
@@ -2,6 +2,7 @@
 
 import enum
 import os
+from itertools import chain
 from math import nan
 
 from flask import current_app
@@ -12,7 +13,8 @@ from flask_sqlalchemy.model import BindMetaMixin, Model
 from sqlalchemy.exc import PendingRollbackError
 from sqlalchemy.ext.declarative import DeclarativeMeta, declarative_base
 from sqlalchemy.orm import backref, validates
-from sqlalchemy.orm.session import object_session
+from sqlalchemy.orm.attributes import PASSIVE_NO_INITIALIZE, get_history
+from sqlalchemy.orm.session import Session, object_session
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.sql.schema import MetaData, UniqueConstraint
@@ -114,6 +116,8 @@ class Exam(db.Model):
     widgets = db.relationship("ExamWidget", backref="exam", cascade="all", order_by="ExamWidget.id", lazy=True)
     finalized = Column(Boolean, default=False, server_default="0")
     grade_anonymous = Column(Boolean, default=False, server_default="0")
+    # Process the scans of a templated exam as single-channel grayscale images
+    grayscale = Column(Boolean, default=False, server_default="0", nullable=False)
     layout = Column(
         "layout", Enum(ExamLayout), server_default="templated", default=ExamLayout.templated, nullable=False
     )
@@ -207,6 +211,8 @@ class Page(db.Model):
     path = Column(Text, nullable=False)
     copy_id = Column(Integer, ForeignKey("copy.id"), nullable=False)  # backref copy
     number = Column(Integer, nullable=False)
+    # SHA-256 of the scanned image the page was stored from, see `scans.image_hash`
+    hash = Column(String(64), nullable=True)
     UniqueConstraint(copy_id, number)
 
     @hybrid_property
@@ -254,6 +260,8 @@ class Problem(db.Model):
         default=GradingPolicy.set_blank,
         nullable=False,
     )
+    # Increased whenever the grader or feedback of one of its solutions changes, see `bump_grading_version`
+    grading_version = Column(Integer, nullable=False, server_default="0", default=0)
     feedback_options = db.relationship(
         "FeedbackOption", backref="problem", cascade="all", order_by="FeedbackOption.id", lazy=True
     )
@@ -401,6 +409,45 @@ scan_copy = db.Table(
 )
 
 
+def bump_grading_version(connection, problem_ids):
+    """Mark that the grader or feedback of solutions of the given problems changed
+
+    This happens automatically when solutions are flushed, but not for bulk updates.
+
+    Parameters
+    ----------
+    connection : Connection
+    problem_ids : iterable of int
+    """
+    problem_ids = set(problem_ids)
+    if problem_ids:
+        connection.execute(
+            Problem.__table__.update()
+            .where(Problem.id.in_(problem_ids))
+            .values(grading_version=Problem.__table__.c.grading_version + 1)
+        )
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_changed_problems(session, flush_context):
+    """Bump the grading version of the problems whose solutions were graded, changed, added or removed."""
+    problem_ids = set()
+    for obj in chain(session.new, session.deleted):
+        if isinstance(obj, (Solution, FeedbackOption)):
+            problem_ids.add(obj.problem_id)
+    for obj in session.dirty:
+        if isinstance(obj, Solution):
+            attributes = ("grader_id", "graded_by", "feedback", "problem_id", "submission_id")
+        elif isinstance(obj, FeedbackOption):
+            attributes = ("solutions",)
+        else:
+            continue
+        if any(get_history(obj, attribute, PASSIVE_NO_INITIALIZE).has_changes() for attribute in attributes):
+            problem_ids.add(obj.problem_id)
+
+    bump_grading_version(session.connection(), problem_ids - {None})
+
+
 class Scan(db.Model):
     """Metadata on uploaded PDFs"""
 
@@ -411,6 +458,9 @@ class Scan(db.Model):
     status = Column(Text, nullable=False)
     message = Column(Text)
     copies = db.relationship("Copy", secondary=scan_copy, backref="scans", lazy=True)
+    checkpoints = db.relationship(
+        "ScanCheckpoint", backref="scan", cascade="all, delete-orphan", order_by="ScanCheckpoint.position", lazy=True
+    )
 
     @property
     def path(self):
@@ -419,6 +469,21 @@ class Scan(db.Model):
         return scan_dir / f"{self.id}{suffix}"
 
 
+class ScanCheckpoint(db.Model):
+    """Outcome of processing a single page of a scan"""
+
+    __tablename__ = "scan_checkpoint"
+    scan_id = Column(Integer, ForeignKey("scan.id"), primary_key=True)  # backref scan
+    # The index of the page in the manifest of the scan
+    position = Column(Integer, primary_key=True, autoincrement=False)
+    success = Column(Boolean, nullable=False)
+    description = Column(Text)
+    # SHA-256 of the extracted image, None if no image could be extracted
+    hash = Column(String(64), nullable=True)
+    # Whether the page was skipped because an identical page was stored before
+    duplicate = Column(Boolean, default=False, server_default="0", nullable=False)
+
+
 class Widget(db.Model):
     __tablename__ = "widget"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -6,6 +6,7 @@ from flask_migrate import Migrate
 from flask_session import Session
 from werkzeug.exceptions import NotFound
 
+from . import page_tiles
 from .database import db, login_manager, Grader
 from .api import api_bp
 
@@ -28,6 +29,7 @@ def create_migrations_app():
 
     db.init_app(app)
     Migrate(app, db)
+    app.cli.add_command(page_tiles.tile_pages_command)
 
     return app
 
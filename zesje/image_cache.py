@@ -0,0 +1,133 @@
+"""Disk cache of encoded images, shared by all processes"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from flask import current_app
+
+
+# Eviction removes images until the cache is at most this fraction of its maximum size
+EVICT_TARGET = 0.9
+# Seconds after which the cache directory is scanned again, to account for images stored by other processes
+EVICT_INTERVAL = 60
+
+# The size of each cache directory as known by this process and when it was last scanned
+_cache_sizes = {}
+_cache_sizes_lock = threading.Lock()
+
+
+def cache_directory():
+    return os.path.join(current_app.config["DATA_DIRECTORY"], "cache", "images")
+
+
+def get(key):
+    """Get a cached image
+
+    Parameters
+    ----------
+    key : str
+        The key of the image, must be a valid file name.
+
+    Returns
+    -------
+    data : bytes or None
+        The encoded image, or None if it is not cached.
+    """
+    path = os.path.join(cache_directory(), key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        # Mark the image as recently used
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+
+    return data
+
+
+def contains(key):
+    """Whether an image is cached"""
+    return os.path.exists(os.path.join(cache_directory(), key))
+
+
+def put(key, data):
+    """Store an image in the cache, evicting the least recently used images
+
+    The cache is bounded by ``IMAGE_CACHE_SIZE`` in megabytes. The size of the
+    cache is kept track of, such that the cache directory is only scanned when
+    the limit is crossed or `EVICT_INTERVAL` passed since the last scan.
+
+    Parameters
+    ----------
+    key : str
+        The key of the image, must be a valid file name.
+    data : bytes
+        The encoded image.
+    """
+    max_size = current_app.config["IMAGE_CACHE_SIZE"] * 1024**2
+    if len(data) > max_size:
+        return
+
+    directory = cache_directory()
+    os.makedirs(directory, exist_ok=True)
+
+    # Written to a temporary file first, such that other processes never read a partial image
+    fd, temp_path = tempfile.mkstemp(prefix=".", dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, os.path.join(directory, key))
+
+    with _cache_sizes_lock:
+        cache_size, scanned_at = _cache_sizes.get(directory, (None, None))
+        if cache_size is not None and time.monotonic() - scanned_at < EVICT_INTERVAL:
+            cache_size += len(data)
+            if cache_size <= max_size:
+                _cache_sizes[directory] = (cache_size, scanned_at)
+                return
+
+        _cache_sizes[directory] = (_evict(directory, max_size, int(EVICT_TARGET * max_size)), time.monotonic())
+
+
+def clear():
+    """Remove all cached images"""
+    directory = cache_directory()
+    with _cache_sizes_lock:
+        _cache_sizes.pop(directory, None)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _evict(directory, max_size, target_size):
+    """Remove the least recently used images down to `target_size` if the cache is larger than `max_size`
+
+    Returns
+    -------
+    cache_size : int
+        The size of the cache after eviction in bytes.
+    """
+    entries = []
+    for entry in os.scandir(directory):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            # Evicted by another process
+            continue
+        if not entry.name.startswith("."):
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+    cache_size = sum(size for _, size, _ in entries)
+    if cache_size <= max_size:
+        return cache_size
+
+    for _, size, path in sorted(entries):
+        if cache_size <= target_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+    return cache_size
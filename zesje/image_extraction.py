@@ -1,5 +1,7 @@
+from collections import namedtuple
 from io import BytesIO
 
+import itertools
 import numpy as np
 import mimetypes
 import zipfile
@@ -34,6 +36,9 @@ RE_COPY = re.compile(r"^(\D*(?P<copy>\d{1,2})\D*?)(\.(?P<ext>\w+))?$")
 RE_ANY_NUMBER = re.compile(r"(^|\D+)\d{1,2}($|\D+)")
 
 
+ManifestEntry = namedtuple("ManifestEntry", ["file_info", "members", "kind", "page", "error"])
+
+
 def extract_pages_from_file(file_path_or_buffer, file_info, dpi=300):
     """Recursively yield all images with page info from an arbitrary file
 
@@ -63,23 +68,23 @@ def extract_pages_from_file(file_path_or_buffer, file_info, dpi=300):
     total : int
         The total number of files to extract.
     """
-    file_infos = list(extract_images_or_infos_from_file(file_path_or_buffer, file_info, dpi, only_info=True))
-    final_total = len(file_infos)
-
-    students = Student.query.all()
-    page_infos = [guess_page_info(info, students) for info in file_infos]
+    manifest = list(build_manifest(file_path_or_buffer, file_info))
+    final_total = len(manifest)
 
-    page_infos = guess_missing_page_info(page_infos)
+    page_infos = manifest_page_infos(manifest)
 
     for number, (page_info, (image, file_info)) in enumerate(
-        zip(page_infos, extract_images_or_infos_from_file(file_path_or_buffer, file_info, dpi, only_info=False)),
+        zip(page_infos, extract_pages_from_manifest(file_path_or_buffer, manifest, dpi)),
         start=1,
     ):
         yield image, page_info, file_info, number, final_total
 
 
-def extract_images_or_infos_from_file(file_path_or_buffer, file_info, dpi=300, only_info=False):
-    """Extract images or file tree info from an arbitrary file
+def build_manifest(file_path_or_buffer, file_info, members=()):
+    """Index all pages of an arbitrary file without decoding any image
+
+    ZIP files are indexed using their central directory, only PDFs inside are
+    opened to read the number of pages.
 
     Params
     ------
@@ -87,21 +92,23 @@ def extract_images_or_infos_from_file(file_path_or_buffer, file_info, dpi=300, o
         Points to the file to read from
     file_info : str or [str]
         The name of the file, including extension. Is used to determine the mimetype.
-        Also see `file_info` in yields for this function.
-    dpi : int
-        The resolution to use for flattening PDFs, in DPI
-    only_info : bool
-        When `False`, yield everything. When `True`, only yield file tree info.
+    members : tuple of str
+        The names of the ZIP members that lead to this file, used when recursing.
 
     Yields
     ------
-    image : PIL.Image or buffer/stream
-        The extracted image or the buffer/stream of a non-image file
-    file_info : list of str and int
-        The hierarchy of the file origin. Contains a combination of the following:
-        scan filename, filename in the zip or PDF page number.
-        For example: ['scan.zip', 'some_directory_in_zip/student/page.pdf', 3] or ['student-page.png']
-        When `only_info` is `True`, this is the only parameter that is yielded.
+    entry : ManifestEntry
+        One entry for each page, containing:
+        file_info : list of str and int
+            See `extract_pages_from_file`.
+        members : tuple of str
+            The names of the (nested) ZIP members containing the page, empty if it is not in a ZIP.
+        kind : str
+            One of "image", "pdf" or "unknown".
+        page : int or None
+            The index of the page within a PDF, None for other files.
+        error : Exception or None
+            The error that occured while reading the file, if any.
     """
     if not isinstance(file_info, list):
         file_info = [file_info]
@@ -109,49 +116,168 @@ def extract_images_or_infos_from_file(file_path_or_buffer, file_info, dpi=300, o
     mime_type = guess_mimetype(file_info)
 
     if mime_type is None:
-        yield from _extract_from_unknown(file_path_or_buffer, file_info, only_info)
+        yield ManifestEntry(file_info, members, "unknown", None, None)
     elif mime_type in current_app.config["ZIP_MIME_TYPES"]:
         with zipfile.ZipFile(file_path_or_buffer, mode="r") as zip_file:
             infolist_files = (zip_info for zip_info in zip_file.infolist() if not zip_info.is_dir())
 
             for zip_info in infolist_files:
-                with zip_file.open(zip_info, "r") as zip_info_content:
-                    combined_file_info = _combine_file_info(file_info, zip_info.filename)
-                    yield from extract_images_or_infos_from_file(
-                        zip_info_content, combined_file_info, dpi, only_info=only_info
-                    )
+                combined_file_info = _combine_file_info(file_info, zip_info.filename)
+                combined_members = members + (zip_info.filename,)
+                member_mime_type = guess_mimetype(combined_file_info)
+
+                if member_mime_type == "application/pdf" or member_mime_type in current_app.config["ZIP_MIME_TYPES"]:
+                    with zip_file.open(zip_info, "r") as zip_info_content:
+                        yield from build_manifest(zip_info_content, combined_file_info, combined_members)
+                else:
+                    # The content of other files is not required to index them
+                    yield from build_manifest(None, combined_file_info, combined_members)
 
     elif mime_type == "application/pdf":
-        yield from extract_images_from_pdf(file_path_or_buffer, file_info, dpi, only_info=only_info)
+        try:
+            with Pdf.open(file_path_or_buffer) as pdf_reader:
+                number_of_pages = len(pdf_reader.pages)
+        except Exception as e:
+            yield ManifestEntry(file_info, members, "pdf", None, e)
+            return
+
+        for page in range(number_of_pages):
+            # Only include page number in file_info if there are multiple pages
+            if number_of_pages > 1:
+                file_info_page = _combine_file_info(file_info, page + 1)
+            else:
+                file_info_page = file_info
+
+            yield ManifestEntry(file_info_page, members, "pdf", page, None)
 
     elif mime_type.startswith("image/"):
-        yield from extract_image_from_image(file_path_or_buffer, file_info, only_info=only_info)
+        yield ManifestEntry(file_info, members, "image", None, None)
     else:
-        yield from _extract_from_unknown(file_path_or_buffer, file_info, only_info)
+        yield ManifestEntry(file_info, members, "unknown", None, None)
+
+
+def manifest_to_data(manifest):
+    """Convert the entries of a manifest to plain data, e.g. to pass them to a Celery task
+
+    Errors are only kept as their message, see `manifest_from_data`.
 
+    Params
+    ------
+    manifest : list of ManifestEntry
+        See `build_manifest`.
+
+    Returns
+    -------
+    data : list of tuple
+        The fields of each entry, with the error as a string or None.
+    """
+    return [
+        (entry.file_info, entry.members, entry.kind, entry.page, None if entry.error is None else str(entry.error))
+        for entry in manifest
+    ]
+
+
+def manifest_from_data(data):
+    """Restore the entries of a manifest that were converted with `manifest_to_data`
+
+    Returns
+    -------
+    manifest : list of ManifestEntry
+    """
+    return [
+        ManifestEntry(list(file_info), tuple(members), kind, page, None if error is None else Exception(error))
+        for file_info, members, kind, page, error in data
+    ]
 
-def _extract_from_unknown(file_path_or_buffer, file_info, only_info=False):
-    """Helper function to yield a file of unknown type
+
+def manifest_page_infos(manifest):
+    """Guess the page info for all entries of a manifest
 
     Params
     ------
-    Same as `extract_image_from_image`
+    manifest : list of ManifestEntry
+        See `build_manifest`.
+
+    Returns
+    -------
+    page_infos : list of tuple of (None or int)
+        Contains (student_id, page, copy) for each entry.
+    """
+    students = Student.query.all()
+
+    # We use no info for files that are not images.
+    # This ensures they are not included when checking for ambiguities.
+    page_infos = [
+        guess_page_info(entry.file_info if entry.kind != "unknown" else [], students) for entry in manifest
+    ]
+
+    return guess_missing_page_info(page_infos)
+
+
+def extract_pages_from_manifest(file_path_or_buffer, manifest, dpi=300, grayscale=False):
+    """Lazily yield the image of each entry in a manifest
+
+    Every (nested) ZIP member and PDF is opened at most once.
+
+    Params
+    ------
+    file_path_or_buffer : path-like or buffer/stream
+        Points to the file the manifest was built from
+    manifest : list of ManifestEntry
+        The (consecutive) entries to extract, see `build_manifest`.
+    dpi : int
+        The resolution to use for flattening PDFs, in DPI
+    grayscale : bool
+        Whether to convert the images to grayscale instead of RGB
 
     Yields
     ------
-    Same as `extract_images_or_infos_from_file`
+    image : PIL.Image, Exception or buffer/stream
+        The extracted image, the error that occured or the buffer/stream of a non-image file
+    file_info : list of str and int
+        See `extract_pages_from_file`.
     """
-    if not only_info:
-        # No images in here, just yield what we currently have
-        yield file_path_or_buffer, file_info
+    if manifest:
+        yield from _extract_from_entries(file_path_or_buffer, list(manifest), dpi, grayscale, depth=0)
+
+
+def _extract_from_entries(file_path_or_buffer, entries, dpi, grayscale, depth):
+    """Helper function to extract the entries of the file at `depth` in the ZIP hierarchy"""
+    if len(entries[0].members) > depth:
+        with zipfile.ZipFile(file_path_or_buffer, mode="r") as zip_file:
+            for member, member_entries in itertools.groupby(entries, key=lambda entry: entry.members[depth]):
+                with zip_file.open(member, "r") as zip_info_content:
+                    yield from _extract_from_entries(
+                        zip_info_content, list(member_entries), dpi, grayscale, depth + 1
+                    )
+
+    elif entries[0].kind == "pdf":
+        yield from _extract_from_pdf_entries(file_path_or_buffer, entries, dpi, grayscale)
 
     else:
-        # We yield no info for files that are not images.
-        # This ensures they are not included when checking for ambiguities.
-        yield []
+        for entry in entries:
+            if entry.kind == "image":
+                yield from extract_image_from_image(file_path_or_buffer, entry.file_info, grayscale=grayscale)
+            else:
+                # No images in here, just yield what we currently have
+                yield file_path_or_buffer, entry.file_info
 
 
-def extract_image_from_image(file_path_or_buffer, file_info, only_info=False):
+def _extract_from_pdf_entries(file_path_or_buffer, entries, dpi, grayscale):
+    """Helper function to extract the pages of a single PDF in a manifest"""
+    if entries[0].error is not None:
+        yield entries[0].error, entries[0].file_info
+        return
+
+    try:
+        with Pdf.open(file_path_or_buffer) as pdf_reader:
+            pages = ((pdf_reader.pages[entry.page], entry.file_info) for entry in entries)
+            yield from _extract_images_from_pages(pages, dpi, grayscale)
+    except Exception as e:
+        yield e, entries[0].file_info
+
+
+def extract_image_from_image(file_path_or_buffer, file_info, grayscale=False):
     """Yield an image from a file or buffer/stream
 
     Params
@@ -160,24 +286,23 @@ def extract_image_from_image(file_path_or_buffer, file_info, only_info=False):
         Points to the image file to read from
     file_info : [str]
         The hierarchy of the image origin. See `extract_pages_from_file`.
+    grayscale : bool
+        Whether to convert the image to grayscale instead of RGB
 
     Yields
     ------
-    Same as `extract_images_or_infos_from_file`.
+    Same as `extract_pages_from_manifest`.
     """
-    if not only_info:
-        try:
-            with Image.open(file_path_or_buffer) as image:
-                image = exif_transpose(image)
-                image = convert_to_rgb(image)
-                yield image, file_info
-        except Exception as e:
-            yield e, file_info
-    else:
-        yield file_info
+    try:
+        with Image.open(file_path_or_buffer) as image:
+            image = exif_transpose(image)
+            image = convert_to_grayscale(image) if grayscale else convert_to_rgb(image)
+            yield image, file_info
+    except Exception as e:
+        yield e, file_info
 
 
-def extract_images_from_pdf(file_path_or_buffer, file_info=None, dpi=300, only_info=False):
+def extract_images_from_pdf(file_path_or_buffer, file_info=None, dpi=300):
     """Yield all images from a PDF file.
 
     Tries to use PikePDF to extract the images from the given PDF. If PikePDF is not able to extract the image from a
@@ -194,7 +319,7 @@ def extract_images_from_pdf(file_path_or_buffer, file_info=None, dpi=300, only_i
 
     Yields
     ------
-    Same as `extract_images_or_infos_from_file`.
+    Same as `extract_pages_from_manifest`.
     """
     if file_info is None:
         file_info = []
@@ -202,44 +327,61 @@ def extract_images_from_pdf(file_path_or_buffer, file_info=None, dpi=300, only_i
     try:
         with Pdf.open(file_path_or_buffer) as pdf_reader:
             number_of_pages = len(pdf_reader.pages)
-            use_wand = False
 
-            for page_number, page in enumerate(pdf_reader.pages, start=1):
-                # Only include page number in file_info if there are multiple pages
-                if number_of_pages > 1:
-                    file_info_page = _combine_file_info(file_info, page_number)
-                else:
-                    file_info_page = file_info
-
-                if not only_info:
-                    if not use_wand:
-                        try:
-                            # Try to use PikePDF, but catch any error it raises
-                            img = extract_image_pikepdf(page)
-
-                        except (ValueError, AttributeError, NotImplementedError, UnsupportedImageTypeError, PdfError):
-                            # Fallback to Wand if extracting with PikePDF failed
-                            use_wand = True
-                        except Exception as e:
-                            yield e, file_info_page
-                            continue
-
-                    if use_wand:
-                        try:
-                            img = extract_image_wand(page, dpi)
-                        except Exception as e:
-                            yield e, file_info_page
-                            continue
-
-                    img = convert_to_rgb(img)
-                    yield img, file_info_page
-                else:
-                    yield file_info_page
+            # Only include page number in file_info if there are multiple pages
+            if number_of_pages > 1:
+                file_infos = [_combine_file_info(file_info, number) for number in range(1, number_of_pages + 1)]
+            else:
+                file_infos = [file_info] * number_of_pages
+
+            yield from _extract_images_from_pages(zip(pdf_reader.pages, file_infos), dpi)
     except Exception as e:
-        if only_info:
-            yield file_info
-        else:
-            yield e, file_info
+        yield e, file_info
+
+
+def _extract_images_from_pages(pages, dpi, grayscale=False):
+    """Yield the images of pages from a single PDF.
+
+    Tries to use PikePDF to extract the images from the given pages. If PikePDF is not able to extract the image from
+    a page, it continues to use Wand to flatten the rest of the pages.
+
+    Params
+    ------
+    pages : iterable of (pikepdf.Page, file_info)
+        The pages to extract, together with the `file_info` to yield for each page.
+    dpi : int
+        The resolution to use for flattening PDFs, in DPI
+    grayscale : bool
+        Whether to convert the images to grayscale instead of RGB
+
+    Yields
+    ------
+    Same as `extract_pages_from_manifest`.
+    """
+    use_wand = False
+
+    for page, file_info in pages:
+        if not use_wand:
+            try:
+                # Try to use PikePDF, but catch any error it raises
+                img = extract_image_pikepdf(page)
+
+            except (ValueError, AttributeError, NotImplementedError, UnsupportedImageTypeError, PdfError):
+                # Fallback to Wand if extracting with PikePDF failed
+                use_wand = True
+            except Exception as e:
+                yield e, file_info
+                continue
+
+        if use_wand:
+            try:
+                img = extract_image_wand(page, dpi)
+            except Exception as e:
+                yield e, file_info
+                continue
+
+        img = convert_to_grayscale(img) if grayscale else convert_to_rgb(img)
+        yield img, file_info
 
 
 def extract_image_pikepdf(page):
@@ -418,7 +560,7 @@ def guess_page_info(file_info, students):
     Params
     ------
     file_info : list of str and int
-        See `image_extraction._extract_images_or_infos_from_file`.
+        See `extract_pages_from_file`.
     students : list of Student
         Students to consider for detecting names
 
@@ -484,6 +626,14 @@ def convert_to_rgb(img):
     return img
 
 
+def convert_to_grayscale(img):
+    if img.mode == "L":
+        return img
+
+    # Remove any transparency on a white background first
+    return convert_to_rgb(img).convert("L")
+
+
 def exif_transpose(image):
     """
     If an image has an EXIF Orientation tag, return a new image that is
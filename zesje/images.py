@@ -2,19 +2,58 @@
 
 import numpy as np
 import cv2
+from io import BytesIO
+from PIL import Image
 
 from reportlab.lib.units import inch, mm
 from flask import current_app
 
+from . import page_tiles
+
 mm_per_inch = inch / mm
 
 
 def guess_dpi(image_array):
     h, *_ = image_array.shape
+    return _dpi_from_height(h)
+
+
+def _dpi_from_height(h):
     resolutions = np.array([1200, 600, 400, 300, 200, 150, 144, 120, 100, 75, 72, 60, 50, 40])
     return resolutions[np.argmin(abs(resolutions - 25.4 * h / 297))]
 
 
+def normalize_dpi(image_array, max_dpi):
+    """Downscale the image of a page with a resolution above `max_dpi` to `max_dpi`.
+
+    Parameters
+    ----------
+    image_array : numpy array
+        The image of a page in portrait orientation.
+    max_dpi : int
+        The maximum resolution, should be one of the resolutions `guess_dpi` distinguishes.
+        If 0, the image is returned as is.
+
+    Returns
+    -------
+    image_array : numpy array
+        The image at a resolution of at most `max_dpi`.
+    """
+    dpi = guess_dpi(image_array)
+    if not max_dpi or dpi <= max_dpi:
+        return image_array
+
+    scale = max_dpi / dpi
+    return cv2.resize(image_array, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def to_grayscale(image_array):
+    """Convert a BGR image to grayscale, single-channel images are returned as is."""
+    if image_array.ndim == 2:
+        return image_array
+    return cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
+
+
 def get_box(image_array, box, padding=0.3):
     """Extract a subblock from an array corresponding to a scanned A4 page.
 
@@ -31,7 +70,11 @@ def get_box(image_array, box, padding=0.3):
     """
     # TODO: use points as base unit
     h, w, *_ = image_array.shape
-    dpi = guess_dpi(image_array)
+    top, bottom, left, right = _box_pixels(box, padding, guess_dpi(image_array), h, w)
+    return image_array[top:bottom, left:right]
+
+
+def _box_pixels(box, padding, dpi, h, w):
     box = np.array(box)
     box += (-padding, padding, -padding, padding)
     box = (np.array(box) * dpi).astype(int)
@@ -39,7 +82,143 @@ def get_box(image_array, box, padding=0.3):
     # the numpy slicing is not correct.
     top, bottom = max(0, min(box[0], h)), max(1, min(box[1], h))
     left, right = max(0, min(box[2], w)), max(1, min(box[3], w))
-    return image_array[top:bottom, left:right]
+    return top, bottom, left, right
+
+
+# The largest height of a JPEG MCU, the decoded rows above the last MCU row depend on the rows below
+JPEG_MCU_HEIGHT = 16
+
+# Reading a JPEG at a reduced scale skips most of the decoding, from the largest reduction down
+_REDUCED_READ_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+_ORIENTATION_TAG = 0x0112
+
+
+def read_page(path, box=None, padding=0.3, min_width=None):
+    """Read (part of) a stored page, only decoding what is needed.
+
+    A JPEG is decoded sequentially, so a box is read by decoding the rows
+    up to the bottom of the box only. Without a box, a page is decoded at a
+    reduced scale if it is still at least `min_width` pixels wide.
+
+    If the page is tiled, see `page_tiles`, only the tiles of the box or of a
+    smaller level that is at least `min_width` pixels wide are decoded.
+
+    Parameters
+    ----------
+    path : str
+        The path of the page image.
+    box : 4 floats (top, bottom, left, right), optional
+        Coordinates of the bounding box in inches to read, see `get_box`.
+        Defaults to the full page.
+    padding : float
+        Padding around box borders in inches.
+    min_width : int, optional
+        The width in pixels the page will be downscaled to, ignored if a box is given.
+
+    Returns
+    -------
+    image_array : numpy array
+        The BGR image, equal to the result of `get_box` on the decoded page.
+    dpi : int
+        The resolution of the returned image.
+    origin : (int, int)
+        The (y, x) position of the top left of the image on the page in pixels.
+    """
+    manifest = page_tiles.load_manifest(path)
+    # A full page at its full resolution is decoded faster from the page itself
+    if manifest is not None and (box is not None or page_tiles.level_for_width(manifest, min_width)[0] > 0):
+        return _read_tiled_page(path, manifest, box, padding, min_width)
+
+    if box is None:
+        flags = cv2.IMREAD_COLOR
+        if min_width is not None:
+            with Image.open(path) as image:
+                width, _ = image.size
+            for factor, reduced_flags in _REDUCED_READ_FLAGS:
+                if width // factor >= min_width:
+                    flags = reduced_flags
+                    break
+
+        image_array = cv2.imread(path, flags)
+        return image_array, guess_dpi(image_array), (0, 0)
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    with Image.open(BytesIO(data)) as image:
+        w, h = image.size
+        dpi = _dpi_from_height(h)
+        top, bottom, left, right = _box_pixels(box, padding, dpi, h, w)
+
+        decode_height = int(min(h, bottom + JPEG_MCU_HEIGHT))
+        height_offset = _jpeg_frame_height_offset(data) if image.format == "JPEG" else None
+        if height_offset is None or decode_height == h or image.getexif().get(_ORIENTATION_TAG, 1) != 1:
+            # Any other image is read as a whole, like `cv2.imread` does
+            page_im = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            return np.ascontiguousarray(page_im[top:bottom, left:right]), dpi, (top, left)
+
+    # Decoding stops after the last row of the frame, so make the frame end right below the box
+    data = data[:height_offset] + decode_height.to_bytes(2, "big") + data[height_offset + 2 :]
+    with Image.open(BytesIO(data)) as image:
+        page_im = np.asarray(image.convert("RGB"))
+
+    return np.ascontiguousarray(page_im[top:bottom, left:right, ::-1]), dpi, (top, left)
+
+
+def _read_tiled_page(path, manifest, box, padding, min_width):
+    if box is None:
+        level, w, h = page_tiles.level_for_width(manifest, min_width)
+        return page_tiles.read_tiles(path, level, 0, h, 0, w), _dpi_from_height(h), (0, 0)
+
+    _, w, h = page_tiles.level_for_width(manifest)
+    dpi = _dpi_from_height(h)
+    top, bottom, left, right = _box_pixels(box, padding, dpi, h, w)
+    return page_tiles.read_tiles(path, 0, top, bottom, left, right), dpi, (top, left)
+
+
+# Start of frame markers of all JPEG processes except baseline and extended sequential
+_NON_SEQUENTIAL_SOF_MARKERS = {0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _jpeg_frame_height_offset(data):
+    """The offset of the image height in the frame header of a sequential JPEG
+
+    Parameters
+    ----------
+    data : bytes
+        The encoded JPEG.
+
+    Returns
+    -------
+    offset : int or None
+        None if the JPEG is not sequential or its header could not be parsed.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+        elif marker in (0xC0, 0xC1):
+            # Segment marker and length, followed by the sample precision
+            return pos + 5
+        elif marker in _NON_SEQUENTIAL_SOF_MARKERS or marker == 0xDA:
+            # Not sequential, or start of scan before a frame header
+            return None
+        else:
+            pos += 2 + int.from_bytes(data[pos + 2 : pos + 4], "big")
+
+    return None
 
 
 def widget_area(problem):
@@ -69,6 +248,28 @@ def widget_area(problem):
     return widget_area_in
 
 
+def binarize(image_array, binary_threshold, kernel_size=None):
+    """Convert an image to binary, with white as open space and black as filled space
+
+    Params
+    ------
+    image_array: np.array
+        The grayscale or BGR image
+    binary_threshold: int, between 0 and 255
+        The value used to convert grayscale images to binary
+    kernel_size: int, optional
+        The diameter in pixels of the kernel that is used to thicken the lines.
+        If None, the lines are not thickened.
+    """
+    _, binary = cv2.threshold(to_grayscale(image_array), binary_threshold, 255, cv2.THRESH_BINARY)
+
+    if kernel_size is not None:
+        kernel = np.ones((kernel_size, kernel_size), dtype=np.uint8)
+        binary = cv2.erode(binary, kernel, iterations=1)
+
+    return binary
+
+
 def covers(cover_img, to_cover_img, padding_pixels=0, threshold=0, binary_threshold=150, kernel_size=9):
     """Check if an image covers another image
 
@@ -93,15 +294,28 @@ def covers(cover_img, to_cover_img, padding_pixels=0, threshold=0, binary_thresh
     kernel_size: int
         The diameter in pixels of the kernel that is used to thicken the lines
     """
-    cover = cv2.cvtColor(cover_img, cv2.COLOR_BGR2GRAY)
-    _, cover_bin = cv2.threshold(cover, binary_threshold, 255, cv2.THRESH_BINARY)
+    cover_thick = binarize(cover_img, binary_threshold, kernel_size)
+    to_cover_bin = binarize(to_cover_img, binary_threshold)
+
+    return covers_binary(cover_thick, to_cover_bin, padding_pixels, threshold)
 
-    to_cover = cv2.cvtColor(to_cover_img, cv2.COLOR_BGR2GRAY)
-    _, to_cover_bin = cv2.threshold(to_cover, binary_threshold, 255, cv2.THRESH_BINARY)
 
-    kernel = np.ones((kernel_size, kernel_size), dtype=np.uint8)
-    cover_thick = cv2.erode(cover_bin, kernel, iterations=1)
+def covers_binary(cover_thick, to_cover_bin, padding_pixels=0, threshold=0):
+    """Check if a thickened binary image covers another binary image
 
+    Same as `covers`, for images that are already converted with `binarize`.
+
+    Params
+    ------
+    cover_thick: np.array
+        The binary image with thickened lines that is used as cover
+    to_cover_bin: np.array
+        The binary image that is going to be covered
+    padding_pixels: int
+        The amount of padding to remove before checking if it is covered
+    threshold: int
+        The amount of pixels that are allowed to not be covered
+    """
     difference = ~(cover_thick - to_cover_bin)[padding_pixels:-padding_pixels, padding_pixels:-padding_pixels]
 
     non_covered_pixels = np.count_nonzero(difference == 0)
@@ -109,7 +323,7 @@ def covers(cover_img, to_cover_img, padding_pixels=0, threshold=0, binary_thresh
     return non_covered_pixels <= threshold
 
 
-def is_misaligned(area_inch, img, reference, padding_inch=0.2):
+def is_misaligned(area_inch, img, reference, padding_inch=0.2, reference_bin=None):
     """Checks if an image is correctly aligned against the reference
 
     The check is only executed for the supplied area.
@@ -127,6 +341,10 @@ def is_misaligned(area_inch, img, reference, padding_inch=0.2):
         A numpy array of the full page reference image
     padding_inch: float
         Extra padding to apply such that content is not cut off, in inches
+    reference_bin: np.array, optional
+        The full page reference image converted with `binarize` using the
+        misalignment threshold, e.g. from `blanks.reference_mask`. If not
+        provided, it is computed from `reference`.
     """
     dpi = guess_dpi(img)
     padding_pixels = int(padding_inch * dpi)
@@ -136,15 +354,12 @@ def is_misaligned(area_inch, img, reference, padding_inch=0.2):
     kernel_size_mm = 2 * current_app.config["MAX_ALIGNMENT_ERROR_MM"]
     kernel_size = int(kernel_size_mm * dpi / mm_per_inch)
 
-    img_cropped = get_box(img, area_inch, padding=padding_inch)
-    reference_cropped = get_box(reference, area_inch, padding=padding_inch)
-
     binary_threshold = current_app.config["THRESHOLD_MISALIGMENT"]
 
-    return not covers(
-        img_cropped,
-        reference_cropped,
-        padding_pixels=padding_pixels,
-        binary_threshold=binary_threshold,
-        kernel_size=kernel_size,
-    )
+    img_thick = binarize(get_box(img, area_inch, padding=padding_inch), binary_threshold, kernel_size)
+    if reference_bin is None:
+        reference_cropped_bin = binarize(get_box(reference, area_inch, padding=padding_inch), binary_threshold)
+    else:
+        reference_cropped_bin = get_box(reference_bin, area_inch, padding=padding_inch)
+
+    return not covers_binary(img_thick, reference_cropped_bin, padding_pixels=padding_pixels)
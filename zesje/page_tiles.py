@@ -0,0 +1,211 @@
+"""Tiled multi-resolution storage of pages
+
+Next to a stored page ``pageNN.jpg``, the directory ``pageNN.tiles`` holds the
+page split in JPEG tiles, at its full resolution and at repeatedly halved
+resolutions (levels). Crops and downscaled pages only decode the tiles they need.
+
+The stored page itself remains the reference for everything else, its tiles are
+only used as long as it is not modified after they were stored.
+"""
+
+import errno
+import json
+import os
+import shutil
+import tempfile
+
+import click
+import cv2
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from PIL import Image
+
+from .constants import PAGE_TILE_SIZE, PAGE_TILE_QUALITY
+from .database import Page
+
+MANIFEST_NAME = "manifest.json"
+
+
+def tiles_directory(image_path):
+    return os.path.splitext(image_path)[0] + ".tiles"
+
+
+def update(image_path, image=None):
+    """Store or remove the tiles of a page after it is saved, depending on ``PAGE_TILES``
+
+    Parameters
+    ----------
+    image_path : str
+        The path of the stored page.
+    image : PIL Image, optional
+        The stored page, read from `image_path` if not given.
+    """
+    if not current_app.config["PAGE_TILES"]:
+        remove_tiles(image_path)
+        return
+
+    try:
+        save_tiles(image_path, image)
+    except OSError:
+        # The stored page itself can still be used without tiles
+        current_app.logger.exception(f"Storing the tiles of {image_path} failed")
+
+
+def save_tiles(image_path, image=None):
+    """Store the tiles of a page
+
+    Parameters
+    ----------
+    image_path : str
+        The path of the stored page.
+    image : PIL Image, optional
+        The stored page, read from `image_path` if not given.
+    """
+    if image is None:
+        with Image.open(image_path) as stored_image:
+            image = stored_image.convert("L" if stored_image.mode == "L" else "RGB")
+    elif image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+
+    # The version is taken before tiling, such that a page saved in the meantime invalidates the tiles
+    stat = os.stat(image_path)
+    manifest = {"source": [stat.st_mtime_ns, stat.st_size], "tile_size": PAGE_TILE_SIZE, "levels": []}
+
+    directory = tiles_directory(image_path)
+    temp_directory = tempfile.mkdtemp(prefix=".", dir=os.path.dirname(directory))
+    try:
+        level = image
+        while True:
+            level_directory = os.path.join(temp_directory, str(len(manifest["levels"])))
+            os.mkdir(level_directory)
+            _save_level(level, level_directory)
+            manifest["levels"].append(level.size)
+
+            if max(level.size) <= PAGE_TILE_SIZE:
+                break
+            level = level.reduce(2)
+
+        with open(os.path.join(temp_directory, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f)
+
+        # Replace the tiles as a whole, readers only use tiles with a manifest
+        remove_tiles(image_path)
+        try:
+            os.rename(temp_directory, directory)
+        except OSError as error:
+            if error.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            # Tiled concurrently by another process
+            shutil.rmtree(temp_directory, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        raise
+
+
+def _save_level(image, directory):
+    width, height = image.size
+    for top in range(0, height, PAGE_TILE_SIZE):
+        for left in range(0, width, PAGE_TILE_SIZE):
+            tile = image.crop((left, top, min(left + PAGE_TILE_SIZE, width), min(top + PAGE_TILE_SIZE, height)))
+            tile.save(os.path.join(directory, _tile_name(top, left)), quality=PAGE_TILE_QUALITY)
+
+
+def _tile_name(top, left):
+    return f"{top // PAGE_TILE_SIZE}_{left // PAGE_TILE_SIZE}.jpg"
+
+
+def remove_tiles(image_path):
+    shutil.rmtree(tiles_directory(image_path), ignore_errors=True)
+
+
+def load_manifest(image_path):
+    """Load the manifest of the tiles of a page
+
+    Parameters
+    ----------
+    image_path : str
+        The path of the stored page.
+
+    Returns
+    -------
+    manifest : dict or None
+        None if the page has no tiles or was modified after they were stored.
+    """
+    try:
+        with open(os.path.join(tiles_directory(image_path), MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        stat = os.stat(image_path)
+    except (OSError, ValueError):
+        return None
+
+    if manifest["source"] != [stat.st_mtime_ns, stat.st_size] or manifest["tile_size"] != PAGE_TILE_SIZE:
+        return None
+
+    return manifest
+
+
+def level_for_width(manifest, min_width=None):
+    """The smallest level of a page that is at least `min_width` pixels wide
+
+    Returns
+    -------
+    level : int
+    width, height : int
+        The size of the level in pixels.
+    """
+    levels = manifest["levels"]
+    level = 0
+    if min_width is not None:
+        while level + 1 < len(levels) and levels[level + 1][0] >= min_width:
+            level += 1
+
+    return (level, *levels[level])
+
+
+def read_tiles(image_path, level, top, bottom, left, right):
+    """Read a region of a level of a page from its tiles
+
+    Parameters
+    ----------
+    image_path : str
+        The path of the stored page, whose tiles are valid according to `load_manifest`.
+    level : int
+    top, bottom, left, right : int
+        The region to read in pixels of the level, within its bounds.
+
+    Returns
+    -------
+    image_array : numpy array
+        The BGR image of the region.
+    """
+    level_directory = os.path.join(tiles_directory(image_path), str(level))
+    image_array = np.empty((bottom - top, right - left, 3), dtype=np.uint8)
+
+    for tile_top in range(top - top % PAGE_TILE_SIZE, bottom, PAGE_TILE_SIZE):
+        for tile_left in range(left - left % PAGE_TILE_SIZE, right, PAGE_TILE_SIZE):
+            tile_array = cv2.imread(os.path.join(level_directory, _tile_name(tile_top, tile_left)))
+
+            y0, x0 = max(top, tile_top), max(left, tile_left)
+            y1 = min(bottom, tile_top + tile_array.shape[0])
+            x1 = min(right, tile_left + tile_array.shape[1])
+            image_array[y0 - top : y1 - top, x0 - left : x1 - left] = tile_array[
+                y0 - tile_top : y1 - tile_top, x0 - tile_left : x1 - tile_left
+            ]
+
+    return image_array
+
+
+@click.command("tile-pages")
+@click.option("--remove", is_flag=True, help="Remove the tiles of all pages instead.")
+@with_appcontext
+def tile_pages_command(remove):
+    """Store the tiles of all pages in the data directory that are not tiled yet."""
+    pages = Page.query.filter(Page.path.isnot(None)).all()
+
+    with click.progressbar(pages, label="Removing tiles" if remove else "Tiling pages") as bar:
+        for page in bar:
+            if remove:
+                remove_tiles(page.abs_path)
+            elif os.path.exists(page.abs_path) and load_manifest(page.abs_path) is None:
+                save_tiles(page.abs_path)
@@ -12,6 +12,8 @@ from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 import zipstream
 
+from .blanks import clear_reference_images
+
 
 def exam_dir(exam_id):
     return os.path.join(
@@ -147,6 +149,9 @@ def write_finalized_exam(exam):
 
     os.remove(original_pdf_file)
 
+    # Any reference images rendered before are outdated now, see `blanks.schedule_reference_images`
+    clear_reference_images(exam.id)
+
 
 def _exam_generate_data(exam):
     """Retrieve data necessary to generate exam PDFs
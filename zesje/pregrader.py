@@ -1,18 +1,138 @@
 import cv2
 import numpy as np
+from collections import defaultdict, namedtuple
 from datetime import datetime, timezone
+from functools import lru_cache
 
 from flask import current_app
 from reportlab.lib.units import inch, mm
 
-from .blanks import reference_image
-from .database import db, Grader, FeedbackOption, GradingPolicy, rollback_transaction_if_pending
-from .images import guess_dpi, get_box, widget_area, covers, is_misaligned
+from .blanks import reference_image, reference_mask
+from .database import db, Grader, FeedbackOption, GradingPolicy
+from .images import guess_dpi, get_box, widget_area, binarize, covers, covers_binary, is_misaligned
 
 mm_per_inch = inch / mm
 
 
-def grade_page(copy, page, page_img):
+ProblemLayout = namedtuple("ProblemLayout", ["id", "page", "widget_area_in", "mc_options"])
+
+PregradeResult = namedtuple("PregradeResult", ["misaligned", "blank", "filled_feedback_ids"])
+
+ReferenceMasks = namedtuple("ReferenceMasks", ["misalignment", "blank"])
+
+
+def problem_layout(problem):
+    """Collect the geometry of a problem that is needed for pregrading.
+
+    The result does not reference any database objects, such that it can be
+    sent to other processes that perform the image analysis.
+
+    Parameters
+    ----------
+    problem : Problem
+        The problem to collect the layout for
+
+    Returns
+    -------
+    layout : ProblemLayout
+        The problem id, page, widget area in inches and a tuple of
+        (feedback_id, x, y) for each multiple choice option.
+    """
+    return ProblemLayout(
+        id=problem.id,
+        page=problem.widget.page,
+        widget_area_in=widget_area(problem),
+        mc_options=tuple((mc_option.feedback_id, mc_option.x, mc_option.y) for mc_option in problem.mc_options),
+    )
+
+
+def reference_masks(exam_id, page, dpi, grayscale=False):
+    """Get the binarized reference page used by the misalignment and blank checks.
+
+    The masks are cached, such that the reference page is only binarized once
+    for all scanned pages.
+
+    Parameters
+    ----------
+    exam_id : int
+        The id of the exam
+    page : int
+        The page number
+    dpi : int
+        The resolution of the scanned pages
+    grayscale : bool
+        Whether the scanned pages are grayscale
+
+    Returns
+    -------
+    masks : ReferenceMasks
+        The binary reference page for `is_misaligned` and the binary reference
+        page with thickened lines for `_is_blank`.
+    """
+    return ReferenceMasks(
+        misalignment=reference_mask(
+            exam_id, page, dpi, current_app.config["THRESHOLD_MISALIGMENT"], grayscale=grayscale
+        ),
+        blank=reference_mask(
+            exam_id, page, dpi, current_app.config["THRESHOLD_BLANK"], _blank_kernel_size(dpi), grayscale=grayscale
+        ),
+    )
+
+
+def pregrade_problems(layouts, page, page_img, reference_img, masks=None):
+    """Run the image checks of the pregrader for all problems on a page.
+
+    This function does not access the database.
+
+    Parameters
+    ----------
+    layouts : iterable of ProblemLayout
+        The problems to check, problems on other pages are skipped
+    page : int
+        Page number of the image
+    page_img : np.array
+        image of the page
+    reference_img: np.array
+        A numpy array of the full page reference image
+    masks : ReferenceMasks, optional
+        The result of `reference_masks` for this page. If not provided, the
+        reference image is binarized for every problem.
+
+    Returns
+    -------
+    results : dict of int to PregradeResult
+        The result for each problem on this page, indexed by problem id
+    """
+    misalignment_mask, blank_mask = masks if masks is not None else (None, None)
+
+    results = {}
+    mc_layouts = []
+    for layout in layouts:
+        if layout.page != page:
+            continue
+
+        if is_misaligned(layout.widget_area_in, page_img, reference_img, reference_bin=misalignment_mask):
+            results[layout.id] = PregradeResult(misaligned=True, blank=None, filled_feedback_ids=())
+        elif layout.mc_options:
+            mc_layouts.append(layout)
+        else:
+            blank = is_area_blank(layout.widget_area_in, page_img, reference_img, blank_mask)
+            results[layout.id] = PregradeResult(misaligned=False, blank=blank, filled_feedback_ids=())
+
+    # All checkboxes on the page are checked at once
+    mc_options = [mc_option for layout in mc_layouts for mc_option in layout.mc_options]
+    if mc_options:
+        fill_ratios = checkbox_fill_ratios([(x, y) for _, x, y in mc_options], page_img)
+        filled_ids = {feedback_id for (feedback_id, *_), ratio in zip(mc_options, fill_ratios) if ratio >= 1}
+
+        for layout in mc_layouts:
+            filled = tuple(feedback_id for feedback_id, *_ in layout.mc_options if feedback_id in filled_ids)
+            results[layout.id] = PregradeResult(misaligned=False, blank=not filled, filled_feedback_ids=filled)
+
+    return results
+
+
+def grade_page(copy, page, page_img, pregraded=None):
     """Grades all the problems in the `copy` belonging to the corresponding `page`.
 
     Automatically checks if a problem is blank, and adds a feedback option 'blank' if so.
@@ -20,6 +140,8 @@ def grade_page(copy, page, page_img):
     that is identified as filled in is created.
     For submissions with multipe copies, no grading is done at all.
 
+    Warning: Does not commit the database changes
+
     Parameters
     ------
     copy : Copy
@@ -28,6 +150,9 @@ def grade_page(copy, page, page_img):
         Page number of the submission
     page_img : np.array
         image of the page
+    pregraded : dict of int to PregradeResult, optional
+        The results of `pregrade_problems` for this page, if these were already
+        computed. If not provided, the image checks are performed here.
     """
     AUTOGRADER_NAME = current_app.config["AUTOGRADER_NAME"]
     sub = copy.submission
@@ -36,40 +161,38 @@ def grade_page(copy, page, page_img):
     if len(sub.copies) > 1:
         return
 
-    dpi = guess_dpi(page_img)
-    reference_img = reference_image(sub.exam_id, page, dpi)
-
-    for sol in sub.solutions:
-        # exclude solutions which are already graded by someone that is not Zesje
-        if sol.is_graded and sol.graded_by.oauth_id != AUTOGRADER_NAME:
-            continue
-
+    # exclude solutions which are already graded by someone that is not Zesje
+    solutions = [
+        sol
+        for sol in sub.solutions
+        if not (sol.is_graded and sol.graded_by.oauth_id != AUTOGRADER_NAME) and sol.problem.widget.page == page
+    ]
+
+    if pregraded is None:
+        dpi = guess_dpi(page_img)
+        grayscale = page_img.ndim == 2
+        reference_img = reference_image(sub.exam_id, page, dpi, grayscale=grayscale)
+        masks = reference_masks(sub.exam_id, page, dpi, grayscale=grayscale)
+        layouts = [problem_layout(sol.problem) for sol in solutions]
+        pregraded = pregrade_problems(layouts, page, page_img, reference_img, masks)
+
+    for sol in solutions:
         problem = sol.problem
-        # exclude problems on a different page
-        if problem.widget.page != page:
-            continue
+        result = pregraded.get(problem.id)
 
-        if not is_problem_misaligned(problem, page_img, reference_img):
+        if result is not None and not result.misaligned:
             # Completely reset the solution and pregrade with a fresh start
             sol.feedback = []
             sol.grader_id = None
             sol.graded_at = None
 
             if problem.mc_options:
-                grade_mcq(sol, page_img, reference_img)
-            elif is_solution_blank(problem, page_img, reference_img):
+                grade_mcq(sol, result.filled_feedback_ids)
+            elif result.blank:
                 grade_as_blank(sol)
 
-            try:
-                db.session.commit()
-            except Exception as e:
-                # Rollback the transaction if a rollback was pending due to an error.
-                # If there was no pending rollback, the unexpected error is raised.
-                if not rollback_transaction_if_pending():
-                    raise e
-
 
-def grade_mcq(sol, page_img, reference_img):
+def grade_mcq(sol, filled_feedback_ids):
     """
     Pre-grades a multiple choice problem.
     This function does either of two things:
@@ -84,18 +207,14 @@ def grade_mcq(sol, page_img, reference_img):
     ----------
     sol : Solution
         The solution to the multiple choice question
-    page_img: np.array
-        A numpy array of the image scan
-    reference_img: np.array
-        A numpy array of the full page reference image
+    filled_feedback_ids : collection of int
+        The feedback ids of the options whose checkbox was detected as filled
     """
     problem = sol.problem
     mc_filled_counter = 0
 
     for mc_option in problem.mc_options:
-        box = (mc_option.x, mc_option.y)
-
-        if is_checkbox_filled(box, page_img, reference_img):
+        if mc_option.feedback_id in filled_feedback_ids:
             feedback = mc_option.feedback
             sol.feedback.append(feedback)
             mc_filled_counter += 1
@@ -180,7 +299,16 @@ def is_problem_misaligned(problem, student_img, reference_img):
     return is_misaligned(widget_area_in, student_img, reference_img)
 
 
-def _is_blank(area_inch, page_img, reference_img, padding_inch, binary_threshold, min_area_inch2):
+def _blank_kernel_size(dpi):
+    """The diameter of the kernel to thicken the lines of the reference with.
+
+    This allows misalignment up to the max alignment error in any direction.
+    """
+    alignment_error_pixel = current_app.config["MAX_ALIGNMENT_ERROR_MM"] * dpi / mm_per_inch
+    return 2 * int(alignment_error_pixel) + 1
+
+
+def _is_blank(area_inch, page_img, reference_img, padding_inch, binary_threshold, min_area_inch2, reference_thick=None):
     """Determines if an area of a page is blank
 
     Params
@@ -197,6 +325,10 @@ def _is_blank(area_inch, page_img, reference_img, padding_inch, binary_threshold
         The value used to convert grayscale images to binary
     min_area_inch2
         The surface area that is allowed to be filled to still consider it blank
+    reference_thick: np.array, optional
+        The full page reference image converted with `images.binarize` using
+        `binary_threshold` and `_blank_kernel_size`. If not provided, it is
+        computed from `reference_img`.
 
     Returns
     ------
@@ -208,14 +340,19 @@ def _is_blank(area_inch, page_img, reference_img, padding_inch, binary_threshold
     # in only one of the two images
     padding_pixels = int(padding_inch * dpi)
 
-    # The diameter of the kernel to thicken the lines with. This allows
-    # misalignment up to the max alignment error in any direction.
-    alignment_error_pixel = current_app.config["MAX_ALIGNMENT_ERROR_MM"] * dpi / mm_per_inch
-    kernel_size = 2 * int(alignment_error_pixel) + 1
-
     min_answer_area_pixels = int(min_area_inch2 * dpi**2)
 
     student = get_box(page_img, area_inch, padding=padding_inch)
+
+    if reference_thick is not None:
+        return covers_binary(
+            get_box(reference_thick, area_inch, padding=padding_inch),
+            binarize(student, binary_threshold),
+            padding_pixels=padding_pixels,
+            threshold=min_answer_area_pixels,
+        )
+
+    kernel_size = _blank_kernel_size(dpi)
     reference = get_box(reference_img, area_inch, padding=padding_inch)
 
     return covers(
@@ -244,8 +381,27 @@ def is_solution_blank(problem, page_img, reference_img):
     ------
     True if the solution is blank, else False
     """
-    widget_area_in = widget_area(problem)
+    return is_area_blank(widget_area(problem), page_img, reference_img)
+
+
+def is_area_blank(widget_area_in, page_img, reference_img, reference_thick=None):
+    """Determines if the widget area of a problem is blank
 
+    Params
+    ------
+    widget_area_in: numpy array
+        An array with consisting of [top, bottom, left, right] in inches
+    page_img: np.array
+        A numpy array of the full page image scan
+    reference_img: np.array
+        A numpy array of the full page reference image
+    reference_thick: np.array, optional
+        The `blank` mask of `reference_masks`, see `_is_blank`.
+
+    Returns
+    ------
+    True if the area is blank, else False
+    """
     padding_inch = 0.2
     min_area_inch2 = current_app.config["MIN_ANSWER_SIZE_MM2"] / (mm_per_inch) ** 2
     binary_threshold = current_app.config["THRESHOLD_BLANK"]
@@ -257,6 +413,7 @@ def is_solution_blank(problem, page_img, reference_img):
         padding_inch=padding_inch,
         binary_threshold=binary_threshold,
         min_area_inch2=min_area_inch2,
+        reference_thick=reference_thick,
     )
 
 
@@ -264,9 +421,8 @@ def is_checkbox_filled(box_coords, page_img, reference_img):
     """
     Checks whether a checkbox at a specific location is filled
 
-    First, a binary threshold is applied to the input images. Next, template matching
-    is applied to find the exact location of the checkbox. Finally the inside of the
-    checkbox is checked to be filled for at least a certain threshold.
+    See `checkbox_fill_ratios` for the algorithm, which checks all checkboxes
+    of a page at once.
 
     Params
     ------
@@ -282,12 +438,37 @@ def is_checkbox_filled(box_coords, page_img, reference_img):
     ------
     True if the box is marked, else False.
     """
+    return checkbox_fill_ratios([box_coords], page_img)[0] >= 1
+
+
+def checkbox_fill_ratios(boxes_coords, page_img):
+    """
+    Measures how much each checkbox on a page is filled
+
+    First, a binary threshold is applied to the areas around the checkboxes.
+    Next, template matching is applied to find the exact location of each checkbox.
+    Finally the filled pixels inside each checkbox are counted.
+
+    The areas around the checkboxes are stacked and both the template matching
+    and the counting use a single integral image of the stack, such that all
+    checkboxes of a page are checked at once.
+
+    Params
+    ------
+    boxes_coords: list of (int, int)
+        The coordinates of the top left (x,y) of each checkbox in points.
+    page_img: np.array
+        A numpy array of the image scan
+
+    Returns
+    ------
+    fill_ratios : np.array
+        For each checkbox the amount of filled pixels inside it, relative to the
+        minimum for a marked checkbox. A checkbox is marked if its ratio is at least 1.
+    """
     dpi = guess_dpi(page_img)
     box_size = current_app.config["CHECKBOX_SIZE"]
 
-    # create an array with y top, y bottom, x left and x right. And divide by 72 to get dimensions in inches.
-    coords = np.asarray([box_coords[1], box_coords[1] + box_size, box_coords[0], box_coords[0] + box_size]) / 72
-
     min_area_inch2 = current_app.config["MIN_CHECKBOX_SIZE_MM2"] / (mm_per_inch) ** 2
     binary_threshold = current_app.config["THRESHOLD_MCQ"]
     min_answer_area_pixels = int(min_area_inch2 * dpi**2)
@@ -295,36 +476,84 @@ def is_checkbox_filled(box_coords, page_img, reference_img):
     # Extra padding to ensure any content is not cut off due to misalignment
     padding_inch = current_app.config["MAX_ALIGNMENT_ERROR_MM"] / mm_per_inch
 
-    student = get_box(page_img, coords, padding=padding_inch)
-
-    student_gray = cv2.cvtColor(student, cv2.COLOR_BGR2GRAY)
-    _, student_bin = cv2.threshold(student_gray, binary_threshold, 255, cv2.THRESH_BINARY)
+    reference_size, line_width, border = _checkbox_template(dpi, box_size)
+
+    # Crops near the edge of the page can be smaller, only crops of the same size are stacked
+    crops = defaultdict(list)
+    for index, (x, y) in enumerate(boxes_coords):
+        # create an array with y top, y bottom, x left and x right. And divide by 72 to get dimensions in inches.
+        coords = np.asarray([y, y + box_size, x, x + box_size]) / 72
+        crop = get_box(page_img, coords, padding=padding_inch)
+        crops[crop.shape[:2]].append((index, crop))
+
+    fill_ratios = np.zeros(len(boxes_coords))
+    for (height, width), indexed_crops in crops.items():
+        indices, stacked = zip(*indexed_crops)
+
+        # The number of black pixels in any rectangle of the stacked crops
+        black = (binarize(np.concatenate(stacked), binary_threshold) == 0).astype(np.uint8)
+        integral = cv2.integral(black, sdepth=cv2.CV_64F).astype(np.int64)
+
+        def count(top, left, size):
+            return (
+                integral[top + size, left + size]
+                - integral[top, left + size]
+                - integral[top + size, left]
+                + integral[top, left]
+            )
+
+        # All positions of the template that are fully inside a single crop
+        tops = height * np.arange(len(indices))[:, None, None] + np.arange(height - reference_size + 1)[:, None]
+        lefts = np.arange(width - reference_size + 1)
+
+        # Match the template checkbox to the student image, this is the TM_CCORR
+        # score of the inverted images, see `_checkbox_template`.
+        frame = count(tops, lefts, reference_size)
+        inside = count(tops + border, lefts + border, reference_size - 2 * border)
+        score = 255 * frame - 127 * inside
+
+        y, x = np.divmod(np.argmax(score.reshape(len(indices), -1), axis=1), len(lefts))
+        y += height * np.arange(len(indices))
+
+        # Find the inside of the checkbox on the student image.
+        # Crop 1 line width for the line of the checkbox.
+        # Crop 1 line width + 1 pixel for small alignment errors.
+        crop = 2 * line_width + 1
+        non_covered_pixels = count(y + crop, x + crop, max(0, reference_size - 2 * crop))
+
+        fill_ratios[list(indices)] = non_covered_pixels / min_answer_area_pixels
+
+    return fill_ratios
+
+
+@lru_cache(maxsize=16)
+def _checkbox_template(dpi, box_size):
+    """The template to locate a checkbox at the given DPI and size in points.
+
+    The template is a blank checkbox at this DPI, but with the internal area of
+    the checkbox gray, as we should find marked as well as blank checkboxes.
+    Template matching with the TM_CCORR method is most sensitive to white areas
+    of the image, so the images and template are inverted to focus on black.
+    As the inverted template is 255 on the border and 128 inside, its score at
+    a position is ``255 * frame - 127 * inside`` times 255, with `frame` and
+    `inside` the amount of black pixels of the image in the full template and
+    its inside.
 
+    Returns
+    ------
+    reference_size : int
+        The width of a complete checkbox in pixels.
+    line_width : int
+        The line width of a checkbox in pixels.
+    border : int
+        The width of the border of the template in pixels.
+    """
     # The width of a complete checkbox is its defined width + 1pt line width
     reference_size = int((box_size + 1) / 72 * dpi)
     line_width = int(dpi / 72)
 
-    # A representation of a blank checkbox at this DPI
-    reference_bin = np.full((reference_size, reference_size), 255, dtype=np.uint8)
-    cv2.rectangle(reference_bin, (0, 0), (reference_bin.shape[0] - 1, reference_bin.shape[1] - 1), 0, line_width * 2)
-
-    # The template used for template matching. The same as `reference_bin`, but with the internal area
-    # of the checkbox replaced with gray, as we should find marked as well as blank checkboxes.
     template_bin = np.full((reference_size, reference_size), 127, dtype=np.uint8)
     cv2.rectangle(template_bin, (0, 0), (template_bin.shape[0] - 1, template_bin.shape[1] - 1), 0, line_width * 2 + 1)
+    border = int(np.argmax(template_bin[reference_size // 2] == 127))
 
-    # Match the template checkbox to the student image. The TM_CCORR method is most
-    # sensitive to white areas of the image, so we invert everything to focus on black.
-    res = cv2.matchTemplate(~student_bin, ~template_bin, cv2.TM_CCORR)
-    *_, max_loc = cv2.minMaxLoc(res)
-
-    # Find the inside of the checkbox on the student image.
-    # Crop 1 line width for the line of the checkbox.
-    # Crop 1 line width + 1 pixel for small alignment errors.
-    x, y = max_loc
-    crop = 2 * line_width + 1
-    inside_box = student_bin[(crop + y) : (y + reference_size - crop), (crop + x) : (x + reference_size - crop)]
-
-    non_covered_pixels = np.count_nonzero(inside_box == 0)
-
-    return non_covered_pixels >= min_answer_area_pixels
+    return reference_size, line_width, border
@@ -1,10 +1,11 @@
 from flask import current_app
 from pathlib import Path
 
+from . import page_tiles
 from .database import db, Exam, Submission, Solution, Student, Copy, Page
 
 
-def process_page(image, page_info, file_info, exam_config, output_directory, scan=None):
+def process_page(image, page_info, file_info, exam_config, output_directory, scan=None, commit=True, content_hash=None):
     student_id, page, copy = page_info
 
     if not student_id:
@@ -37,9 +38,12 @@ def process_page(image, page_info, file_info, exam_config, output_directory, sca
 
     path = image_dir / f"page{page.number:02d}.jpg"
     image.save(path)
+    page_tiles.update(str(path), image)
 
     page.path = str(path.relative_to(current_app.config["DATA_DIRECTORY"]))
-    db.session.commit()
+    page.hash = content_hash
+    if commit:
+        db.session.commit()
 
     return True, "success"
 
@@ -78,7 +82,6 @@ def create_copy(sub):
     db.session.add(copy)
     db.session.flush()
     copy.number = copy.id
-    db.session.commit()
 
     return copy
 
@@ -86,6 +89,8 @@ def create_copy(sub):
 def link_copy_to_scan(copy, scan):
     """Link a copy to a scan.
 
+    Warning: Does not commit the database changes
+
     Parameters
     ----------
     copy : Copy instance
@@ -96,4 +101,3 @@ def link_copy_to_scan(copy, scan):
 
     scan.copies.append(copy)
     db.session.add(scan)
-    db.session.commit()
@@ -1,22 +1,31 @@
 import functools
+import hashlib
 import itertools
 import math
 import os
-from collections import namedtuple
+from collections import OrderedDict, deque, namedtuple
+from pathlib import Path
 import signal
+import time
 
 import cv2
 import numpy as np
-from flask import current_app
+from billiard import Pool
+from billiard.exceptions import WorkerLostError
+from billiard.pool import ApplyResult
+from celery import chord
+from flask import Flask, current_app
 
 from PIL import Image
 from pylibdmtx import pylibdmtx
+from sqlalchemy import func
 from sqlalchemy.exc import InternalError, IntegrityError
 from reportlab.lib.units import inch
 
 from .database import (
     db,
     Scan,
+    ScanCheckpoint,
     Exam,
     Page,
     Student,
@@ -27,19 +36,59 @@ from .database import (
     ExamLayout,
     rollback_transaction_if_pending,
 )
-from .images import guess_dpi, get_box, is_misaligned
-from .pregrader import grade_page
-from .image_extraction import extract_pages_from_file, readable_filename
-from .blanks import reference_image
+from .images import guess_dpi, get_box, is_misaligned, normalize_dpi, to_grayscale
+from .pregrader import grade_page, pregrade_problems, problem_layout, reference_masks
+from .image_extraction import (
+    build_manifest,
+    extract_pages_from_manifest,
+    manifest_from_data,
+    manifest_page_infos,
+    manifest_to_data,
+    readable_filename,
+)
+from .blanks import reference_image, reference_mask
+from .constants import BARCODE_STRATEGY_CACHE_SIZE, BARCODE_TIMEOUT, PYRAMID_DPI
 from .raw_scans import process_page as process_page_raw, link_copy_to_scan
-from . import celery
+from . import celery, page_tiles
 
 ExtractedBarcode = namedtuple("ExtractedBarcode", ["token", "copy", "page"])
 
-ExamMetadata = namedtuple("ExamMetadata", ["token", "barcode_coords"])
+ExamMetadata = namedtuple(
+    "ExamMetadata",
+    ["token", "barcode_coords", "exam_id", "problems", "grayscale", "student_id_coords"],
+    defaults=(None, None, False, None),
+)
 
+PageAnalysis = namedtuple("PageAnalysis", ["success", "description", "barcode", "image", "image_path", "pregraded"])
 
-@celery.task()
+BarcodeStrategy = namedtuple("BarcodeStrategy", ["upside_down", "step", "blur", "threshold"])
+
+# Transformations we apply to the barcode in order to increase a chance of success,
+# upright pages are the most common and the downsampled images are the cheapest to decode.
+BARCODE_STRATEGIES = tuple(
+    BarcodeStrategy(upside_down, step, blur, threshold)
+    for upside_down in (False, True)
+    for blur, threshold in ((False, False), (False, True), (True, False), (True, True))
+    for step in (2, 1)
+)
+
+# Maps every pixel value above 100 to white and the rest to black
+_BARCODE_THRESHOLD_LUT = np.where(np.arange(256) > 100, 255, 0).astype(np.uint8)
+
+# Replaces the image of pages that are identical to a page that was stored before
+_DUPLICATE_PAGE = object()
+
+# The last successful barcode strategy of each exam token, tried first for the next page.
+# This is only a hint kept per worker process, the least recently used exams are forgotten.
+_preferred_barcode_strategy = OrderedDict()
+
+
+# The tasks are acknowledged when finished, such that they are restarted if a worker dies.
+# Restarted tasks continue after the last checkpointed page.
+_RESUMABLE_ERRORS = (SystemExit, KeyboardInterrupt, WorkerLostError)
+
+
+@celery.task(acks_late=True, reject_on_worker_lost=True)
 def process_scan(scan_id, scan_type):
     """Process a PDF, recording progress to a database
 
@@ -48,7 +97,154 @@ def process_scan(scan_id, scan_type):
     scan_id : int
         The ID in the database of the Scan to process
     """
+    _exit_on_signals()
+
+    try:
+        _process_scan(scan_id, ExamLayout(scan_type))
+    except _RESUMABLE_ERRORS:
+        # The task is delivered again and resumes after the last checkpointed page
+        raise
+    except BaseException as error:
+        # TODO: When #182 is implemented, properly separate user-facing
+        #       messages (written to DB) from developer-facing messages,
+        #       which should be written into the log.
+        write_scan_status(scan_id, "error", "Unexpected error: " + str(error))
+
 
+@celery.task(acks_late=True, reject_on_worker_lost=True)
+def process_scan_chunk(scan_id, scan_type, manifest_data, page_infos, start, total):
+    """Process a consecutive range of pages of a scan
+
+    Parameters
+    ----------
+    scan_id : int
+        The ID in the database of the Scan to process
+    scan_type : str
+        The layout of the exam.
+    manifest_data : list of tuple
+        The manifest entries of the pages in the range, see `image_extraction.manifest_to_data`.
+    page_infos : list of tuple of (None or int)
+        The page info of each page in the range, see `image_extraction.manifest_page_infos`.
+    start : int
+        The index of the first page of the range in the manifest of the scan.
+    total : int
+        The total number of pages in the scan.
+
+    Returns
+    -------
+    failures : list of (file_info, description)
+        The pages that could not be processed.
+    error : str or None
+        The error that stopped the processing of the range, if any.
+    """
+    _exit_on_signals()
+
+    try:
+        scan = Scan.query.filter(Scan.id == scan_id).one()
+        manifest = manifest_from_data(manifest_data)
+
+        failures = _process_pages(scan, ExamLayout(scan_type), manifest, page_infos, start, total)
+        return failures, None
+    except _RESUMABLE_ERRORS:
+        raise
+    except BaseException as error:
+        rollback_transaction_if_pending()
+        return [], str(error)
+
+
+@celery.task()
+def finish_scan(results, scan_id, total):
+    """Summarize the results of all `process_scan_chunk` tasks of a scan
+
+    Parameters
+    ----------
+    results : list of (failures, error)
+        The results of the tasks, see `process_scan_chunk`.
+    scan_id : int
+        The ID in the database of the processed Scan
+    total : int
+        The total number of pages in the scan.
+    """
+    errors = [error for _, error in results if error is not None]
+
+    if errors:
+        scan = Scan.query.get(scan_id)
+        write_scan_status(scan_id, "error", f"Failed to read file {scan.name}: " + "\n".join(errors))
+    else:
+        write_scan_result(scan_id, [failure for failures, _ in results for failure in failures], total)
+
+
+@celery.task(bind=True)
+def repregrade_exam(self, exam_id, problem_ids=None):
+    """Run the pregrading again on the stored pages of an exam
+
+    Solutions that are graded by a human are left untouched, see `pregrader.grade_page`.
+    The progress is reported as the ``PROGRESS`` state of the task, with the exam,
+    the amount of pages that are done and the total amount of pages as meta data.
+
+    Parameters
+    ----------
+    exam_id : int
+        The ID in the database of the Exam to pregrade
+    problem_ids : list of int, optional
+        The problems to pregrade, defaults to all problems of the exam.
+
+    Returns
+    -------
+    progress : dict
+        The ``exam_id``, the amount of pages that are ``done``, the ``total`` and the pages that ``failed``.
+    """
+    exam = Exam.query.filter(Exam.id == exam_id).one()
+    exam_config = exam_metadata(exam)
+
+    layouts = [layout for layout in exam_config.problems or () if problem_ids is None or layout.id in problem_ids]
+
+    # Submissions with multiple copies are not pregraded
+    single_copy_submissions = (
+        db.session.query(Copy.submission_id).group_by(Copy.submission_id).having(func.count(Copy.id) == 1)
+    )
+    pages = [
+        (page.id, page.abs_path, page.number)
+        for page in Page.query.join(Copy)
+        .join(Submission)
+        .filter(
+            Submission.exam_id == exam_id,
+            Copy.submission_id.in_(single_copy_submissions),
+            Page.number.in_({layout.page for layout in layouts}),
+        )
+        .order_by(Page.copy_id, Page.number)
+    ]
+
+    total = len(pages)
+    progress = {"exam_id": exam_id, "done": 0, "total": total, "failed": 0}
+    report_every = current_app.config["SCAN_BATCH_SIZE"]
+
+    def report_progress():
+        if self.request.id is not None and not self.request.is_eager:
+            self.update_state(state="PROGRESS", meta=progress)
+
+    # Reported right away, such that the exam of the task is known
+    report_progress()
+
+    results = pregrade_stored_pages(pages, exam_config, layouts, current_app.config["SCAN_PROCESSES"])
+    for done, (page_id, number, pregraded) in enumerate(results, start=1):
+        if isinstance(pregraded, Exception):
+            progress["failed"] += 1
+        else:
+            page = Page.query.get(page_id)
+            grade_page(page.copy, number, None, pregraded)
+
+        progress["done"] = done
+        if done % report_every == 0:
+            db.session.commit()
+            report_progress()
+
+    db.session.commit()
+
+    return progress
+
+
+def _exit_on_signals():
     def raise_exit(signo, frame):
         raise SystemExit("PDF processing was killed by an external signal")
 
@@ -58,83 +254,505 @@ def process_scan(scan_id, scan_type):
     for signal_type in (signal.SIGINT, signal.SIGTERM):
         signal.signal(signal_type, raise_exit)
 
-    try:
-        _process_scan(scan_id, ExamLayout(scan_type))
-    except BaseException as error:
-        # TODO: When #182 is implemented, properly separate user-facing
-        #       messages (written to DB) from developer-facing messages,
-        #       which should be written into the log.
-        write_scan_status(scan_id, "error", "Unexpected error: " + str(error))
-
 
 def _process_scan(scan_id, exam_layout):
-    data_directory = current_app.config["DATA_DIRECTORY"]
-
     report_error = functools.partial(write_scan_status, scan_id, "error")
     report_progress = functools.partial(write_scan_status, scan_id, "processing")
-    report_success = functools.partial(write_scan_status, scan_id, "success")
 
     # Raises exception if zero or more than one scans found
     scan = Scan.query.filter(Scan.id == scan_id).one()
 
     report_progress(f"Importing file {scan.name}")
 
-    output_directory = os.path.join(data_directory, f"{scan.exam.id}_data")
-
     try:
-        exam_config = exam_metadata(scan.exam)
+        exam_metadata(scan.exam)
     except Exception as e:
         report_error(f"Error while reading Exam metadata: {e}")
         raise
 
-    if exam_layout == ExamLayout.templated:
-        process_page_function = process_page
-    elif exam_layout == ExamLayout.unstructured:
-        process_page_function = process_page_raw
-    else:
+    if exam_layout not in (ExamLayout.templated, ExamLayout.unstructured):
         raise ValueError(f"Exam layout {exam_layout} is not defined.")
 
-    failures = []
     try:
-        for image, page_info, file_info, number, total in extract_pages_from_file(scan.path, scan.name):
-            report_progress(f"Processing page {number} / {total}")
-            if isinstance(image, Exception):
-                failures.append((file_info, str(image)))
-            elif not isinstance(image, Image.Image):
-                failures.append((file_info, "File is not an image."))
-            else:
-                try:
-                    success, description = process_page_function(
-                        image, page_info, file_info, exam_config, output_directory, scan
-                    )
-                    if not success:
-                        failures.append((file_info, description))
-                except Exception as e:
-                    rollback_transaction_if_pending()
-
-                    failures.append((file_info, str(e)))
+        manifest = list(build_manifest(scan.path, scan.name))
+        page_infos = manifest_page_infos(manifest)
+        total = len(manifest)
+
+        chunk_size = current_app.config["SCAN_CHUNK_SIZE"]
+        if chunk_size and total > chunk_size:
+            # Process large scans in parallel on all available Celery workers, the manifest is only built once
+            manifest_data = manifest_to_data(manifest)
+            chunks = [
+                process_scan_chunk.s(
+                    scan_id,
+                    exam_layout.value,
+                    manifest_data[start : start + chunk_size],
+                    page_infos[start : start + chunk_size],
+                    start,
+                    total,
+                )
+                for start in range(0, total, chunk_size)
+            ]
+            report_progress(f"Processing {total} pages in {len(chunks)} parts")
+            chord(chunks)(finish_scan.s(scan_id, total))
+            return
+
+        failures = _process_pages(scan, exam_layout, manifest, page_infos, 0, total)
     except Exception as e:
         report_error(f"Failed to read file {scan.name}: {e}")
         raise
 
+    write_scan_result(scan_id, failures, total)
+
+
+def _process_pages(scan, exam_layout, manifest, page_infos, start, total):
+    """Process and store consecutive pages of a scan, recording progress to the database
+
+    The final outcome of every page is checkpointed together with the page itself,
+    pages that already have a checkpoint are not processed again. Pages that failed
+    with an unexpected error are retried, except a page during which the worker died.
+
+    Parameters
+    ----------
+    scan : Scan
+        The scan the pages belong to.
+    exam_layout : ExamLayout
+    manifest : list of ManifestEntry
+        The entries of the pages in the manifest of the scan, see `image_extraction.build_manifest`.
+    page_infos : list of tuple of (None or int)
+        The page info of each entry, see `image_extraction.manifest_page_infos`.
+    start : int
+        The index of the first page in the manifest of the scan.
+    total : int
+        The total number of pages in the scan.
+
+    Returns
+    -------
+    failures : list of (file_info, description)
+        The pages that could not be processed, including the ones of earlier attempts.
+    """
+    report_progress = functools.partial(write_scan_status, scan.id, "processing")
+
+    exam_config = exam_metadata(scan.exam)
+    output_directory = os.path.join(current_app.config["DATA_DIRECTORY"], f"{scan.exam.id}_data")
+
+    checkpoints = {
+        checkpoint.position: checkpoint
+        for checkpoint in ScanCheckpoint.query.filter(
+            ScanCheckpoint.scan_id == scan.id,
+            ScanCheckpoint.position >= start,
+            ScanCheckpoint.position < start + len(manifest),
+        )
+    }
+    failures = [
+        (position, entry.file_info, checkpoint.description)
+        for position, entry in enumerate(manifest, start=start)
+        if (checkpoint := checkpoints.get(position)) is not None and not checkpoint.success
+    ]
+
+    in_progress_path = Path(f"{scan.path}.{start}.in-progress")
+    if (crashed := _page_in_progress(in_progress_path)) is not None and crashed not in checkpoints:
+        # Processing this page stopped the worker before, so it is not tried again
+        checkpoints[crashed] = ScanCheckpoint(
+            scan_id=scan.id, position=crashed, success=False, description="Processing this page stopped the worker."
+        )
+        db.session.add(checkpoints[crashed])
+        db.session.commit()
+        failures.append((crashed, manifest[crashed - start].file_info, checkpoints[crashed].description))
+
+    remaining = [
+        (position, entry, page_info)
+        for position, (entry, page_info) in enumerate(zip(manifest, page_infos), start=start)
+        if position not in checkpoints
+    ]
+    if checkpoints and remaining:
+        report_progress(f"Resuming at page {remaining[0][0] + 1} / {total}")
+
+    # The hashes of the images the pages of the exam are currently stored from, with the copies of these pages
+    known_hashes = {
+        content_hash: copy_id
+        for content_hash, copy_id in db.session.query(Page.hash, Page.copy_id)
+        .join(Copy, Copy.id == Page.copy_id)
+        .filter(Copy._exam_id == scan.exam_id, Page.hash.isnot(None))
+    }
+
+    def extracted_pages():
+        images = extract_pages_from_manifest(
+            scan.path, [entry for _, entry, _ in remaining], grayscale=exam_config.grayscale
+        )
+        for (position, _, page_info), (image, file_info) in zip(remaining, images):
+            content_hash = None
+            if isinstance(image, Image.Image):
+                # The page info determines where a page of an unstructured exam is stored
+                content_hash = image_hash(image, page_info if exam_layout == ExamLayout.unstructured else None)
+                if content_hash in known_hashes:
+                    # Skip the processing of pages that are identical to a stored page
+                    image = _DUPLICATE_PAGE
+            yield image, page_info, file_info, position, content_hash
+
+    pages = extracted_pages()
+    processes = current_app.config["SCAN_PROCESSES"]
+
+    if exam_layout == ExamLayout.templated and processes > 1:
+        pages = analyse_pages_in_pool(pages, exam_config, output_directory, processes)
+        process_page_function = store_analysed_page
+    elif exam_layout == ExamLayout.templated:
+        process_page_function = process_page
+    else:
+        process_page_function = process_page_raw
+
+    batch = PageBatch(current_app.config["SCAN_BATCH_SIZE"], current_app.config["SCAN_BATCH_SECONDS"])
+
+    for image, page_info, file_info, position, content_hash in pages:
+        duplicate = image is _DUPLICATE_PAGE
+        final = True
+        if duplicate:
+            success, description = True, "Duplicate of a page that was uploaded before."
+            copy_id = known_hashes[content_hash]
+            if copy_id is not None and (copy := Copy.query.get(copy_id)) not in scan.copies:
+                # The page is part of this scan as well
+                link_copy_to_scan(copy, scan)
+        elif isinstance(image, Exception):
+            success, description = False, str(image)
+        elif not isinstance(image, (Image.Image, PageAnalysis)):
+            success, description = False, "File is not an image."
+        else:
+            # Only left behind if the worker dies while processing the page
+            in_progress_path.write_text(str(position))
+            try:
+                success, description = batch.store(
+                    process_page_function,
+                    image,
+                    page_info,
+                    file_info,
+                    exam_config,
+                    output_directory,
+                    scan,
+                    content_hash=content_hash,
+                )
+            except Exception as e:
+                rollback_transaction_if_pending()
+
+                # The error may be temporary, such as a lost database connection, so the page is retried on resume
+                success, description, final = False, str(e), False
+            finally:
+                in_progress_path.unlink(missing_ok=True)
+
+        if not success:
+            failures.append((position, file_info, description))
+        elif content_hash is not None and not duplicate:
+            # Stored pages are linked to this scan already
+            known_hashes[content_hash] = None
+
+        if final:
+            # Committed together with the page, such that it is never processed twice
+            db.session.add(
+                ScanCheckpoint(
+                    scan_id=scan.id,
+                    position=position,
+                    success=success,
+                    description=description,
+                    hash=content_hash,
+                    duplicate=duplicate,
+                )
+            )
+
+        if batch.commit_if_due():
+            report_progress(f"Processed page {position + 1} / {total}")
+
+    batch.commit()
+
+    return [(file_info, description) for _, file_info, description in sorted(failures, key=lambda f: f[0])]
+
+
+def _page_in_progress(path):
+    """The position of the page that was being processed when the worker died, if any"""
+    try:
+        position = int(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+    path.unlink(missing_ok=True)
+    return position
+
+
+def image_hash(image, page_info=None):
+    """The SHA-256 hex digest of the pixels of an image, optionally combined with its page info."""
+    digest = hashlib.sha256(f"{image.mode} {image.width}x{image.height} {page_info} ".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def write_scan_result(scan_id, failures, total):
+    """Write the summary of a processed scan to the database
+
+    Parameters
+    ----------
+    scan_id : int
+        The ID in the database of the processed Scan
+    failures : list of (file_info, description)
+        The pages that could not be processed.
+    total : int
+        The total number of pages in the scan.
+    """
+    duplicates = ScanCheckpoint.query.filter(ScanCheckpoint.scan_id == scan_id, ScanCheckpoint.duplicate).count()
+    skipped = f" Skipped {duplicates} duplicate pages." if duplicates else ""
+
     if failures:
         processed = total - len(failures)
         if processed:
-            report_error(
-                f"Processed {processed} / {total} pages.\n"
-                + "\n".join(f"{readable_filename(file_info)}: {description}" for file_info, description in failures)
+            write_scan_status(
+                scan_id,
+                "error",
+                f"Processed {processed} / {total} pages.{skipped}\n"
+                + "\n".join(f"{readable_filename(file_info)}: {description}" for file_info, description in failures),
             )
         else:
-            report_error(
+            write_scan_status(
+                scan_id,
+                "error",
                 f"Failed on all {total} pages.\n"
-                + "\n".join(f"{readable_filename(file_info)}: {description}" for file_info, description in failures)
+                + "\n".join(f"{readable_filename(file_info)}: {description}" for file_info, description in failures),
             )
     else:
-        report_success(f"Processed {total} pages.")
+        write_scan_status(scan_id, "success", f"Processed {total} pages.{skipped}")
+
+
+class PageBatch:
+    """Stores scanned pages in the database with a single commit for many pages.
+
+    Every page is stored in its own savepoint, such that a failing page does not
+    affect the other pages of the batch.
+
+    Parameters
+    ----------
+    max_pages : int
+        The number of pages after which the batch is committed.
+    max_seconds : float
+        The time in seconds after which the batch is committed.
+    """
+
+    # The number of times a page is stored before an IntegrityError is raised
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, max_pages, max_seconds):
+        self.max_pages = max_pages
+        self.max_seconds = max_seconds
+        self._reset()
+
+    def _reset(self):
+        self.pages = 0
+        self.started = time.monotonic()
+
+    def store(self, process_page_function, *args, **kwargs):
+        """Store a single page in the batch.
+
+        Parameters
+        ----------
+        process_page_function : callable
+            A function with the signature of `process_page`, which is called
+            with `args`, `kwargs` and ``commit=False``.
+
+        Returns
+        -------
+        The return value of `process_page_function`.
+
+        Raises
+        ------
+        IntegrityError
+            If storing the page still conflicts after `MAX_ATTEMPTS` attempts.
+        """
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            try:
+                with db.session.begin_nested():
+                    result = process_page_function(*args, commit=False, **kwargs)
+                break
+            except IntegrityError:
+                if attempt == self.MAX_ATTEMPTS:
+                    raise
+                # The copy or page was added by a concurrent upload, which only becomes
+                # visible in a new transaction. Commit the batch and try again.
+                self.commit()
+
+        self.pages += 1
+        return result
+
+    def commit_if_due(self):
+        """Commit the batch if it is large or old enough.
+
+        Returns
+        -------
+        committed : bool
+            Whether the batch was committed.
+        """
+        if self.pages < self.max_pages and time.monotonic() - self.started < self.max_seconds:
+            return False
+
+        self.commit()
+        return True
+
+    def commit(self):
+        """Commit all pages stored in the batch."""
+        db.session.commit()
+        self._reset()
+
+
+def analyse_pages_in_pool(pages, exam_config, output_dir, processes):
+    """Run `analyse_page` for the extracted pages in a pool of processes.
+
+    Parameters
+    ----------
+    pages : iterable of tuple
+        The extracted pages, each a tuple starting with the image as yielded by
+        `image_extraction.extract_pages_from_manifest`.
+    exam_config : ExamMetadata instance
+        Information about the exam to which the pages should belong
+    output_dir : string
+        Path where the processed images must be stored.
+    processes : int
+        The number of processes to use.
+
+    Yields
+    ------
+    The same as `pages`, in the same order, but each image replaced by its
+    `PageAnalysis` or by the exception raised while analysing it.
+    At most ``2 * processes`` pages are in flight at the same time.
+    """
+    # Celery workers are daemonic processes, which are not allowed to have
+    # children when using multiprocessing. Billiard lifts this restriction.
+    with Pool(processes, initializer=_init_pool_worker, initargs=(_pool_worker_config(),)) as pool:
+        pending = deque()
+
+        for image, *page in pages:
+            if isinstance(image, Image.Image):
+                image = pool.apply_async(analyse_page, (image, exam_config, output_dir))
+            pending.append((image, *page))
+
+            if len(pending) >= 2 * processes:
+                yield _pool_result(*pending.popleft())
+
+        while pending:
+            yield _pool_result(*pending.popleft())
+
+
+def pregrade_stored_pages(pages, exam_config, layouts, processes=1):
+    """Run the image checks of the pregrader on stored pages.
+
+    Parameters
+    ----------
+    pages : iterable of (page_id, image_path, page_number)
+        The pages to check.
+    exam_config : ExamMetadata instance
+        Information about the exam to which the pages belong
+    layouts : list of ProblemLayout
+        The problems to check, see `pregrader.pregrade_problems`.
+    processes : int
+        The number of processes to use. If more than one, at most
+        ``2 * processes`` pages are in memory at the same time.
+
+    Yields
+    ------
+    page_id : int
+    page_number : int
+    pregraded : dict of int to PregradeResult or Exception
+        The result of `pregrader.pregrade_problems`, or the exception raised while checking the page.
+    """
+    if processes <= 1:
+        for page_id, image_path, number in pages:
+            try:
+                pregraded = pregrade_stored_page(image_path, number, exam_config, layouts)
+            except Exception as e:
+                pregraded = e
+            yield page_id, number, pregraded
+        return
+
+    with Pool(processes, initializer=_init_pool_worker, initargs=(_pool_worker_config(),)) as pool:
+        pending = deque()
+
+        for page_id, image_path, number in pages:
+            result = pool.apply_async(pregrade_stored_page, (image_path, number, exam_config, layouts))
+            pending.append((result, page_id, number))
+
+            if len(pending) >= 2 * processes:
+                result, page_id, number = _pool_result(*pending.popleft())
+                yield page_id, number, result
+
+        while pending:
+            result, page_id, number = _pool_result(*pending.popleft())
+            yield page_id, number, result
+
+
+def pregrade_stored_page(image_path, page, exam_config, layouts):
+    """Run the image checks of the pregrader on a stored page.
+
+    This function does not access the database, such that it can run in a separate process.
+
+    Parameters
+    ----------
+    image_path : str
+        The location of the stored image of the page.
+    page : int
+        The page number.
+    exam_config : ExamMetadata instance
+        Information about the exam to which the page belongs
+    layouts : list of ProblemLayout
+        The problems to check.
+
+    Returns
+    -------
+    pregraded : dict of int to PregradeResult
+        See `pregrader.pregrade_problems`.
+    """
+    with Image.open(image_path) as image:
+        image_array = np.array(image.convert("L" if exam_config.grayscale else "RGB"))
+
+    dpi = guess_dpi(image_array)
+    reference = reference_image(exam_config.exam_id, page, dpi, grayscale=exam_config.grayscale)
+    masks = reference_masks(exam_config.exam_id, page, dpi, grayscale=exam_config.grayscale)
+
+    return pregrade_problems(layouts, page, image_array, reference, masks)
+
+
+def _pool_result(result, *page):
+    if isinstance(result, ApplyResult):
+        try:
+            result = result.get()
+        except Exception as e:
+            result = e
+    return (result, *page)
+
+
+def _pool_worker_config():
+    """The part of the app config that can be sent to pool workers."""
+    return {
+        key: value
+        for key, value in current_app.config.items()
+        if isinstance(value, (str, int, float, bool, list, tuple, dict, type(None)))
+    }
+
+
+def _init_pool_worker(config):
+    """Provide an app context to pool workers, as the image processing reads the app config."""
+    app = Flask(__name__)
+    app.config.update(config)
+    app.app_context().push()
+
+
+def store_analysed_page(
+    analysis, page_info, file_info, exam_config, output_dir, scan=None, commit=True, content_hash=None
+):
+    """Incorporate a page analysed by `analyse_pages_in_pool` in the database.
+
+    Has the same signature and return values as `process_page`.
+    """
+    if not analysis.success:
+        return False, analysis.description
+
+    return store_page(analysis, exam_config, scan, commit=commit, content_hash=content_hash)
 
 
 def exam_metadata(exam):
-    """Read off exam token and barcode coordinates from the database."""
+    """Read off exam token, barcode coordinates and problem layouts from the database."""
 
     if exam.layout == ExamLayout.templated:
         # Raises exception if zero or more than one barcode widgets found
@@ -145,6 +763,13 @@ def exam_metadata(exam):
         # unstructured exams have no barcode
         barcode_widget = None
 
+    if exam.layout == ExamLayout.templated:
+        problems = tuple(problem_layout(problem) for problem in exam.problems if problem.widget is not None)
+        _, student_id_coords = exam_student_id_widget(exam.id)
+    else:
+        problems = None
+        student_id_coords = None
+
     return ExamMetadata(
         token=exam.token,
         barcode_coords=[
@@ -155,6 +780,10 @@ def exam_metadata(exam):
         ]
         if barcode_widget
         else None,
+        exam_id=exam.id,
+        problems=problems,
+        grayscale=exam.grayscale and exam.layout == ExamLayout.templated,
+        student_id_coords=student_id_coords,
     )
 
 
@@ -190,7 +819,17 @@ def write_scan_status(scan_id, status, message):
     db.session.commit()
 
 
-def process_page(image_data, page_info, file_info, exam_config, output_dir=None, scan=None, strict=False):
+def process_page(
+    image_data,
+    page_info,
+    file_info,
+    exam_config,
+    output_dir=None,
+    scan=None,
+    strict=False,
+    commit=True,
+    content_hash=None,
+):
     """Incorporate a scanned image in the data structure.
 
     For each page perform the following steps:
@@ -221,6 +860,10 @@ def process_page(image_data, page_info, file_info, exam_config, output_dir=None,
     strict : bool
         Whether to stop trying if we did not find corner markers.
         This spoils page positioning, but may increase the success rate.
+    commit : bool
+        Whether to commit the changes to the database, see `store_page`.
+    content_hash : str, optional
+        The hash of `image_data` to store with the page, see `image_hash`.
 
     Returns
     -------
@@ -237,27 +880,71 @@ def process_page(image_data, page_info, file_info, exam_config, output_dir=None,
     A page from a wrong exam likely means we're reading a wrong pdf, and
     therefore should stop processing any other pages if this function raises.
     """
+    analysis = analyse_page(image_data, exam_config, output_dir, strict)
+
+    if not analysis.success:
+        return False, analysis.description
+    elif output_dir is None:
+        return True, "Testing, image not saved and database not updated."
+
+    return store_page(analysis, exam_config, scan, strict, commit, content_hash)
+
+
+def analyse_page(image_data, exam_config, output_dir=None, strict=False):
+    """Perform the image processing of a scanned page.
+
+    This covers steps 1 to 4 and the image checks of step 6 of `process_page`.
+    It does not access the database, such that it can run in a separate process.
+
+    Parameters
+    ----------
+    image_data : PIL Image
+    exam_config : ExamMetadata instance
+        Information about the exam to which this page should belong
+    output_dir : string, optional
+        Path where the processed image must be stored. If not provided, the
+        image is not saved and no pregrading is performed.
+    strict : bool
+        See `process_page`.
+
+    Returns
+    -------
+    analysis : PageAnalysis
+        If `success` is False, `description` tells what went wrong.
+
+    Raises
+    ------
+    ValueError if the page is from a wrong exam.
+    """
+    if exam_config.grayscale and image_data.mode != "L":
+        image_data = image_data.convert("L")
+
     image_array = np.array(image_data)
     shape = image_array.shape
     if shape[0] < shape[1]:
         # Handle possible horizontal image orientation.
         image_array = np.array(np.rot90(image_array, -1))
 
+    # Everything downstream, including the stored image, uses the normalized resolution
+    image_array = normalize_dpi(image_array, current_app.config["SCAN_DPI"])
+
     try:
         barcode, upside_down = decode_barcode(image_array, exam_config)
         if upside_down:
             # TODO: check if view errors appear
             image_array = np.array(image_array[::-1, ::-1])
     except RuntimeError:
-        return False, "Reading barcode failed"
+        return PageAnalysis(False, "Reading barcode failed", None, None, None, None)
 
     if barcode.token != exam_config.token:
         raise ValueError("PDF is not from this exam")
 
     dpi = guess_dpi(image_array)
-    exam = Exam.query.filter(Exam.token == exam_config.token).one()
+    exam_id = exam_config.exam_id
+    if exam_id is None:
+        exam_id = Exam.query.filter(Exam.token == exam_config.token).one().id
 
-    reference = reference_image(exam.id, barcode.page, dpi)
+    reference = reference_image(exam_id, barcode.page, dpi, grayscale=exam_config.grayscale)
     reference_shape = reference.shape[0:2]
 
     try:
@@ -265,18 +952,57 @@ def process_page(image_data, page_info, file_info, exam_config, output_dir=None,
         image_array = realign_image(image_array, reference_shape, corner_keypoints)
     except RuntimeError as e:
         if strict:
-            return False, str(e)
+            return PageAnalysis(False, str(e), barcode, None, None, None)
         else:
             # Resize the image to match the reference
             image_array = resize_image(image_array, reference_shape)
 
-    if output_dir is not None:
-        image_path = save_image(image_array, barcode=barcode, base_path=output_dir)
+    if output_dir is None:
+        return PageAnalysis(True, "", barcode, image_array, None, None)
+
+    image_path = save_image(image_array, barcode=barcode, base_path=output_dir)
+
+    if exam_config.problems is not None:
+        masks = reference_masks(exam_id, barcode.page, dpi, grayscale=exam_config.grayscale)
+        pregraded = pregrade_problems(exam_config.problems, barcode.page, image_array, reference, masks)
     else:
-        return True, "Testing, image not saved and database not updated."
+        pregraded = None
+
+    return PageAnalysis(True, "", barcode, image_array, image_path, pregraded)
+
+
+def store_page(analysis, exam_config, scan=None, strict=False, commit=True, content_hash=None):
+    """Incorporate an analysed page in the database.
+
+    This covers step 5, 6 and 7 of `process_page`.
+
+    Parameters
+    ----------
+    analysis : PageAnalysis
+        The succesful result of `analyse_page`, including a saved image.
+    exam_config : ExamMetadata instance
+        Information about the exam to which this page belongs
+    scan : Scan instance, optional
+        The scan to link the copy to
+    strict : bool
+        See `process_page`.
+    commit : bool
+        Whether to commit the changes to the database. If False, the changes are
+        only flushed and an IntegrityError is raised if a concurrent upload added
+        the same copy or page, see `PageBatch`.
+    content_hash : str, optional
+        See `process_page`.
+
+    Returns
+    -------
+    success : bool
+    description : string
+        What has happened.
+    """
+    barcode = analysis.barcode
 
     # This copy belongs to a submission that may or may not have other copies
-    copy = add_to_correct_copy(image_path, barcode)
+    copy = add_to_correct_copy(analysis.image_path, barcode, commit, content_hash)
 
     # Link the copy to the scan
     if scan is not None:
@@ -284,19 +1010,22 @@ def process_page(image_data, page_info, file_info, exam_config, output_dir=None,
 
     try:
         # If the corresponding submission has multiple copies, this doesn't grade anything
-        grade_page(copy, barcode.page, image_array)
+        grade_page(copy, barcode.page, analysis.image, analysis.pregraded)
     except InternalError as e:
         if strict:
             return False, str(e)
 
     if barcode.page == 0:
         if not copy.validated:
-            description = guess_student(exam_token=barcode.token, copy_number=barcode.copy)
+            description = guess_student(copy, analysis.image, exam_config)
         else:
             description = "Student signature already validated."
     else:
         description = "Scanned page doesn't contain student number."
 
+    if commit:
+        db.session.commit()
+
     return True, description
 
 
@@ -320,11 +1049,13 @@ def save_image(image, barcode, base_path):
     submission_path = os.path.join(base_path, "submissions", f"{barcode.copy}")
     os.makedirs(submission_path, exist_ok=True)
     image_path = os.path.join(submission_path, f"page{barcode.page:02d}.jpg")
-    Image.fromarray(image).save(image_path)
+    pil_image = Image.fromarray(image)
+    pil_image.save(image_path)
+    page_tiles.update(image_path, pil_image)
     return image_path
 
 
-def add_to_correct_copy(image_path, barcode):
+def add_to_correct_copy(image_path, barcode, commit=True, content_hash=None):
     """Add a database entry for the new image or update an existing one.
 
     Parameters
@@ -333,6 +1064,11 @@ def add_to_correct_copy(image_path, barcode):
         Path to the image.
     barcode : ExtractedBarcode
         The data from the image barcode.
+    commit : bool
+        Whether to commit the new entries. If False, the entries are only flushed
+        and the IntegrityError of a concurrent upload is raised instead of retried.
+    content_hash : str, optional
+        The hash of the scanned image of the page, see `image_hash`.
 
     Returns
     -------
@@ -360,8 +1096,10 @@ def add_to_correct_copy(image_path, barcode):
                 for problem in exam.problems:
                     db.session.add(Solution(problem=problem, submission=sub))
 
-                db.session.commit()
+                _commit_or_flush(commit)
             except IntegrityError:
+                if not commit:
+                    raise
                 db.session.rollback()
                 copy = None
 
@@ -376,42 +1114,68 @@ def add_to_correct_copy(image_path, barcode):
             try:
                 page.path = image_path
                 db.session.add(page)
-                db.session.commit()
+                _commit_or_flush(commit)
             except IntegrityError:
+                if not commit:
+                    raise
                 db.session.rollback()
                 page = None
 
+    # The image of an existing page is replaced, and with it its hash
+    page.hash = content_hash
+
     return copy
 
 
+def _commit_or_flush(commit):
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+
+
 def decode_barcode(image, exam_config):
-    """Extract a barcode from a PIL Image."""
+    """Extract a barcode from a PIL Image.
+
+    The strategies in `BARCODE_STRATEGIES` are tried in order until one succeeds,
+    starting with the strategy that succeeded last for the same exam.
+
+    Scans with a resolution above twice `PYRAMID_DPI` are first downscaled, such
+    that the strategies with step 2 run at `PYRAMID_DPI`. Only if that fails, the
+    strategies are tried again at full resolution.
+    """
 
     barcode_coords = exam_config.barcode_coords
 
     # TODO: use points as base unit
     barcode_coords_in = np.asarray(barcode_coords) / 72
     rotated = np.rot90(image, k=2)
-    step_sizes = (1, 2)
-    image_crop = get_box(image, barcode_coords_in, padding=1.5)
-    image_crop_rotated = get_box(rotated, barcode_coords_in, padding=1.5)
-
-    images = [
-        (image[::step, ::step], ud)
-        for step in step_sizes
-        for (image, ud) in ((image_crop, False), (image_crop_rotated, True))
-    ]
+    image_crops = {
+        False: get_box(image, barcode_coords_in, padding=1.5),
+        True: get_box(rotated, barcode_coords_in, padding=1.5),
+    }
+    levels = [image_crops]
+
+    scale = 2 * PYRAMID_DPI / guess_dpi(image)
+    if scale < 1:
+        levels.insert(
+            0,
+            {
+                upside_down: cv2.resize(image_crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                for upside_down, image_crop in image_crops.items()
+            },
+        )
 
-    # Transformations we apply to images in order to increase a chance of succsess.
-    methods = [
-        (lambda img: Image.fromarray(img)),
-        (lambda img: Image.fromarray(img).point(lambda p: p > 100 and 255)),
-        (lambda img: Image.fromarray(cv2.blur(img, (3, 3)))),
-        (lambda img: (Image.fromarray(cv2.blur(img, (3, 3))).point(lambda p: p > 100 and 255))),
-    ]
+    preferred = _preferred_barcode_strategy.get(exam_config.token)
+    strategies = sorted(BARCODE_STRATEGIES, key=lambda strategy: strategy != preferred)
 
-    for (image, upside_down), method in itertools.product(images, methods):
-        results = pylibdmtx.decode(method(image))
+    for image_crops, strategy in itertools.product(levels, strategies):
+        results = pylibdmtx.decode(
+            _barcode_variant(image_crops[strategy.upside_down], strategy),
+            timeout=BARCODE_TIMEOUT,
+            max_count=1,
+            shape=pylibdmtx.DmtxSymbolSize.DmtxSymbolSquareAuto,
+        )
         if len(results) == 1:
             data = results[0].data
             data = data.decode("utf-8")
@@ -420,22 +1184,55 @@ def decode_barcode(image, exam_config):
                 token, copy, page = data.split("/")
                 copy = int(copy)
                 page = int(page)
-                return ExtractedBarcode(token, copy, page), upside_down
             except ValueError:
-                pass
+                continue
+
+            _preferred_barcode_strategy[exam_config.token] = strategy
+            _preferred_barcode_strategy.move_to_end(exam_config.token)
+            while len(_preferred_barcode_strategy) > BARCODE_STRATEGY_CACHE_SIZE:
+                _preferred_barcode_strategy.popitem(last=False)
+            return ExtractedBarcode(token, copy, page), strategy.upside_down
 
     raise RuntimeError("No barcode found.")
 
 
-def guess_student(exam_token, copy_number):
+def _barcode_variant(image_crop, strategy):
+    """Apply the transformations of a barcode strategy to the crop of a barcode.
+
+    Parameters
+    ----------
+    image_crop : numpy array
+        The area of the page containing the barcode
+    strategy : BarcodeStrategy
+        The transformations to apply
+
+    Returns
+    -------
+    image : PIL Image
+        The transformed image
+    """
+    image = image_crop[:: strategy.step, :: strategy.step]
+    if strategy.blur:
+        image = cv2.blur(image, (3, 3))
+    if strategy.threshold:
+        image = cv2.LUT(image, _BARCODE_THRESHOLD_LUT)
+
+    return Image.fromarray(image)
+
+
+def guess_student(copy, image, exam_config):
     """Update a submission with a guessed student number.
 
+    Warning: Does not commit the database changes
+
     Parameters
     ----------
-    exam_token : string
-        Unique exam identifier (see database schema).
-    copy_number : int
-        The copy number.
+    copy : Copy
+        The copy the first page belongs to.
+    image : numpy array
+        The realigned first page, as produced by `analyse_page`.
+    exam_config : ExamMetadata instance
+        Information about the exam to which the copy belongs.
 
     Returns
     -------
@@ -443,9 +1240,6 @@ def guess_student(exam_token, copy_number):
         Description of the outcome.
     """
 
-    # Throws exception if zero or more than one of Exam, Submission or Page found
-    exam = Exam.query.filter(Exam.token == exam_token).one()
-    copy = Copy.query.filter(Copy.number == copy_number, Copy.exam == exam).one()
     sub = copy.submission
 
     # We expect only a single copy, raise an error if we find more
@@ -458,15 +1252,17 @@ def guess_student(exam_token, copy_number):
     if copy.validated:
         return "Signature of this copy is already validated"
 
-    image_path = Page.query.filter(Page.copy == copy, Page.number == 0).one().abs_path
-
-    student_id_widget, student_id_widget_coords = exam_student_id_widget(exam.id)
+    student_id_widget_coords = exam_config.student_id_coords
+    if student_id_widget_coords is None:
+        _, student_id_widget_coords = exam_student_id_widget(sub.exam_id)
     student_id_widget_coords_inch = np.array(student_id_widget_coords) / 72
 
-    image = cv2.imread(image_path)
     dpi = guess_dpi(image)
-    reference = reference_image(exam.id, 0, dpi)
-    if is_misaligned(student_id_widget_coords_inch, image, reference, padding_inch=0.2):
+    reference = reference_image(sub.exam_id, 0, dpi, grayscale=exam_config.grayscale)
+    reference_bin = reference_mask(
+        sub.exam_id, 0, dpi, current_app.config["THRESHOLD_MISALIGMENT"], grayscale=exam_config.grayscale
+    )
+    if is_misaligned(student_id_widget_coords_inch, image, reference, padding_inch=0.2, reference_bin=reference_bin):
         return "Student id widget is misaligned, not guessing student"
 
     try:
@@ -477,7 +1273,6 @@ def guess_student(exam_token, copy_number):
     student = Student.query.get(int(number))
     if student is not None:
         sub.student = student
-        db.session.commit()
         return "Successfully extracted student number"
     else:
         return f"Student number {number} not in the database"
@@ -516,7 +1311,6 @@ def get_student_number(image, student_id_widget_coords):
     for center in centers.reshape(2, -1).T:
         x, y = center
         weights.append(np.sum(255 - thresholded[y - r : y + r, x - r : x + r]))
-        thresholded[y - r : y + r, x - r : x + r] = np.array([255, 0, 0])
 
     weights = np.array(weights).reshape(10, digits, order="F")
     return sum(((np.argmax(weights, axis=0)) % 10)[::-1] * 10 ** np.arange(digits))
@@ -562,9 +1356,12 @@ def find_corner_marker_keypoints(image_array, corner_sizes=[0.125, 0.25, 0.5]):
     If not enough are detected it continues with the next corner size
     until the list is depleted and raises a RunTimeError.
 
+    Scans with a resolution above `PYRAMID_DPI` are first searched at that
+    resolution, after which the markers are refined at full resolution.
+
     Parameters:
     -----------
-    image_data: 3d numpy array
+    image_data: 2d or 3d numpy array
 
     corner_sizes : list of float
         The corner sizes to search the corner markers in
@@ -575,12 +1372,9 @@ def find_corner_marker_keypoints(image_array, corner_sizes=[0.125, 0.25, 0.5]):
         The found corner markers, can contain 0-4 corner markers.
     """
     h, w, *_ = image_array.shape
-    marker_length = current_app.config["MARKER_LINE_LENGTH"] * guess_dpi(image_array) / 72
-    marker_width = current_app.config["MARKER_LINE_WIDTH"] * guess_dpi(image_array) / 72
-    marker_area = marker_length * marker_width * 2
-    marker_area_min = max(marker_length * (marker_width - 1) * 2, 0)  # One pixel thinner due to possible aliasing
+    dpi = guess_dpi(image_array)
 
-    binary_threshold = current_app.config["THRESHOLD_CORNER_MARKER"]
+    scale = min(PYRAMID_DPI / dpi, 1)
 
     corner_points = []
 
@@ -588,101 +1382,20 @@ def find_corner_marker_keypoints(image_array, corner_sizes=[0.125, 0.25, 0.5]):
     left_right = (True, False)
 
     for is_top, is_left in itertools.product(top_bottom, left_right):
-        corner_points_current_corner = []
-
         for corner_size in corner_sizes:
             # Filter out everything in the center of the image
             h_slice = slice(0, int(h * corner_size)) if is_top else slice(int(h * (1 - corner_size)), None)
             w_slice = slice(0, int(w * corner_size)) if is_left else slice(int(w * (1 - corner_size)), None)
 
-            gray_im = cv2.cvtColor(image_array[h_slice, w_slice], cv2.COLOR_BGR2GRAY)
-            _, inv_im = cv2.threshold(gray_im, binary_threshold, 255, cv2.THRESH_BINARY_INV)
-            ret, labels = cv2.connectedComponents(inv_im)
-            for label in range(1, ret):
-                new_img = labels == label
-
-                # Relative error determined to work well empirically
-                max_error = 1.19
-
-                blob_area = np.sum(new_img)
-                if not marker_area_min / max_error**2 < blob_area < marker_area * max_error**2:
-                    continue  # The area of the blob is too small or too large
-
-                new_img_uint8 = new_img.astype(np.uint8)
-
-                angle_resolution = 0.25 * np.pi / 180
-                spatial_resolution = 1
-                max_angle = 10 * np.pi / 180
-                max_angle_error = 3 * np.pi / 180
-                threshold = int(marker_length * 0.9)
-
-                lines_vertical_1 = cv2.HoughLines(
-                    new_img_uint8,
-                    rho=spatial_resolution,
-                    theta=angle_resolution,
-                    threshold=threshold,
-                    min_theta=0,
-                    max_theta=max_angle,
-                )
-                lines_vertical_2 = cv2.HoughLines(
-                    new_img_uint8,
-                    rho=spatial_resolution,
-                    theta=angle_resolution,
-                    threshold=threshold,
-                    min_theta=np.pi - max_angle,
-                    max_theta=np.pi,
-                )
-                lines_vertical = (lines_vertical_1, lines_vertical_2)
-                if all(lines is None for lines in lines_vertical):
-                    continue  # Didn't find any vertical lines
-                lines_vertical = np.vstack([lines for lines in (lines_vertical) if lines is not None])
-                lines_vertical = lines_vertical.reshape(-1, 2).T
-
-                # The vertical lines can have both theta ≈ 0 or theta ≈ π, here we flip those
-                # points to ensure that we end up with two reasonably contiguous regions.
-                to_flip = lines_vertical[1] > 3 * np.pi / 4
-                lines_vertical[1, to_flip] -= np.pi
-                lines_vertical[0, to_flip] *= -1
-
-                rho_v, theta_v = np.average(lines_vertical, axis=1)
-
-                # Search for horizontal lines that are nearly perpendicular
-                horizontal_angle = theta_v + np.pi / 2
-                lines_horizontal = cv2.HoughLines(
-                    new_img_uint8,
-                    spatial_resolution,
-                    angle_resolution,
-                    threshold,
-                    min_theta=horizontal_angle - max_angle_error,
-                    max_theta=horizontal_angle + max_angle_error,
-                )
-                if lines_horizontal is None:
-                    continue  # Didn't find any horizontal lines
-
-                lines_horizontal = lines_horizontal.reshape(-1, 2).T
-                rho_h, theta_h = np.average(lines_horizontal, axis=1)
-
-                marker_boundings = bounding_box_corner_markers(marker_length, theta_h, theta_v, is_top, is_left)
-                non_zero_points = cv2.findNonZero(new_img_uint8)
-                *_, blob_width, blob_height = cv2.boundingRect(non_zero_points)
-                invalid_dimensions = False
-                for blob_length, marker_bounding in zip((blob_width, blob_height), marker_boundings):
-                    if not marker_bounding / max_error < blob_length < marker_bounding * max_error:
-                        invalid_dimensions = True  # The dimensions of the blob are too large
-                        break
-                if invalid_dimensions:
-                    continue
-
-                y, x = np.linalg.solve(
-                    [[np.cos(theta_h), np.sin(theta_h)], [np.cos(theta_v), np.sin(theta_v)]], [rho_h, rho_v]
-                )
-                # TODO: add failsafes
-                if np.isnan(x) or np.isnan(y):
-                    continue
-                corner_points_current_corner.append((int(y) + w_slice.start, int(x) + h_slice.start))
+            gray_im = to_grayscale(image_array[h_slice, w_slice])
+            if scale < 1:
+                corner_points_current_corner = _refined_corner_markers(gray_im, dpi, scale, is_top, is_left)
+            else:
+                corner_points_current_corner = _corner_markers(gray_im, dpi, is_top, is_left)
 
             if len(corner_points_current_corner) == 1:
-                corner_points.append(corner_points_current_corner[0])
+                x, y = corner_points_current_corner[0]
+                corner_points.append((x + w_slice.start, y + h_slice.start))
                 break
 
             if len(corner_points_current_corner) > 1:
@@ -692,6 +1405,190 @@ def find_corner_marker_keypoints(image_array, corner_sizes=[0.125, 0.25, 0.5]):
     return corner_points
 
 
+def _corner_markers(gray_im, dpi, is_top, is_left):
+    """Find all corner markers in the grayscale image of a corner of a page
+
+    Returns
+    -------
+    corner_points : list of (int, int)
+        The (x, y) coordinates of the markers in `gray_im`.
+    """
+    marker_length = current_app.config["MARKER_LINE_LENGTH"] * dpi / 72
+    marker_width = current_app.config["MARKER_LINE_WIDTH"] * dpi / 72
+    marker_area = marker_length * marker_width * 2
+    marker_area_min = max(marker_length * (marker_width - 1) * 2, 0)  # One pixel thinner due to possible aliasing
+
+    # Relative error determined to work well empirically
+    max_error = 1.19
+    # Largest tilt of a marker line that is still considered, see _fit_corner_marker
+    max_tilt = (10 + 3) * np.pi / 180
+
+    # Limits on the bounding box of a marker, which may be tilted, used to discard blobs before fitting lines
+    marker_bounding_min = marker_length * np.cos(max_tilt) / max_error
+    marker_bounding_max = marker_length * (1 + np.sin(max_tilt)) * max_error
+
+    binary_threshold = current_app.config["THRESHOLD_CORNER_MARKER"]
+
+    _, inv_im = cv2.threshold(gray_im, binary_threshold, 255, cv2.THRESH_BINARY_INV)
+    if not cv2.countNonZero(inv_im):
+        return []  # Nothing in this corner, computing the statistics is relatively costly
+
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(inv_im)
+
+    # Discard all blobs with an unfit area or bounding box at once, skipping the background label
+    left, top, width, height, area = stats[1:].T
+    candidates = np.flatnonzero(
+        (marker_area_min / max_error**2 < area)
+        & (area < marker_area * max_error**2)
+        & (marker_bounding_min < width)
+        & (width < marker_bounding_max)
+        & (marker_bounding_min < height)
+        & (height < marker_bounding_max)
+    )
+
+    corner_points = []
+    # The Hough transform quantizes distances with respect to the origin, so each blob is kept in the
+    # coordinates of the corner. A single buffer is reused, of which only the bounding box of a blob is set.
+    blob_buffer = np.zeros(labels.shape, dtype=np.uint8) if len(candidates) else None
+    for index in candidates:
+        x0, y0, blob_width, blob_height = left[index], top[index], width[index], height[index]
+        x1, y1 = x0 + blob_width, y0 + blob_height
+
+        blob = blob_buffer[:y1, :x1]
+        np.equal(labels[y0:y1, x0:x1], index + 1, out=blob[y0:y1, x0:x1])
+        point = _fit_corner_marker(blob, (blob_width, blob_height), marker_length, max_error, is_top, is_left)
+        blob[y0:y1, x0:x1] = 0
+
+        if point is None:
+            continue
+
+        x, y = point
+        corner_points.append((int(x), int(y)))
+
+    return corner_points
+
+
+def _refined_corner_markers(gray_im, dpi, scale, is_top, is_left):
+    """Find all corner markers in a corner of a page, first on a copy downscaled by `scale`
+
+    Each marker found on the downscaled copy is refined in a small window at full
+    resolution. If no markers are found or the refinement fails, the full resolution
+    image is searched instead.
+
+    Returns
+    -------
+    The same as `_corner_markers`.
+    """
+    coarse_im = cv2.resize(gray_im, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    coarse_points = _corner_markers(coarse_im, dpi * scale, is_top, is_left)
+
+    # Half the size of the window, which contains the marker with any tilt or rounding error
+    marker_length = current_app.config["MARKER_LINE_LENGTH"] * dpi / 72
+    marker_width = current_app.config["MARKER_LINE_WIDTH"] * dpi / 72
+    radius = int(1.2 * marker_length + marker_width + 2 / scale)
+
+    corner_points = []
+    for x, y in coarse_points:
+        x0, y0 = max(0, int(x / scale) - radius), max(0, int(y / scale) - radius)
+        window = gray_im[y0 : int(y / scale) + radius, x0 : int(x / scale) + radius]
+
+        refined_points = _corner_markers(window, dpi, is_top, is_left)
+        if len(refined_points) != 1:
+            return _corner_markers(gray_im, dpi, is_top, is_left)
+
+        x, y = refined_points[0]
+        corner_points.append((x + x0, y + y0))
+
+    return corner_points
+
+
+def _fit_corner_marker(blob, blob_size, marker_length, max_error, is_top, is_left):
+    """Fits the lines of a corner marker to a blob and returns their intersection.
+
+    Parameters:
+    -----------
+    blob : 2d numpy array of uint8
+        Image in which the nonzero pixels belong to the blob
+    blob_size : (int, int)
+        The width and height of the bounding box of the blob
+    marker_length : float
+        The length of the corner marker lines in pixels
+    max_error : float
+        Relative error allowed on the bounding box of the blob
+    is_top, is_left : bool
+        The corner of the page the blob is in
+
+    Returns
+    -------
+    point : (float, float) or None
+        The (x, y) intersection of the lines in the coordinates of `blob`,
+        or None if the blob is not a corner marker.
+    """
+    angle_resolution = 0.25 * np.pi / 180
+    spatial_resolution = 1
+    max_angle = 10 * np.pi / 180
+    max_angle_error = 3 * np.pi / 180
+    threshold = int(marker_length * 0.9)
+
+    lines_vertical_1 = cv2.HoughLines(
+        blob,
+        rho=spatial_resolution,
+        theta=angle_resolution,
+        threshold=threshold,
+        min_theta=0,
+        max_theta=max_angle,
+    )
+    lines_vertical_2 = cv2.HoughLines(
+        blob,
+        rho=spatial_resolution,
+        theta=angle_resolution,
+        threshold=threshold,
+        min_theta=np.pi - max_angle,
+        max_theta=np.pi,
+    )
+    lines_vertical = (lines_vertical_1, lines_vertical_2)
+    if all(lines is None for lines in lines_vertical):
+        return None  # Didn't find any vertical lines
+    lines_vertical = np.vstack([lines for lines in (lines_vertical) if lines is not None])
+    lines_vertical = lines_vertical.reshape(-1, 2).T
+
+    # The vertical lines can have both theta ≈ 0 or theta ≈ π, here we flip those
+    # points to ensure that we end up with two reasonably contiguous regions.
+    to_flip = lines_vertical[1] > 3 * np.pi / 4
+    lines_vertical[1, to_flip] -= np.pi
+    lines_vertical[0, to_flip] *= -1
+
+    rho_v, theta_v = np.average(lines_vertical, axis=1)
+
+    # Search for horizontal lines that are nearly perpendicular
+    horizontal_angle = theta_v + np.pi / 2
+    lines_horizontal = cv2.HoughLines(
+        blob,
+        spatial_resolution,
+        angle_resolution,
+        threshold,
+        min_theta=horizontal_angle - max_angle_error,
+        max_theta=horizontal_angle + max_angle_error,
+    )
+    if lines_horizontal is None:
+        return None  # Didn't find any horizontal lines
+
+    lines_horizontal = lines_horizontal.reshape(-1, 2).T
+    rho_h, theta_h = np.average(lines_horizontal, axis=1)
+
+    marker_boundings = bounding_box_corner_markers(marker_length, theta_h, theta_v, is_top, is_left)
+    for blob_length, marker_bounding in zip(blob_size, marker_boundings):
+        if not marker_bounding / max_error < blob_length < marker_bounding * max_error:
+            return None  # The dimensions of the blob are too large
+
+    y, x = np.linalg.solve([[np.cos(theta_h), np.sin(theta_h)], [np.cos(theta_v), np.sin(theta_v)]], [rho_h, rho_v])
+    # TODO: add failsafes
+    if np.isnan(x) or np.isnan(y):
+        return None
+
+    return y, x
+
+
 def realign_image(image_array, page_shape, keypoints=None):
     """
     Transform the image so that the keypoints match the reference.
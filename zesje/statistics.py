@@ -1,4 +1,5 @@
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from math import nan
 
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -7,11 +8,47 @@ import numpy as np
 import pandas
 from sqlalchemy import between, desc, func
 
-from .database import db, Exam, Student, Grader, Solution, Submission
+from .database import db, Exam, Problem, Student, Grader, Solution, Submission, FeedbackOption, solution_feedback
+
+
+def solution_scores(exam_id, submission_id=None):
+    """Compute the scores of the solutions of an exam with a single query.
+
+    Parameters
+    ----------
+    exam_id : int
+        The exam to compute the scores for.
+    submission_id : int, optional
+        Only compute the scores of this submission.
+
+    Returns
+    -------
+    scores : dict of (int, int) to int
+        The score of each solution by (submission id, problem id).
+        Solutions without scored feedback are absent, their score is nan as in `Solution.score`.
+    """
+    query = (
+        db.session.query(Solution.submission_id, Solution.problem_id, func.sum(FeedbackOption.score))
+        .join(Submission, Submission.id == Solution.submission_id)
+        .join(solution_feedback, solution_feedback.c.solution_id == Solution.id)
+        .join(FeedbackOption, FeedbackOption.id == solution_feedback.c.feedback_option_id)
+        .filter(Submission.exam_id == exam_id)
+        .group_by(Solution.submission_id, Solution.problem_id)
+    )
+    if submission_id is not None:
+        query = query.filter(Solution.submission_id == submission_id)
+
+    # convert score to int because the query result is a SQLAlchemy integer
+    # which is not JSON serializable
+    return {(sub_id, problem_id): int(score) for sub_id, problem_id, score in query if score is not None}
+
 
+def solution_data(exam_id, student_id, scores=None):
+    """Return Python datastructures corresponding to the student submission.
 
-def solution_data(exam_id, student_id):
-    """Return Python datastructures corresponding to the student submission."""
+    The scores of the solutions are taken from `scores`, the result of
+    `solution_scores`, if given, otherwise they are queried.
+    """
 
     student = Student.query.get(student_id)
     if student is None:
@@ -23,6 +60,9 @@ def solution_data(exam_id, student_id):
     if sub is None:
         raise RuntimeError(f"Student #{student_id} does not have a validated submission for exam {exam_id}.")
 
+    if scores is None:
+        scores = solution_scores(exam_id, sub.id)
+
     results = []
     total_score = 0
     for solution in sub.solutions:  # Sorted by problem_id
@@ -39,7 +79,7 @@ def solution_data(exam_id, student_id):
             else []
         )
 
-        problem_data["score"] = solution.score
+        problem_data["score"] = scores.get((sub.id, problem.id), nan)
         problem_data["remarks"] = solution.remarks or ""
 
         results.append(problem_data)
@@ -58,17 +98,38 @@ def solution_data(exam_id, student_id):
 
 
 def full_exam_data(exam_id):
-    """Compute all grades of an exam as a pandas DataFrame."""
+    """Compute all grades of an exam as a pandas DataFrame.
+
+    The data is retrieved with a few queries for the whole exam, and arranged
+    in the columns of the DataFrame with pivot tables.
+    """
     exam = Exam.query.get(exam_id)
     if exam is None:
         raise NoResultFound("Exam does not exist.")
 
-    student_ids = (
-        db.session.query(Submission.student_id)
+    students = pandas.DataFrame(
+        db.session.query(Submission.id, Submission.student_id, Student.first_name, Student.last_name)
+        .join(Student, Student.id == Submission.student_id)
         .filter(Submission.exam_id == exam.id, Submission.validated)
         .order_by(Submission.student_id)
+        .all(),
+        columns=["submission_id", "student_id", "first_name", "last_name"],
+    )
+
+    feedback_options = (
+        FeedbackOption.query.join(Problem, Problem.id == FeedbackOption.problem_id)
+        .filter(Problem.exam_id == exam.id)
+        .order_by(FeedbackOption.id)
         .all()
     )
+    children = defaultdict(list)
+    for fo in feedback_options:
+        children[fo.parent_id].append(fo)
+
+    def all_descendants(fo):
+        for child in children[fo.id]:
+            yield child
+            yield from all_descendants(child)
 
     # keys used to distinguish problems or FO with the same name
     # we attach to the name its id to those that are repeated
@@ -86,7 +147,8 @@ def full_exam_data(exam_id):
         problem_keys[problem.id] = key
 
         columns[(key, "remarks")] = "string"
-        for fo in problem.root_feedback.all_descendants:
+        (root,) = (fo for fo in children[None] if fo.problem_id == problem.id)
+        for fo in all_descendants(root):
             if (key, fo.text) in feedback_keys.values():
                 feedback_keys[fo.id] = (key, f"{fo.text} ({fo.id})")
             else:
@@ -95,33 +157,62 @@ def full_exam_data(exam_id):
         columns[(key, "total")] = pandas.Int32Dtype()  # Contains nan
     columns[("total", "total")] = "int"
 
-    if not student_ids:
+    if students.empty:
         # No students were assigned.
         return pandas.DataFrame(columns=pandas.MultiIndex.from_tuples(columns.keys()))
 
-    df = pandas.DataFrame(
-        index=pandas.Index([id for id, in student_ids], name="Student ID", dtype="int"),
-        columns=pandas.MultiIndex.from_tuples(columns.keys()),
-    )
-
-    for (student_id,) in student_ids:
-        student, problems = solution_data(exam_id, student_id)
+    student_ids = students.set_index("submission_id")["student_id"]
 
-        df.loc[student["id"], ("First name", "")] = student["first_name"]
-        df.loc[student["id"], ("Last name", "")] = student["last_name"]
-
-        for problem in problems:
-            key = problem_keys[problem["id"]]
-
-            df.loc[student["id"], (key, "remarks")] = problem["remarks"]
-
-            for fo in problem["feedback"]:
-                df.loc[student["id"], feedback_keys[fo["id"]]] = fo["score"]
-
-            df.loc[student["id"], (key, "total")] = problem["score"]
-
-        df.loc[student["id"], ("total", "total")] = student["total"]
+    solutions = pandas.DataFrame(
+        db.session.query(Solution.submission_id, Solution.problem_id, Solution.remarks)
+        .join(Submission, Submission.id == Solution.submission_id)
+        .filter(Submission.exam_id == exam.id, Submission.validated)
+        .all(),
+        columns=["submission_id", "problem_id", "remarks"],
+    )
+    solutions["student_id"] = solutions["submission_id"].map(student_ids)
+
+    # Only the feedback of graded solutions is exported
+    feedback = pandas.DataFrame(
+        db.session.query(Solution.submission_id, FeedbackOption.id, FeedbackOption.score)
+        .join(Submission, Submission.id == Solution.submission_id)
+        .join(solution_feedback, solution_feedback.c.solution_id == Solution.id)
+        .join(FeedbackOption, FeedbackOption.id == solution_feedback.c.feedback_option_id)
+        .filter(Submission.exam_id == exam.id, Submission.validated, Solution.is_graded)
+        .all(),
+        columns=["submission_id", "feedback_id", "score"],
+    )
+    feedback["student_id"] = feedback["submission_id"].map(student_ids)
 
+    scores = pandas.DataFrame(
+        [(sub_id, problem_id, score) for (sub_id, problem_id), score in solution_scores(exam.id).items()],
+        columns=["submission_id", "problem_id", "score"],
+    )
+    scores["student_id"] = scores["submission_id"].map(student_ids)
+    scores = scores.dropna(subset=["student_id"])  # Scores of submissions that are not validated
+
+    index = pandas.Index(students["student_id"], name="Student ID", dtype="int")
+    remarks = solutions.fillna({"remarks": ""}).pivot(index="student_id", columns="problem_id", values="remarks")
+    remarks = remarks.reindex(index=index)
+    feedback_scores = feedback.pivot(index="student_id", columns="feedback_id", values="score").reindex(index=index)
+    problem_scores = scores.pivot(index="student_id", columns="problem_id", values="score").reindex(index=index)
+
+    data = {
+        ("First name", ""): students["first_name"].to_numpy(),
+        ("Last name", ""): students["last_name"].to_numpy(),
+    }
+    for problem_id, key in problem_keys.items():
+        if problem_id in remarks:
+            data[(key, "remarks")] = remarks[problem_id]
+    for feedback_id, key in feedback_keys.items():
+        if feedback_id in feedback_scores:
+            data[key] = feedback_scores[feedback_id]
+    for problem_id, key in problem_keys.items():
+        if problem_id in problem_scores:
+            data[(key, "total")] = problem_scores[problem_id]
+    data[("total", "total")] = problem_scores.sum(axis=1)
+
+    df = pandas.DataFrame(data, index=index, columns=pandas.MultiIndex.from_tuples(columns.keys()))
     df = df.astype(dtype=columns)  # set column types
 
     return df
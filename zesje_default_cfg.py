@@ -68,3 +68,35 @@ OAUTH_SCOPES = ["openid", "email"]
 # OAUTH_NAME_FIELD = 'name'
 # OAUTH_PROVIDER = 'Surf Conext'
 # OAUTH_SCOPES = ['openid']
+
+# Number of processes used for the image processing of scanned pages.
+# With 1 all pages are processed in the Celery task itself.
+SCAN_PROCESSES = 1
+
+# Scanned pages of templated exams with a higher resolution are downscaled to this
+# resolution before processing, which also applies to the stored images. Should be
+# one of 150, 200 or 300, for which the reference images are prepared. Use 0 to disable.
+SCAN_DPI = 300
+
+# Scanned pages are committed to the database in batches,
+# whenever this number of pages or seconds is reached.
+SCAN_BATCH_SIZE = 50
+SCAN_BATCH_SECONDS = 5
+
+# Scans with more pages than this are split in parts of this many pages,
+# which are processed in parallel by the available Celery workers. Use 0 to disable.
+SCAN_CHUNK_SIZE = 200
+
+# Maximum memory in MB used by each process to cache decoded reference images
+REFERENCE_CACHE_SIZE = 256
+
+# Maximum disk space in MB used to cache the images of solutions shown to graders, use 0 to disable
+IMAGE_CACHE_SIZE = 512
+
+# Number of submissions ahead of a grader whose solution images are rendered in the background, use 0 to disable.
+# This is best effort, the images are rendered by each web server process and only kept in the image cache.
+PREFETCH_SUBMISSIONS = 3
+
+# Whether to also store pages as tiles at multiple resolutions, which speeds up showing (parts of) pages
+# at the cost of about twice the disk space. Existing pages are tiled with `yarn migrate:tiles`.
+PAGE_TILES = False